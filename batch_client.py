@@ -0,0 +1,197 @@
+"""
+Batch submission client: fans many cases out to the Celery workers with a bounded number of
+tasks in flight, collects results asynchronously, retries failures with exponential backoff
+and writes a summary.
+
+Manifest: one JSON job per line, e.g.
+    {"id": "case01", "task": "tasks.dli_read", "params": {"path": "...", "stream_label": "tracettalgupdate2", ...}}
+    {"task": "tasks.add", "args": [5, 3]}
+("params" is shorthand for kwargs={"params": ...}).
+
+Usage:
+    python batch_client.py manifest.jsonl --max-in-flight 16 --retries 2 --summary summary.json
+    python batch_client.py manifest.jsonl --group     # all jobs at once as one celery group, no retries
+"""
+import argparse
+import asyncio
+import json
+import time
+import logging
+from celery import group
+from common.transport import resolve
+
+
+def load_manifest(filename):
+    ''' read a JSONL manifest, blank lines and lines starting with # are skipped '''
+    jobs = []
+    with open(filename, 'r') as fp:
+        for num, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            job = json.loads(line)
+            job.setdefault('id', f'job{num}')
+            jobs.append(job)
+    return jobs
+
+
+def job_signature(app, job):
+    ''' celery signature of a manifest job '''
+    kwargs = dict(job.get('kwargs', {}))
+    if 'params' in job:
+        kwargs['params'] = job['params']
+    options = {k: job[k] for k in ('queue', 'priority') if k in job}
+    return app.signature(job['task'], args=job.get('args', ()), kwargs=kwargs, **options)
+
+
+def fan_out_group(app, jobs):
+    ''' all jobs as one celery group (unbounded, e.g. as the header of a chord) '''
+    return group(job_signature(app, job) for job in jobs)
+
+
+class BatchClient():
+    '''
+    Args:
+        app (Celery): application used to send the tasks.
+        max_in_flight (int): maximum number of submitted, unfinished tasks.
+        retries (int): extra attempts per failed job.
+        backoff (float): seconds before the first retry, doubled on every retry (up to backoff_max).
+        poll_interval (float): seconds between result state checks.
+        timeout (float): seconds after which a running job is counted as failed (None: no limit).
+        progress (callable): called with every finished job record.
+    '''
+
+    def __init__(self, app, max_in_flight=16, retries=2, backoff=5.0, backoff_max=300.0,
+                 poll_interval=1.0, timeout=None, progress=None):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.progress = progress
+
+    async def wait_result(self, result):
+        '''
+        poll the result state without blocking the event loop (backend calls run in worker threads).
+        A task still running after timeout is revoked (and terminated) before the job is retried.
+        '''
+        t0 = time.monotonic()
+        while not await asyncio.to_thread(result.ready):
+            if self.timeout and time.monotonic() - t0 > self.timeout:
+                await asyncio.to_thread(result.revoke, terminate=True)
+                raise TimeoutError(f'task {result.id} did not finish within {self.timeout} sec, revoked')
+            await asyncio.sleep(self.poll_interval)
+        if await asyncio.to_thread(result.failed):
+            raise RuntimeError(f'{result.state}: {result.result!r}')
+        return await asyncio.to_thread(lambda: resolve(result.result))
+
+    async def run_job(self, job, semaphore):
+        record = {'id': job['id'], 'task': job['task'], 'attempts': 0, 'task_ids': []}
+        t0 = time.monotonic()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+                logging.info(f"batch: retry {job['id']} in {delay} sec")
+                await asyncio.sleep(delay)
+            record['attempts'] += 1
+            async with semaphore:
+                try:
+                    result = await asyncio.to_thread(job_signature(self.app, job).apply_async)
+                    record['task_ids'].append(result.id)
+                    record['result'] = await self.wait_result(result)
+                    record['state'] = 'SUCCESS'
+                    record.pop('error', None)
+                    break
+                except Exception as e:
+                    record['state'] = 'FAILURE'
+                    record['error'] = str(e)
+                    logging.warning(f"batch: {job['id']} attempt {record['attempts']} failed: {e}")
+        record['elapsed_sec'] = round(time.monotonic() - t0, 3)
+        if self.progress:
+            self.progress(record)
+        return record
+
+    async def run_async(self, jobs):
+        ''' run all jobs, at most max_in_flight at a time; returns the summary '''
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        t0 = time.monotonic()
+        records = await asyncio.gather(*(self.run_job(job, semaphore) for job in jobs))
+        return self.summary(records, time.monotonic() - t0)
+
+    def run(self, jobs):
+        return asyncio.run(self.run_async(jobs))
+
+    async def run_group_async(self, jobs):
+        '''
+        submit all jobs at once as one celery group (fan_out_group: the broker holds the backlog, the
+        workers' concurrency bounds the work in flight) and collect the results; jobs are not retried.
+        '''
+        t0 = time.monotonic()
+        group_result = await asyncio.to_thread(fan_out_group(self.app, jobs).apply_async)
+
+        async def collect(job, result):
+            record = {'id': job['id'], 'task': job['task'], 'attempts': 1, 'task_ids': [result.id]}
+            try:
+                record['result'] = await self.wait_result(result)
+                record['state'] = 'SUCCESS'
+            except Exception as e:
+                record['state'] = 'FAILURE'
+                record['error'] = str(e)
+                logging.warning(f"batch: {job['id']} failed: {e}")
+            record['elapsed_sec'] = round(time.monotonic() - t0, 3)
+            if self.progress:
+                self.progress(record)
+            return record
+
+        records = await asyncio.gather(*(collect(job, result) for job, result in zip(jobs, group_result.results)))
+        return self.summary(records, time.monotonic() - t0)
+
+    def run_group(self, jobs):
+        return asyncio.run(self.run_group_async(jobs))
+
+    @staticmethod
+    def summary(records, elapsed):
+        failed = [r for r in records if r['state'] != 'SUCCESS']
+        return {'total': len(records),
+                'succeeded': len(records) - len(failed),
+                'failed': len(failed),
+                'retries': sum(r['attempts'] - 1 for r in records),
+                'elapsed_sec': round(elapsed, 3),
+                'failed_ids': [r['id'] for r in failed],
+                'jobs': records}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='JSONL file, one job per line')
+    parser.add_argument('--max-in-flight', type=int, default=16)
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--backoff', type=float, default=5.0)
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--timeout', type=float, default=None)
+    parser.add_argument('--group', action='store_true',
+                        help='submit all jobs at once as one celery group (no in-flight bound, no retries)')
+    parser.add_argument('--summary', help='write the summary (JSON) to this file')
+    args = parser.parse_args(argv)
+
+    from celery_app import app
+
+    def progress(record):
+        print(f"{record['id']:>20s} {record['state']:8s} attempts={record['attempts']} {record['elapsed_sec']} sec")
+
+    client = BatchClient(app, max_in_flight=args.max_in_flight, retries=args.retries, backoff=args.backoff,
+                         poll_interval=args.poll_interval, timeout=args.timeout, progress=progress)
+    jobs = load_manifest(args.manifest)
+    summary = client.run_group(jobs) if args.group else client.run(jobs)
+    print(f"{summary['succeeded']}/{summary['total']} succeeded, {summary['failed']} failed, "
+          f"{summary['retries']} retries, {summary['elapsed_sec']} sec")
+    if args.summary:
+        with open(args.summary, 'w') as fp:
+            json.dump(summary, fp, indent=4, default=str)
+    return 0 if not summary['failed'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
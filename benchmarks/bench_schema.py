@@ -0,0 +1,48 @@
+"""
+Benchmark of the reflective read_generic against the compiled SchemaCache extractor
+on synthetic nested, array-bearing records.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_schema --records 20000 --repeat 3
+"""
+import argparse
+import time
+
+from pyDli.schema import SchemaCache, read_generic
+from pyDli.fake_dli import make_records, ARRAY_TYPES, TUPLE_TYPES
+
+
+def timeit(func, records, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = [func(rec) for rec in records]
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def run(num_of_records=20000, repeat=3):
+    records = make_records(num_of_records)
+
+    t_generic, out_generic = timeit(lambda rec: read_generic(rec, array_types=ARRAY_TYPES, tuple_types=TUPLE_TYPES), records, repeat)
+    cache = SchemaCache(array_types=ARRAY_TYPES, tuple_types=TUPLE_TYPES)
+    t_schema, out_schema = timeit(cache.extract, records, repeat)
+    assert out_generic == out_schema, 'compiled extractor output differs from read_generic'
+
+    return {
+        'records': num_of_records,
+        'read_generic_sec': t_generic,
+        'schema_cache_sec': t_schema,
+        'read_generic_rec_per_sec': num_of_records / t_generic,
+        'schema_cache_rec_per_sec': num_of_records / t_schema,
+        'speedup': t_generic / t_schema,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    for k, v in run(args.records, args.repeat).items():
+        print(f'{k:26s}: {v:,.3f}' if isinstance(v, float) else f'{k:26s}: {v}')
@@ -0,0 +1,51 @@
+"""
+Cold import time of the Celery entry points, each measured in a fresh interpreter:
+celery_app (clients: send_task / results) and celery_tasks (workers: task definitions).
+Also reports whether the heavy backends (pythonnet, numpy, DLI / PHT modules) were imported.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_startup --repeat 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+MODULES = ['celery_app', 'celery_tasks']
+HEAVY_MODULES = ['clr', 'numpy', 'pyDli.pyDli', 'pyDli.mp_dli', 'pht_runner.pht_runner']
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'sec': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def import_time(module, python=sys.executable):
+    ''' seconds to import module in a fresh interpreter, and the heavy modules it pulled in '''
+    out = subprocess.run([python, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)], cwd=ROOT,
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(repeat=5, modules=MODULES):
+    results = {}
+    for module in modules:
+        runs = [import_time(module) for _ in range(repeat)]
+        results[module] = {'import_sec': min(r['sec'] for r in runs), 'heavy_modules': runs[-1]['heavy']}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    for module, res in run(args.repeat).items():
+        print(f"{module:14s}: {res['import_sec'] * 1000:8.1f} ms   heavy modules: {res['heavy_modules'] or 'none'}")
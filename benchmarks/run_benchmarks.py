@@ -0,0 +1,154 @@
+"""
+Reproducible benchmark suite of the Python side of the DLI pipeline, on the pure-Python
+fake DliReader (pyDli.fake_dli), so it runs on any machine.
+
+Benchmarks:
+    parse    read_generic vs the compiled SchemaCache extractor, per data size
+    writers  stream_read into every output writer, per data size
+    mp_dli   MP_dli process fan-out, per worker count
+    startup  cold import time of celery_app / celery_tasks (fresh interpreter)
+
+Results are compared with the last run stored in the baseline file and, with
+--update-baseline, appended to it so performance can be tracked over time.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --sizes 2000,20000 --workers 1,2,4 --update-baseline
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks import bench_schema, bench_startup
+from pyDli.fake_dli import FakeDli, fake_loader
+from pyDli.stream_writer import WRITERS, get_writer, stream_read
+from pyDli.mp_dli import MP_dli
+from pyDli import dli_pool
+
+
+BASELINE_FILE = Path(__file__).parent.joinpath('baseline.json')
+STREAM_LABEL = 'tracettalgupdate2'
+
+
+def bench_parse(sizes, repeat):
+    results = {}
+    for size in sizes:
+        res = bench_schema.run(size, repeat)
+        results[f'parse/read_generic/{size}'] = res['read_generic_rec_per_sec']
+        results[f'parse/schema_cache/{size}'] = res['schema_cache_rec_per_sec']
+    return results
+
+
+def bench_writers(sizes, block_size, output_types):
+    results = {}
+    tmp_dir = tempfile.mkdtemp(prefix='bench_writers_')
+    try:
+        for size in sizes:
+            dli = FakeDli(first_last_key=(0, size - 1), period=1)
+            for output_type in output_types:
+                t0 = time.perf_counter()
+                with get_writer(output_type, os.path.join(tmp_dir, f'{output_type}_{size}')) as writer:
+                    stream_read(dli, STREAM_LABEL, writer, block_size=block_size)
+                elapsed = time.perf_counter() - t0
+                results[f'writers/{output_type}/{size}'] = writer.num_of_records / elapsed
+                results[f'writers/{output_type}/{size}/bytes_per_record'] = writer.bytes_written / max(writer.num_of_records, 1)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def bench_mp_dli(size, workers, block_size):
+    results = {}
+    loader = fake_loader(first_last_key=(0, size - 1), period=1)
+    for max_workers in workers:
+        mp = MP_dli(version='fake', path='.', stream_label=STREAM_LABEL, tsRange=[0, size - 1],
+                    block_size=block_size, max_workers=max_workers, loader=loader)
+        # warm up: start the pool once, the measured run reuses it
+        mp.get_pool().submit(dli_pool.first_last_key, '.', STREAM_LABEL).result()
+        t0 = time.perf_counter()
+        res = mp.process()
+        elapsed = time.perf_counter() - t0
+        results[f'mp_dli/workers={max_workers}/{size}'] = res['Num of records'] / elapsed
+    dli_pool.shutdown_pools()
+    return results
+
+
+def bench_startup_time(repeat):
+    ''' imports per second (1 / cold import time), so that like the other results higher is better '''
+    return {f'startup/{module}/imports_per_sec': 1 / res['import_sec']
+            for module, res in bench_startup.run(repeat).items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_baseline(filename):
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {'runs': []}
+
+
+def compare(results, previous):
+    ''' print every result with its ratio to the previous run (throughputs: > 1 is faster) '''
+    for name, value in results.items():
+        line = f'{name:55s} {value:14,.1f}'
+        if previous and name in previous['results']:
+            line += f'   x{value / previous["results"][name]:.2f} vs {previous["commit"]}'
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='2000,20000', help='records per benchmark (comma separated)')
+    parser.add_argument('--workers', default='1,2,4', help='MP_dli worker counts (comma separated)')
+    parser.add_argument('--block-size', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help='run only these benchmarks (comma separated: parse,writers,mp_dli,startup)')
+    parser.add_argument('--baseline', default=str(BASELINE_FILE))
+    parser.add_argument('--update-baseline', action='store_true', help='append this run to the baseline file')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    workers = [int(w) for w in args.workers.split(',')]
+    only = set(args.only.split(',')) if args.only else {'parse', 'writers', 'mp_dli', 'startup'}
+
+    results = {}
+    if 'parse' in only:
+        results.update(bench_parse(sizes, args.repeat))
+    if 'writers' in only:
+        results.update(bench_writers(sizes, args.block_size, list(WRITERS)))
+    if 'mp_dli' in only:
+        results.update(bench_mp_dli(max(sizes), workers, args.block_size))
+    if 'startup' in only:
+        results.update(bench_startup_time(args.repeat))
+
+    baseline = load_baseline(args.baseline)
+    compare(results, baseline['runs'][-1] if baseline['runs'] else None)
+
+    if args.update_baseline:
+        baseline['runs'].append({'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                                 'commit': git_commit(),
+                                 'platform': platform.platform(),
+                                 'python': platform.python_version(),
+                                 'cpu_count': os.cpu_count(),
+                                 'results': results})
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=4)
+        print(f'baseline updated: {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+Lightweight Celery entry point: the application and its configuration only, no task backends.
+Clients that only send tasks and read results (batch_client.py, Flower, notebooks) import `app` from here;
+the workers load the task definitions of celery_tasks.py (include), whose heavy backends
+(pythonnet / DLI, numpy, PHT runner) are imported inside the tasks on first use.
+"""
+import os
+from common.transport import TransportCelery, result_transport_config
+from common.routing import routing_config
+
+
+# Celery configuration
+REDIS_URL = os.getenv("REDIS_URL", "redis://wdcoretech02:6379/0")  # Default Redis URL for Celery broker and backend
+
+
+# results go through msgpack + zlib, large results are offloaded to RESULT_STORE_DIR (see common/transport.py)
+app = TransportCelery(
+    "case_processor",  # Name of the Celery application
+    broker=REDIS_URL,  # Broker URL for task queue
+    backend=REDIS_URL,  # Backend URL for storing task results
+    include=["celery_tasks"],  # Task modules loaded by the workers
+)
+
+app.conf.update(
+    task_serializer="json",  # Serialize tasks as JSON
+    accept_content=["json"],  # Accept only JSON content
+    timezone="UTC",  # Set timezone to UTC
+    enable_utc=True,  # Enable UTC for task scheduling
+    **result_transport_config(),  # Compact, compressed results
+    **routing_config()  # light / io / parse / heavy queues, cost-based routing of dli_read (see common/routing.py)
+)
@@ -1,30 +1,26 @@
-from celery import Celery
 import os, sys
 import time
-# from pyDli.mp_dli import MP_dli  # Importing MP_dli for DLI processing
-from pyDli.pyDli import PyDli
-from pht_runner.pht_runner import PHT_runner  # Importing PHT_runner for PHT processing
+import logging
 from pathlib import Path
 import pickle, json
-
-
-# Celery configuration
-REDIS_URL = os.getenv("REDIS_URL", "redis://wdcoretech02:6379/0")  # Default Redis URL for Celery broker and backend
-
-
-app = Celery(
-    "case_processor",  # Name of the Celery application
-    broker=REDIS_URL,  # Broker URL for task queue
-    backend=REDIS_URL  # Backend URL for storing task results
-)
-
-app.conf.update(
-    task_serializer="json",  # Serialize tasks as JSON
-    result_serializer="json",  # Serialize results as JSON
-    accept_content=["json"],  # Accept only JSON content
-    timezone="UTC",  # Set timezone to UTC
-    enable_utc=True,  # Enable UTC for task scheduling
-)
+import shutil
+from celery import group
+from celery.signals import worker_process_init
+from common.transport import resolve
+from common import warm_state
+# the app and its configuration live in celery_app (light, for clients); the DLI / PHT backends 
+# (pythonnet, numpy, ...) are imported inside the tasks on first use so importing this module stays fast
+from celery_app import app, REDIS_URL
+
+
+@worker_process_init.connect
+def init_worker_state(**kwargs):
+    """ 
+    Per worker process warm state (loaded DLI assemblies, parsed configs, fetched tester paths), 
+    reused by all the tasks of the process. Bounded by WARM_STATE_MAX_ENTRIES (default 64). 
+    Thread pools share the process registry, which is created on first use. 
+    """
+    warm_state.init_worker()
 
 
 @app.task(name='tasks.add')
@@ -51,13 +47,22 @@ def generic_task(type: str, params: dict):
     """
     if type == 'echo':
         time.sleep(5)  # Simulate a delay
-        print(params)  # Print the parameters
+        logging.info(f'echo: {params}')
     else:
-        print('unknown type!!!!')  # Handle unknown types
+        logging.warning(f'generic_task: unknown type {type!r}')
     return params
 
 
-@app.task(name='tasks.dli_read', bind=True)
+def is_transient(exc): 
+    """ share / disk errors worth a retry, not a missing path or a denied access (they fail the same way again) """
+    return isinstance(exc, OSError) and \
+        not isinstance(exc, (FileNotFoundError, PermissionError, NotADirectoryError, IsADirectoryError))
+
+
+# acks_late + reject_on_worker_lost: a read whose worker dies (restart, OOM kill) is delivered again 
+# and continues from its checkpoint, so the crash costs at most the block in flight
+@app.task(name='tasks.dli_read', bind=True, acks_late=True, reject_on_worker_lost=True, 
+          max_retries=3, default_retry_delay=60)
 def dli_read(self, params: dict):
     self.update_state(state='PROGRESS', meta={'step': 'Initializing DLI'})
     """
@@ -65,11 +70,28 @@ def dli_read(self, params: dict):
     Args:
         params (dict): Parameters for the DLI process.
             Required keys: 'version', 'path', 'stream_label', 'output_path'.
-            Optional keys: 'tsRange', 'max_workers'.
+            Optional keys: 'tsRange', 'block_size', 'use_cache' (default True), 
+                           'parallel' ('cluster': 'num_of_parts' sub-tasks spread over the workers, 
+                                       'local': MP_dli process pool of 'max_workers' on this node), 
+                           'output_type' ('json' (default), 'jsonl', 'pk', 
+                                          'columnar' (.npz) or 'columnar_npy' (memory-mappable .npy directory)), 
+                           'metrics_path' (also write the stage metrics to this file, .prom: Prometheus text, else JSON), 
+                           'fields' (dotted field paths to extract, e.g. ['Timestamp', 'Location.X']), 
+                           'where' (row filter, e.g. {'field': 'Valid', 'op': '==', 'value': True}), 
+                           'stride' (keep every n-th record), 
+                           'checkpoint' (default True: finished blocks are recorded in <output>.checkpoint.json 
+                                         and skipped when the same read runs again; json, jsonl and pk outputs 
+                                         and the parts of parallel reads). 
+            'stream_label' can also be a list of labels or 'all' (every stream of stream2reader.json): the streams are 
+            read concurrently with one loaded DLI ('stream_workers' (default 4), 'stream_mode' 'thread' (default) or 'process') 
+            and described by 'manifest_name' (default 'manifest.json') in output_path.
     Returns:
-        bool or str: True if successful, error message otherwise.
+        dict or str: {'success': True, 'output', 'records', 'metrics'} if successful, error message otherwise.
     """
-    print(params)
+    logging.info(f'dli_read: {params}')
+    from pyDli.pyDli import PyDli
+    from pyDli.stream_writer import get_writer, stream_read, merge_parts
+    from pyDli.checkpoint import open_output, job_key, CheckpointBusy
     required_keys = ['version', 'path', 'stream_label', 'output_path']
     if all(k in params for k in required_keys):
         
@@ -91,29 +113,244 @@ def dli_read(self, params: dict):
                     dliVersion = params.get('version', None))
         self.update_state(state='PROGRESS', meta={'step': 'Loading DLI'})
         dli.loadDli()
-        print(dli.get_first_last_key(stream_label=stream_label))
-        trace=dli.read(stream_label, ts_range=params.get('tsRange', None))
-        self.update_state(state='PROGRESS', meta={'step': 'Reading Data'})
-        res_dict = dli.parse(trace, stream_label=stream_label)
-        self.update_state(state='PROGRESS', meta={'step': 'Parsing Data'})
-        
-        if output_path: 
-            self.update_state(state='PROGRESS', meta={'step': 'Saving Output'})
-            if output_type == 'json':
-                output_filename = Path(output_path).joinpath(f'{stream_label}[{tsRange}].json')
-                if output_type == 'json':
-                    with open(output_filename, 'w') as fp:
-                        json.dump(res_dict, fp)
-                elif output_type == 'pk':
-                    with open(output_filename, 'wb') as fp:
-                        pickle.dump(res_dict, fp)
-
-        
-
-        return True
+        output_filename = Path(output_path).joinpath(f'{stream_label}[{tsRange}]')
+        multi_stream = isinstance(stream_label, list) or stream_label == 'all'
+        if not tsRange and not multi_stream: 
+            tsRange = dli.get_first_last_key(stream_label=stream_label)
+        logging.info(f'dli_read: {stream_label} tsRange {tsRange}')
+
+        if multi_stream: 
+            manifest = read_streams_task(self, dli, params, tsRange)
+            return task_result(dli.metrics, params, manifest=manifest['manifest'], 
+                               streams={k: v['status'] for k, v in manifest['streams'].items()}, 
+                               records=sum(v.get('records', 0) for v in manifest['streams'].values()))
+
+        use_checkpoint = params.get('checkpoint', True)
+        job = {'version': dli.dliVersion, 'path': str(params.get('path')), 'stream_label': stream_label, 
+               'tsRange': list(tsRange), 'block_size': params.get('block_size', 50000), 
+               'use_cache': params.get('use_cache', True), 'extract': extract_options(params)}
+
+        parallel = params.get('parallel')
+        if parallel in ('cluster', 'local'): 
+            # per-block parts are read in parallel, then merged in order into one artifact. 
+            # With a checkpoint the parts directory belongs to the job (not to this run) and is kept 
+            # until the merge succeeds, so a new run reuses the finished parts.
+            # A stride is counted over the whole stream: the parts are read without it and the merge 
+            # applies it, so the output is the one of a serial read (not with 'where', which is applied first) 
+            stride = params.get('stride') or 1
+            if stride > 1 and params.get('where'): 
+                raise ValueError(f"dli_read: 'stride' with 'where' is not supported by parallel={parallel} reads")
+            part_params = {k: v for k, v in params.items() if k != 'stride'}
+            run_key = job_key(dict(job, parallel=parallel))[:16] if use_checkpoint else self.request.id
+            parts_dir = Path(output_path).joinpath(f'.parts-{run_key}')
+            parts_dir.mkdir(exist_ok=True)
+            merged = False
+            try: 
+                if parallel == 'cluster': 
+                    part_files = read_parts_cluster(self, part_params, tsRange, parts_dir)
+                else: 
+                    part_files = read_parts_local(self, part_params, dli.dliVersion, tsRange, parts_dir)
+
+                self.update_state(state='PROGRESS', meta={'step': 'Merging parts', 'parts': len(part_files)})
+                with dli.metrics.stage('serialize') as rec: 
+                    with get_writer(output_type, output_filename) as writer: 
+                        rec.records = merge_parts(part_files, writer, stride=stride)
+                    rec.bytes = writer.bytes_written
+                merged = True
+            except CheckpointBusy as e: 
+                # parts still written by an earlier delivery of this read
+                raise self.retry(exc=e)
+            finally: 
+                if merged or not use_checkpoint: 
+                    shutil.rmtree(parts_dir, ignore_errors=True)
+            return task_result(dli.metrics, params, output=str(writer.filename), records=writer.num_of_records)
+
+        def progress(block_num, block, num_of_records): 
+            self.update_state(state='PROGRESS', meta={'step': 'Reading Data', 
+                                                      'block': block_num, 
+                                                      'tsRange': list(block), 
+                                                      'records': num_of_records, 
+                                                      'metrics': dli.metrics.as_dict()})
+
+        # read, parse and write block by block to keep memory bounded by block_size
+        try: 
+            writer, checkpoint = open_output(output_type, output_filename, job) if use_checkpoint \
+                else (get_writer(output_type, output_filename), None)
+        except CheckpointBusy as e: 
+            # a redelivered copy of a read that is still running
+            raise self.retry(exc=e)
+        try: 
+            with writer: 
+                stream_read(dli, stream_label, writer, ts_range=tsRange, 
+                            block_size=params.get('block_size', 50000), progress=progress, 
+                            block_cache=get_block_cache(dli, params), metrics=dli.metrics, 
+                            extract=extract_options(params), checkpoint=checkpoint)
+            if checkpoint: 
+                checkpoint.finish()
+        except OSError as e: 
+            # share / disk errors: retry, the checkpoint keeps the finished blocks
+            if not is_transient(e): 
+                raise
+            raise self.retry(exc=e)
+        finally: 
+            if checkpoint: 
+                checkpoint.close()
+
+        return task_result(dli.metrics, params, output=str(writer.filename), records=writer.num_of_records)
     else:
         return 'Missing params in pyDli process'
 
+
+def task_result(metrics, params, **result): 
+    """ 
+    result of a pipeline task: the given fields plus per-stage metrics (wall time, records/sec, bytes, peak RSS). 
+    With params['metrics_path'] the metrics are also written as Prometheus text (.prom) or JSON. 
+    """
+    if params.get('metrics_path'): 
+        metrics.write(params['metrics_path'])
+    return {'success': True, **result, 'metrics': metrics.as_dict()}
+
+
+def extract_options(params): 
+    """ field projection / row filter / decimation of a dli_read request (applied while parsing) """
+    return {k: params[k] for k in ('fields', 'where', 'stride') if params.get(k)}
+
+
+def get_block_cache(dli, params): 
+    """ parsed blocks are cached, repeated / overlapping requests only read the missing blocks """
+    from pyDli.result_cache import get_result_cache
+    stream_label = params.get('stream_label')
+    result_cache = get_result_cache(dli.config) if params.get('use_cache', True) else None
+    if not result_cache: 
+        return None
+    extract = {k: v for k, v in extract_options(params).items() if k != 'stride'}
+    return result_cache.for_stream(dli.stream_fingerprint(stream_label), stream_label, dli.dliVersion, extract)
+
+
+def read_streams_task(task, dli, params, tsRange): 
+    """ multi-stream dli_read: every stream of params['stream_label'] with one loaded DLI and case index """
+    from pyDli.multi_stream import read_streams
+    done = []
+
+    def progress(stream_label, entry): 
+        done.append(stream_label)
+        task.update_state(state='PROGRESS', meta={'step': 'Reading Data', 
+                                                  'streams_done': len(done), 
+                                                  'stream': stream_label, 
+                                                  'status': entry['status'], 
+                                                  'metrics': dli.metrics.as_dict()})
+
+    def block_cache(stream_label): 
+        return get_block_cache(dli, dict(params, stream_label=stream_label))
+
+    return read_streams(dli, params['stream_label'], params['output_path'], 
+                        output_type=params.get('output_type', 'json'), ts_range=tsRange, 
+                        block_size=params.get('block_size', 50000), 
+                        max_workers=params.get('stream_workers', 4), mode=params.get('stream_mode', 'thread'), 
+                        extract=extract_options(params), block_cache=block_cache, progress=progress, 
+                        manifest_name=params.get('manifest_name', 'manifest.json'), 
+                        output_name=lambda stream_label: f'{stream_label}[{params.get("tsRange")}]')
+
+
+def read_parts_cluster(task, params, tsRange, parts_dir): 
+    """
+    Fan the range out as 'tasks.dli_read_block' sub-tasks (one per part, spread over the cluster) 
+    and aggregate their progress into the parent task's PROGRESS meta.
+    Returns:
+        list: part files, ordered by time.
+    """
+    from pyDli.stream_writer import split_range
+    # parts do not overlap: the records of an edge timestamp are read by one part only
+    parts = split_range(tsRange, params.get('num_of_parts', 16))
+    job = group(dli_read_block.s(params, part, str(parts_dir.joinpath(f'{i:06d}'))) 
+                for i, part in enumerate(parts)).apply_async()
+
+    while not job.ready(): 
+        records = 0
+        for res in job.results: 
+            if isinstance(res.info, dict): 
+                records += res.info.get('records', 0)
+        task.update_state(state='PROGRESS', meta={'step': 'Reading Data', 
+                                                  'parallel': 'cluster', 
+                                                  'parts': len(parts), 
+                                                  'parts_done': job.completed_count(), 
+                                                  'records': records})
+        time.sleep(params.get('poll_interval', 2))
+
+    if job.failed(): 
+        raise RuntimeError(f'{len(parts) - job.completed_count()} of {len(parts)} dli_read_block sub-tasks failed')
+    return [resolve(res.result)['file'] for res in job.results]
+
+
+def read_parts_local(task, params, version, tsRange, parts_dir): 
+    """
+    Read the range on this node's MP_dli process pool (one part file per block).
+    Returns:
+        list: part files, ordered by time.
+    """
+    from pyDli.mp_dli import MP_dli
+    def progress(num_of_blocks, num_of_records): 
+        task.update_state(state='PROGRESS', meta={'step': 'Reading Data', 
+                                                  'parallel': 'local', 
+                                                  'blocks_done': num_of_blocks, 
+                                                  'records': num_of_records})
+
+    mp = MP_dli(version=version, path=params.get('path'), stream_label=params.get('stream_label'), 
+                tsRange=list(tsRange), block_size=params.get('block_size', 50000), 
+                max_workers=params.get('max_workers', os.cpu_count()), 
+                output_path=str(parts_dir), output_type='pk', 
+                target_records=params.get('target_records'), extract=extract_options(params), 
+                checkpoint=params.get('checkpoint', True))
+    res = mp.process(progress=progress)
+    return [block['file'] for block in res['Blocks']]
+
+
+@app.task(name='tasks.dli_read_block', bind=True, acks_late=True, reject_on_worker_lost=True, 
+          max_retries=3, default_retry_delay=60)
+def dli_read_block(self, params: dict, tsRange: list, part_filename: str):
+    """
+    Sub-task of a parallel ('cluster') dli_read: read one part of the range into a chunked pickle part file. 
+    The part is checkpointed like a dli_read output, a redelivered or repeated part continues from its last block.
+    Returns:
+        dict: {'tsRange', 'file', 'records'}
+    """
+    from pyDli.pyDli import PyDli
+    from pyDli.stream_writer import get_writer, stream_read
+    from pyDli.checkpoint import open_output, CheckpointBusy
+    dli = PyDli(caseDir=params.get('path'), 
+                dliVersion = params.get('version', None))
+    dli.loadDli()
+
+    def progress(block_num, block, num_of_records): 
+        self.update_state(state='PROGRESS', meta={'step': 'Reading Data', 'records': num_of_records})
+
+    job = {'version': dli.dliVersion, 'path': str(params.get('path')), 'stream_label': params.get('stream_label'), 
+           'tsRange': list(tsRange), 'block_size': params.get('block_size', 50000), 
+           'use_cache': params.get('use_cache', True), 'extract': extract_options(params)}
+    try: 
+        writer, checkpoint = open_output('pk', part_filename, job) if params.get('checkpoint', True) \
+            else (get_writer('pk', part_filename), None)
+    except CheckpointBusy as e: 
+        raise self.retry(exc=e)
+    try: 
+        with writer: 
+            stream_read(dli, params.get('stream_label'), writer, ts_range=tsRange, 
+                        block_size=params.get('block_size', 50000), progress=progress, 
+                        block_cache=get_block_cache(dli, params), extract=extract_options(params), 
+                        checkpoint=checkpoint)
+        if checkpoint: 
+            # kept (complete) with the part until the parent merged the parts and removed their directory: 
+            # a retried merge reuses the part 
+            checkpoint.finish(remove=False)
+    except OSError as e: 
+        if not is_transient(e): 
+            raise
+        raise self.retry(exc=e)
+    finally: 
+        if checkpoint: 
+            checkpoint.close()
+    return {'tsRange': tsRange, 'file': str(writer.filename), 'records': writer.num_of_records}
+
 @app.task(name='tasks.pht_run', bind=True)
 def pht_run(self, params: dict):
     self.update_state(state='PROGRESS', meta={'step': 'Initializing PHT process'})
@@ -122,27 +359,78 @@ def pht_run(self, params: dict):
     Args:
         params (dict): Parameters for the PHT process.
             Required keys: 'path'.
+            Optional keys: 'metrics_path' (see dli_read), 'phtester_command' (tester command template, 
+                           default: phtester_command of pht_runner/config.ini).
     Returns:
-        bool: True if successful.
+        dict: {'success', 'label', 'returncode', 'killed', 'log_file', 'tail', 'metrics'}; success is False 
+              when the tester exits with a non-zero code or is killed by the supervisor (killed: 'timeout' / 'memory').
     """
+    from pht_runner.pht_runner import PHT_runner
+    from pht_runner.supervisor import ProcessLimitError
 
     pht = PHT_runner(dataDir= params.get('dataDir'), 
                      label=params.get('label'), 
                      enable_traces=params.get('enable_traces'), 
-                     exclude_dirs=params.get('enable_traces', None) )
-    print(pht)
+                     exclude_dirs=params.get('exclude_dirs', None), 
+                     phtester_command=params.get('phtester_command'))
+    logging.info(f'pht_run: {pht}')
     self.update_state(state='PROGRESS', meta={'step': 'Reading Carto version'})
     pht.readCartoVersion()
     self.update_state(state='PROGRESS', meta={'step': 'Copying PHT tester files'})
     pht.copy_phtester()
+    # the callbacks run on copy / supervisor threads, where self.request (thread local) has no task id
+    task_id = self.request.id
+
+    def publish(meta): 
+        self.update_state(task_id=task_id, state='PROGRESS', meta=meta)
+
     self.update_state(state='PROGRESS', meta={'step': 'Copying recordings'})
-    pht.copy_recordings()
+    pht.copy_recordings(progress=lambda stats: publish({'step': 'Copying recordings', **stats}))
     self.update_state(state='PROGRESS', meta={'step': 'Updating trace configurations'})
     pht.update_trace_config()
     self.update_state(state='PROGRESS', meta={'step': 'Running PHT tester'})
-    pht.run_phtester()
+    try: 
+        tester = pht.run_phtester(progress=lambda status: publish({'step': 'Running PHT tester', **status}), 
+                                  waiting=lambda: publish({'step': 'Waiting for a free PHT tester slot'}))
+    except ProcessLimitError as e: 
+        tester = e.result
+
+    return task_result(pht.metrics, params, success=tester['returncode'] == 0 and not tester['killed'], 
+                       label=pht.label, returncode=tester['returncode'], killed=tester['killed'], 
+                       log_file=tester['log_file'], tail=tester['tail'][-20:])
 
-    return True
+
+@app.task(name='tasks.pht_batch', bind=True)
+def pht_batch(self, params: dict):
+    """
+    Run a batch of PHT cases as a staged pipeline: the next cases' recordings are copied while 
+    the tester runs, finished cases are harvested (copy_result + cleanup) while others still run.
+    Args:
+        params (dict): 
+            Required keys: 'cases' (list of {'dataDir', 'label', 'enable_traces', 'exclude_dirs', 'remote_output_path', 
+                           'phtester_command'}).
+            Optional keys: 'run_workers' (default: phtester_slots), 'copy_workers' (default 1), 
+                           'queue_size' (default 1), 'harvest' (default True).
+    Returns:
+        dict: {'success': True, 'total', 'succeeded', 'failed', 'elapsed_sec', 'stage_busy_sec', 'items'}
+    """
+    from pht_runner.pipeline import run_pht_batch
+    cases = params.get('cases') or []
+    states = {}
+    # progress runs on the stage threads, where self.request (thread local) has no task id
+    task_id = self.request.id
+
+    def progress(case, stage_name): 
+        states[case['label']] = f"{case['state']}:{stage_name}"
+        self.update_state(task_id=task_id, state='PROGRESS', meta={'step': 'Running PHT batch', 
+                                                  'cases': len(cases), 
+                                                  'states': dict(states)})
+
+    summary = run_pht_batch(cases, run_workers=params.get('run_workers'), 
+                            copy_workers=params.get('copy_workers', 1), 
+                            queue_size=params.get('queue_size', 1), 
+                            harvest=params.get('harvest', True), progress=progress)
+    return {'success': summary['failed'] == 0, **summary}
 
 
 
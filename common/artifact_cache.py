@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+from pathlib import Path
+import logging
+from common.locking import FileLock
+
+
+META_DIR = '.cache'
+
+
+def file_digest(path, bufsize=8 * 1024 * 1024):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(bufsize):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_manifest(root, with_hash=False):
+    ''' {relative path: {'size': .., 'sha1': ..}} of all files under root '''
+    manifest = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            entry = {'size': os.path.getsize(path)}
+            if with_hash:
+                entry['sha1'] = file_digest(path)
+            manifest[os.path.relpath(path, root).replace(os.sep, '/')] = entry
+    return manifest
+
+
+class Lease():
+    '''
+    Shared "in use" mark of a cache entry: a lease file in <root>/.cache/<version>.leases, locked
+    for as long as the lease is held. Any number of leases of a version can be held at once;
+    the lock of a lease file left by a dead process is free, so its lease counts as released.
+    '''
+
+    def __init__(self, leases_dir):
+        self.path = Path(leases_dir).joinpath(f'{os.getpid()}-{uuid.uuid4().hex[:12]}')
+        self.lock = FileLock(self.path)
+        self.lock.acquire()
+
+    def release(self):
+        if self.lock.locked:
+            self.lock.release()
+            self.path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ArtifactCache():
+    '''
+    Local, versioned cache of directories fetched from a remote share (DLI and PHTester binaries).
+
+    - entries live in <root>/<version>, the same local paths as before
+    - fetching a version holds a per-version file lock, concurrent fetches of the same version wait
+      for the first one and then reuse its copy
+    - each entry has an integrity manifest (file sizes, optionally sha1), invalid entries are re-fetched
+    - when the cache grows beyond max_bytes the least recently used entries are evicted, except the
+      leased ones (see lease(): a loaded DLI version, a running PHTester)
+    - hit / miss / eviction counters are kept in <root>/.cache/index.json
+    Args:
+        root (str): local cache directory.
+        max_bytes (int): size bound, None for unbounded.
+        verify_hash (bool): record and check sha1 of every file (slower).
+        lock_timeout (float): seconds to wait for another process fetching the same version.
+    '''
+
+    def __init__(self, root, max_bytes=None, verify_hash=False, lock_timeout=None):
+        self.root = Path(root)
+        self.meta_dir = self.root.joinpath(META_DIR)
+        self.max_bytes = max_bytes
+        self.verify_hash = verify_hash
+        self.lock_timeout = lock_timeout
+
+    def entry_path(self, version):
+        return self.root.joinpath(version)
+
+    def manifest_path(self, version):
+        return self.meta_dir.joinpath(f'{version}.manifest.json')
+
+    def lock(self, version, timeout=None):
+        return FileLock(self.meta_dir.joinpath(f'{version}.lock'), timeout=timeout)
+
+    def leases_dir(self, version):
+        return self.meta_dir.joinpath(f'{version}.leases')
+
+    def lease(self, version):
+        '''
+        Mark version as in use until the returned Lease is released: it is not evicted meanwhile.
+        Take the lease before fetch(), so the entry cannot be evicted between the fetch and its use.
+        '''
+        return Lease(self.leases_dir(version))
+
+    def is_leased(self, version):
+        ''' True if a live process holds a lease of version (stale lease files are removed) '''
+        leased = False
+        for path in self.leases_dir(version).glob('*'):
+            lock = FileLock(path)
+            if not lock.acquire(blocking=False):
+                leased = True
+                continue
+            lock.release()
+            path.unlink(missing_ok=True)
+        return leased
+
+    # ---- index (last use, size, metrics) ----
+    def _update_index(self, func):
+        with FileLock(self.meta_dir.joinpath('index.lock')):
+            index_path = self.meta_dir.joinpath('index.json')
+            try:
+                with open(index_path, 'r') as fp:
+                    index = json.load(fp)
+            except (OSError, ValueError):
+                index = {'entries': {}, 'metrics': {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_fetched': 0}}
+            res = func(index)
+            tmp_path = index_path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as fp:
+                json.dump(index, fp, indent=4)
+            os.replace(tmp_path, index_path)
+            return res
+
+    def metrics(self):
+        return self._update_index(lambda index: dict(index['metrics']))
+
+    def _record(self, version, metric, size=None, fetched=0):
+        def update(index):
+            index['metrics'][metric] += 1
+            index['metrics']['bytes_fetched'] += fetched
+            entry = index['entries'].setdefault(version, {})
+            entry['last_used'] = time.time()
+            if size is not None:
+                entry['size'] = size
+        self._update_index(update)
+
+    # ---- entries ----
+    def is_valid(self, version):
+        ''' check the entry against its integrity manifest '''
+        entry = self.entry_path(version)
+        try:
+            with open(self.manifest_path(version), 'r') as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        for rel_path, info in manifest['files'].items():
+            path = entry.joinpath(rel_path)
+            try:
+                if path.stat().st_size != info['size']:
+                    return False
+            except OSError:
+                return False
+            if 'sha1' in info and self.verify_hash and file_digest(path) != info['sha1']:
+                return False
+        return True
+
+    def fetch(self, version, remote_path):
+        '''
+        Local path of version, copied from remote_path on a miss.
+        Returns:
+            Path: <root>/<version>
+        '''
+        entry = self.entry_path(version)
+        self.meta_dir.mkdir(parents=True, exist_ok=True)
+        with self.lock(version, timeout=self.lock_timeout):
+            if self.is_valid(version):
+                logging.info(f'artifact cache hit : {version}')
+                self._record(version, 'hits')
+                return entry
+
+            remote_path = Path(remote_path)
+            if not remote_path.exists():
+                if entry.exists() and not self.manifest_path(version).exists():
+                    logging.warning(f'artifact cache: remote {remote_path} not reachable, use unverified local copy of {version}')
+                    return entry
+                raise FileNotFoundError(f'unable to find {version} in remote repository ({remote_path})')
+
+            if entry.exists() and not self.manifest_path(version).exists():
+                # entry copied before the cache existed: adopt it if it matches the remote copy
+                if build_manifest(entry) == build_manifest(remote_path):
+                    logging.info(f'artifact cache adopt existing entry : {version}')
+                    size = self._write_manifest(version)
+                    self._record(version, 'hits', size=size)
+                    return entry
+
+            logging.info(f'artifact cache miss : {version}, copy from {remote_path}')
+            tmp_entry = self.meta_dir.joinpath(f'{version}.tmp-{os.getpid()}')
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            shutil.copytree(remote_path, tmp_entry)
+            self.manifest_path(version).unlink(missing_ok=True)
+            if entry.exists():
+                shutil.rmtree(entry)
+            os.replace(tmp_entry, entry)
+            size = self._write_manifest(version)
+            self._record(version, 'misses', size=size, fetched=size)
+
+        self.evict(keep=version)
+        return entry
+
+    def _write_manifest(self, version):
+        files = build_manifest(self.entry_path(version), with_hash=self.verify_hash)
+        tmp_path = self.manifest_path(version).with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump({'version': version, 'created': time.time(), 'files': files}, fp, indent=4)
+        os.replace(tmp_path, self.manifest_path(version))
+        return sum(f['size'] for f in files.values())
+
+    def evict(self, keep=None):
+        ''' remove least recently used entries until the cache fits in max_bytes '''
+        if not self.max_bytes:
+            return []
+        entries = self._update_index(lambda index: dict(index['entries']))
+        total = sum(e.get('size', 0) for e in entries.values())
+        evicted = []
+        for version, info in sorted(entries.items(), key=lambda e: e[1].get('last_used', 0)):
+            if total <= self.max_bytes:
+                break
+            if version == keep:
+                continue
+            lock = self.lock(version)
+            # skip entries that are being fetched right now
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                # and entries in use (checked under the version lock: a fetch after a new lease waits for it)
+                if self.is_leased(version):
+                    logging.info(f'artifact cache: {version} is in use, not evicted')
+                    continue
+                logging.info(f'artifact cache evict : {version}')
+                self.manifest_path(version).unlink(missing_ok=True)
+                shutil.rmtree(self.entry_path(version), onexc=lambda func, path, exc: logging.warning(f'artifact cache: unable to remove {path} ({exc})'))
+            finally:
+                lock.release()
+            total -= info.get('size', 0)
+            evicted.append(version)
+
+        def update(index):
+            for version in evicted:
+                index['entries'].pop(version, None)
+                index['metrics']['evictions'] += 1
+        if evicted:
+            self._update_index(update)
+        return evicted
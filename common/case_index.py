@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import hashlib
+import fnmatch
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import logging
+
+
+# sidecar index files are kept on the local disk, not next to the (network) case directory
+CASE_INDEX_DIR = os.getenv('CASE_INDEX_DIR', os.path.join(tempfile.gettempdir(), 'case_index'))
+
+INDEX_VERSION = 1
+STREAM_SUFFIX = '.1'
+RECORDING_VERSION_FILE = 'recording_version.txt'
+
+
+def read_wsm_version(filename):
+    ''' parse the WSM version out of a recording_version.txt file '''
+    with open(filename, 'r') as f:
+        for line in f:
+            m = re.findall('WSM Version: (.*)\n', line)
+            if m:
+                return m[0]
+    return None
+
+
+class CaseIndex():
+    '''
+    Index of a case directory built in a single os.scandir walk:
+    stream files (name, size, mtime), recording_version.txt files and the parsed WSM version.
+    The index is cached in memory and in a sidecar JSON file in CASE_INDEX_DIR, and is
+    rebuilt when the mtime of any indexed directory changes (entries added / removed / renamed).
+    '''
+    # in-memory indexes of this process, least recently used ones are dropped above max_cached
+    _cache = OrderedDict()
+    max_cached = 64
+    # _lock only guards _cache / _key_locks; a walk holds the lock of its own case only
+    _lock = threading.Lock()
+    _key_locks = {}
+
+    def __init__(self, caseDir, cache_dir=None):
+        self.caseDir = os.path.abspath(str(caseDir))
+        self.cache_dir = Path(cache_dir or CASE_INDEX_DIR)
+        self.dirs = {}
+        self.streams = {}
+        self.recording_versions = {}
+        self.wsm_version = None
+        self.recording_version_file = None
+        self.checked_at = 0
+
+    @classmethod
+    def get(cls, caseDir, cache_dir=None, max_age=30):
+        '''
+        Index of caseDir: from memory, else from the sidecar file, else a fresh walk.
+        An index younger than max_age seconds is returned without re-checking directory mtimes.
+        A stale index is replaced by a new one (built outside the class lock, one walk per case at a time);
+        threads that already hold the old index keep a consistent, if stale, copy.
+        '''
+        key = (os.path.abspath(str(caseDir)), str(cache_dir))
+        with cls._lock:
+            index = cls._cache.get(key)
+            if index is not None:
+                cls._cache.move_to_end(key)
+            key_lock = cls._key_locks.setdefault(key, threading.Lock())
+        if index is not None and (time.monotonic() - index.checked_at <= max_age or index.is_valid()):
+            return index
+
+        with key_lock:
+            with cls._lock:
+                current = cls._cache.get(key)
+            if current is not None and current is not index:
+                # built by another thread while this one waited
+                return current
+            fresh = cls(caseDir, cache_dir)
+            if not fresh.load():
+                fresh.build()
+            with cls._lock:
+                cls._cache[key] = fresh
+                cls._cache.move_to_end(key)
+                while len(cls._cache) > cls.max_cached:
+                    evicted, _ = cls._cache.popitem(last=False)
+                    cls._key_locks.pop(evicted, None)
+            return fresh
+
+    @property
+    def sidecar_path(self):
+        return self.cache_dir.joinpath(hashlib.sha1(self.caseDir.lower().encode()).hexdigest() + '.json')
+
+    def build(self):
+        ''' walk the case directory once and save the sidecar index '''
+        t0 = time.perf_counter()
+        self.dirs, self.streams, self.recording_versions = {}, {}, {}
+        stack = [self.caseDir]
+        while stack:
+            dir_path = stack.pop()
+            rel_dir = os.path.relpath(dir_path, self.caseDir)
+            try:
+                self.dirs[rel_dir] = os.stat(dir_path).st_mtime_ns
+                entries = sorted(os.scandir(dir_path), key=lambda e: e.name)
+            except OSError as e:
+                logging.warning(f'case_index: unable to scan {dir_path} ({e})')
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(STREAM_SUFFIX):
+                    st = entry.stat()
+                    self.streams[os.path.relpath(entry.path, self.caseDir)] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+                elif entry.name == RECORDING_VERSION_FILE:
+                    self.recording_versions[os.path.relpath(entry.path, self.caseDir)] = read_wsm_version(entry.path)
+
+        self.select_version()
+        self.checked_at = time.monotonic()
+        logging.info(f'case_index: indexed {self.caseDir} ({len(self.dirs)} dirs, {len(self.streams)} streams) in {time.perf_counter() - t0:.2f} sec')
+        self.save()
+        return self
+
+    def select_version(self):
+        ''' the first recording_version.txt holding a WSM version sets the case version '''
+        self.wsm_version, self.recording_version_file = None, None
+        for rel_path in sorted(self.recording_versions):
+            if self.recording_versions[rel_path]:
+                self.wsm_version = self.recording_versions[rel_path]
+                self.recording_version_file = os.path.join(self.caseDir, rel_path)
+                break
+
+    def is_valid(self):
+        ''' True if no indexed directory changed since the index was built '''
+        for rel_dir, mtime in self.dirs.items():
+            try:
+                if os.stat(os.path.join(self.caseDir, rel_dir)).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        self.checked_at = time.monotonic()
+        return bool(self.dirs)
+
+    def save(self):
+        data = {'version': INDEX_VERSION, 'caseDir': self.caseDir, 'dirs': self.dirs, 'streams': self.streams,
+                'recording_versions': self.recording_versions}
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.sidecar_path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp)
+            os.replace(tmp_path, self.sidecar_path)
+        except OSError as e:
+            logging.warning(f'case_index: unable to save {self.sidecar_path} ({e})')
+
+    def load(self):
+        ''' load the sidecar index, returns False if it is missing or stale '''
+        try:
+            with open(self.sidecar_path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != INDEX_VERSION or data.get('caseDir') != self.caseDir:
+            return False
+        self.dirs, self.streams = data['dirs'], data['streams']
+        self.recording_versions = data['recording_versions']
+        self.select_version()
+        return self.is_valid()
+
+    def find_streams(self, stream_label):
+        ''' full paths of the '<stream_label>*.1' files, same matching as Path.rglob(stream_label + '*.1') '''
+        pattern = stream_label + '*' + STREAM_SUFFIX
+        return [os.path.join(self.caseDir, rel_path) for rel_path in sorted(self.streams)
+                if fnmatch.fnmatch(os.path.basename(rel_path), pattern)]
+
+    def stream_info(self, stream_path):
+        ''' size / mtime of an indexed stream file (with or without the .1 suffix) '''
+        rel_path = os.path.relpath(str(stream_path), self.caseDir)
+        if not rel_path.endswith(STREAM_SUFFIX):
+            rel_path += STREAM_SUFFIX
+        return self.streams.get(rel_path)
+
+    def __repr__(self):
+        return f'CaseIndex({self.caseDir}, streams={len(self.streams)}, wsm_version={self.wsm_version})'
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def peak_rss_bytes():
+    ''' peak resident set size of the current process in bytes (None if unavailable) '''
+    if sys.platform == 'win32':
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                            ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                            ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return counters.PeakWorkingSetSize
+        except (OSError, AttributeError):
+            pass
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageRecord():
+    ''' counters of a single stage run, filled in by the code inside Instrumentation.stage() '''
+
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+
+
+class Instrumentation():
+    '''
+    Per stage wall time, records/sec, bytes written and peak RSS of a pipeline (PyDli, PHT_runner).
+    Stages are timed with the stage() context manager or the instrumented() method decorator and
+    accumulate over repeated calls. as_dict() goes into the task meta, to_prometheus() / to_json()
+    export the same numbers.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        rec = StageRecord()
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            self.add(name, time.perf_counter() - t0, records=rec.records, bytes=rec.bytes)
+
+    def add(self, name, wall_sec, records=0, bytes=0):
+        with self.lock:
+            st = self.stages.setdefault(name, {'calls': 0, 'wall_sec': 0.0, 'records': 0, 'bytes': 0})
+            st['calls'] += 1
+            st['wall_sec'] += wall_sec
+            st['records'] += records or 0
+            st['bytes'] += bytes or 0
+            st['peak_rss_bytes'] = peak_rss_bytes()
+
+    def as_dict(self):
+        with self.lock:
+            out = {}
+            for name, st in self.stages.items():
+                st = dict(st, wall_sec=round(st['wall_sec'], 6))
+                if st['wall_sec'] > 0:
+                    st['records_per_sec'] = round(st['records'] / st['wall_sec'], 3)
+                    st['bytes_per_sec'] = round(st['bytes'] / st['wall_sec'], 3)
+                out[name] = st
+            return out
+
+    def to_json(self):
+        return json.dumps({'pipeline': self.name, 'pid': os.getpid(), 'stages': self.as_dict()}, indent=4)
+
+    def to_prometheus(self, prefix='case_processor'):
+        ''' Prometheus text exposition format, one sample per stage and counter '''
+        metrics = [('calls', 'counter', 'calls of the stage'),
+                   ('wall_sec', 'counter', 'wall time spent in the stage [sec]'),
+                   ('records', 'counter', 'records processed by the stage'),
+                   ('bytes', 'counter', 'bytes written by the stage'),
+                   ('peak_rss_bytes', 'gauge', 'peak resident set size of the process [bytes]')]
+        stages = self.as_dict()
+        lines = []
+        for key, kind, help_text in metrics:
+            metric = f'{prefix}_stage_{key}'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for name, st in stages.items():
+                if st.get(key) is not None:
+                    lines.append(f'{metric}{{pipeline="{self.name}",stage="{name}"}} {st[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        ''' write the metrics as Prometheus text (.prom / .txt) or JSON (any other suffix) '''
+        filename = Path(filename)
+        text = self.to_prometheus() if filename.suffix in ('.prom', '.txt') else self.to_json()
+        with open(filename, 'w') as fp:
+            fp.write(text)
+        return filename
+
+
+def instrumented(stage_name, count_records=False):
+    '''
+    Method decorator: time the method as stage_name in self.metrics (an Instrumentation).
+    With count_records the length of the returned value is recorded as the stage's records.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            metrics = getattr(self, 'metrics', None)
+            if metrics is None:
+                return func(self, *args, **kwargs)
+            with metrics.stage(stage_name) as rec:
+                result = func(self, *args, **kwargs)
+                if count_records:
+                    try:
+                        rec.records = len(result)
+                    except TypeError:
+                        pass
+                return result
+        return wrapper
+    return decorator
@@ -0,0 +1,76 @@
+import os
+import time
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+class FileLock():
+    '''
+    Inter-process exclusive lock on a lock file (msvcrt on Windows, flock elsewhere).
+    Args:
+        path (str): lock file, created if missing.
+        timeout (float): seconds to wait in acquire(), None waits forever.
+        poll (float): seconds between attempts.
+    '''
+
+    def __init__(self, path, timeout=None, poll=0.1):
+        self.path = str(path)
+        self.timeout = timeout
+        self.poll = poll
+        self.fd = None
+
+    def _try_lock(self):
+        try:
+            if msvcrt:
+                msvcrt.locking(self.fd, msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, blocking=True):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self._try_lock():
+            if not blocking or (deadline is not None and time.monotonic() > deadline):
+                os.close(self.fd)
+                self.fd = None
+                if not blocking:
+                    return False
+                raise LockTimeout(f'timeout waiting for lock {self.path}')
+            time.sleep(self.poll)
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            if msvcrt:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,114 @@
+'''
+Queues and task routing of the Celery app.
+
+- light: short tasks (add, echo) - threads, never behind long jobs
+- io:    copy / subprocess / waiting work (PHT runs and batches, orchestrators of parallel reads) - threads
+- parse: CPU-bound DLI parsing of small and medium reads and of dli_read_block parts - prefork
+- heavy: large DLI reads (estimated from the requested range) - prefork, few slots, no prefetch
+
+Every queue is consumed by its own worker (see run_all.bat / run_celery_worker.bat), so a heavy job can
+only saturate its own slots. Within a queue cheaper jobs get a better priority (redis: 0 is served first).
+'''
+import os
+from kombu import Queue
+
+
+LIGHT, IO, PARSE, HEAVY = 'light', 'io', 'parse', 'heavy'
+QUEUES = (LIGHT, IO, PARSE, HEAVY)
+
+# timestamps x streams of a dli_read above which it goes to the heavy queue
+HEAVY_TS_SPAN = int(os.getenv('ROUTING_HEAVY_TS_SPAN', 20_000_000))
+# input bytes (params['input_bytes'], when the client knows it) above which a dli_read is heavy
+HEAVY_INPUT_BYTES = int(os.getenv('ROUTING_HEAVY_INPUT_BYTES', 2 * 1024**3))
+PRIORITY_STEPS = 10
+# seconds before the broker redelivers an unacknowledged (acks_late) task
+VISIBILITY_TIMEOUT = int(os.getenv('BROKER_VISIBILITY_TIMEOUT', 12 * 3600))
+
+# fixed queue (and priority) of the tasks whose cost does not depend on their input
+TASK_ROUTES = {
+    'tasks.add': {'queue': LIGHT, 'priority': 0},
+    'tasks.genric_task': {'queue': LIGHT, 'priority': 0},
+    'tasks.pht_run': {'queue': IO, 'priority': 4},
+    'tasks.pht_batch': {'queue': IO, 'priority': 6},
+    'tasks.dli_read_block': {'queue': PARSE, 'priority': 2},
+}
+
+# per task limits, applied by every worker (rate_limit is per worker instance)
+TASK_ANNOTATIONS = {
+    'tasks.pht_run': {'rate_limit': os.getenv('ROUTING_PHT_RATE_LIMIT', '12/m')},
+    'tasks.pht_batch': {'rate_limit': os.getenv('ROUTING_PHT_BATCH_RATE_LIMIT', '2/m')},
+    'tasks.dli_read': {'rate_limit': os.getenv('ROUTING_DLI_RATE_LIMIT')},
+}
+
+
+def estimate_cost(params):
+    '''
+    Estimated cost of a dli_read: requested timestamps x number of streams (None when the whole
+    stream is read and the range is unknown before the case is opened).
+    A stride does not lower it: every block of the range is still read.
+    '''
+    ts_range = params.get('tsRange')
+    if not ts_range:
+        return None
+    stream_label = params.get('stream_label')
+    num_of_streams = len(stream_label) if isinstance(stream_label, list) else 1
+    if stream_label == 'all':
+        return None
+    span = max(int(ts_range[1]) - int(ts_range[0]), 0)
+    return span * num_of_streams
+
+
+def cost_priority(cost, limit):
+    ''' 0 (cheapest) .. PRIORITY_STEPS - 1 (at or above limit) '''
+    if cost is None:
+        return PRIORITY_STEPS - 1
+    return min(PRIORITY_STEPS - 1, int(cost * (PRIORITY_STEPS - 1) / max(limit, 1)))
+
+
+def route_dli_read(params):
+    '''
+    Route of a dli_read from its params.
+    - parallel reads (cluster parts / local process pool) and process-mode multi-stream reads mostly wait
+      on other processes: io (their parsing runs in dli_read_block tasks or in the dli_pool processes)
+    - params['queue'] forces a queue
+    - otherwise parse or heavy by the estimated cost (input_bytes or tsRange x streams; an unbounded range is heavy)
+    '''
+    if params.get('queue') in QUEUES:
+        return {'queue': params['queue'], 'priority': 5}
+    multi_stream = isinstance(params.get('stream_label'), list) or params.get('stream_label') == 'all'
+    if params.get('parallel') in ('cluster', 'local') or (multi_stream and params.get('stream_mode') == 'process'):
+        return {'queue': IO, 'priority': 5}
+    if params.get('input_bytes'):
+        cost, limit = int(params['input_bytes']), HEAVY_INPUT_BYTES
+    else:
+        cost, limit = estimate_cost(params), HEAVY_TS_SPAN
+    if cost is None or cost >= limit:
+        return {'queue': HEAVY, 'priority': cost_priority(cost, limit * 10)}
+    return {'queue': PARSE, 'priority': cost_priority(cost, limit)}
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    ''' Celery router (task_routes): fixed routes of TASK_ROUTES, estimated-cost routing of dli_read '''
+    if name == 'tasks.dli_read':
+        params = (args[0] if args else kwargs.get('params')) or {}
+        return route_dli_read(params)
+    return TASK_ROUTES.get(name)
+
+
+def routing_config():
+    ''' Celery settings of the queues and routes (merged into app.conf) '''
+    return dict(
+        task_queues=[Queue(name, routing_key=name, queue_arguments={'x-max-priority': PRIORITY_STEPS})
+                     for name in QUEUES],
+        task_default_queue=LIGHT,
+        task_routes=(route_task,),
+        task_annotations={name: {k: v for k, v in limits.items() if v}
+                          for name, limits in TASK_ANNOTATIONS.items()},
+        task_default_priority=5,
+        # redis emulates priorities with one list per step, served in priority order.
+        # Unacknowledged acks_late tasks (dli_read) are redelivered after visibility_timeout, which must exceed the longest read
+        broker_transport_options={'priority_steps': list(range(PRIORITY_STEPS)), 'sep': ':',
+                                  'queue_order_strategy': 'priority',
+                                  'visibility_timeout': VISIBILITY_TIMEOUT},
+        task_track_started=True,
+    )
@@ -0,0 +1,180 @@
+'''
+Compact result transport for the Celery app.
+
+- results are serialized with msgpack (JSON if it is not installed) and zlib-compressed by a
+  serializer registered with kombu, so the result backend stores the compressed bytes
+  (see result_transport_config)
+- results larger than CLAIM_CHECK_BYTES are written to a shared store (RESULT_STORE_DIR) and
+  only a small claim-check reference goes through Redis; stored payloads older than
+  RESULT_STORE_TTL are removed by the workers
+- AsyncResult.get() of TransportCelery apps dereferences claim-checks transparently
+'''
+import os
+import json
+import zlib
+import time
+import uuid
+import hashlib
+import threading
+from pathlib import Path
+import logging
+from celery import Celery, Task
+from celery.result import AsyncResult
+from kombu.serialization import register
+from kombu.utils.objects import cached_property
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# shared directory (network share / local object store mount) visible to the workers and the clients
+RESULT_STORE_DIR = os.getenv('RESULT_STORE_DIR')
+CLAIM_CHECK_BYTES = int(os.getenv('RESULT_CLAIM_CHECK_BYTES', 256 * 1024))
+CLAIM_CHECK_KEY = '__claim_check__'
+# stored payloads are kept as long as Celery keeps the results referencing them (result_expires, default 1 day)
+RESULT_STORE_TTL = float(os.getenv('RESULT_STORE_TTL', 24 * 3600))
+PURGE_INTERVAL = 3600
+COMPRESS_LEVEL = 6
+
+ZLIB_MSGPACK, ZLIB_JSON = 'zlib-msgpack', 'zlib-json'
+
+
+def zlib_msgpack_dumps(obj):
+    return zlib.compress(msgpack.packb(obj, use_bin_type=True), COMPRESS_LEVEL)
+
+
+def zlib_msgpack_loads(data):
+    # results may have int keys (e.g. per block dicts), msgpack rejects them by default
+    return msgpack.unpackb(zlib.decompress(data), raw=False, strict_map_key=False)
+
+
+def zlib_json_dumps(obj):
+    return zlib.compress(json.dumps(obj).encode(), COMPRESS_LEVEL)
+
+
+def zlib_json_loads(data):
+    return json.loads(zlib.decompress(data))
+
+
+register(ZLIB_JSON, zlib_json_dumps, zlib_json_loads,
+         content_type='application/x-zlib-json', content_encoding='binary')
+if msgpack:
+    register(ZLIB_MSGPACK, zlib_msgpack_dumps, zlib_msgpack_loads,
+             content_type='application/x-zlib-msgpack', content_encoding='binary')
+RESULT_SERIALIZER = ZLIB_MSGPACK if msgpack else ZLIB_JSON
+
+
+def result_transport_config():
+    ''' Celery settings of the result transport (merged into app.conf) '''
+    return dict(
+        result_serializer=RESULT_SERIALIZER,
+        result_accept_content=['json', ZLIB_JSON] + ([ZLIB_MSGPACK] if msgpack else []),
+    )
+
+
+def is_claim_check(value):
+    return isinstance(value, dict) and CLAIM_CHECK_KEY in value
+
+
+def store_payload(payload, store_dir=None, name=None):
+    ''' write payload (zlib-compressed JSON) to the store, returns its claim-check reference '''
+    store_dir = Path(store_dir or RESULT_STORE_DIR)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    data = zlib_json_dumps(payload)
+    path = store_dir.joinpath(f'{name or uuid.uuid4().hex}.json.z')
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+    return {CLAIM_CHECK_KEY: str(path), 'size': len(data), 'sha1': hashlib.sha1(data).hexdigest()}
+
+
+def load_payload(reference, delete=False):
+    ''' read a payload back from its claim-check reference '''
+    path = Path(reference[CLAIM_CHECK_KEY])
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if hashlib.sha1(data).hexdigest() != reference['sha1']:
+        raise ValueError(f'claim-check payload {path} is corrupted')
+    if delete:
+        path.unlink(missing_ok=True)
+    return zlib_json_loads(data)
+
+
+_last_purge = {}
+_purge_lock = threading.Lock()
+
+
+def purge_store(store_dir=None, max_age=None, force=False):
+    '''
+    remove payloads (and leftover temporary files) older than max_age (default RESULT_STORE_TTL) from the store,
+    at most once per PURGE_INTERVAL and process unless force. Returns the number of removed files.
+    '''
+    store_dir = Path(store_dir or RESULT_STORE_DIR)
+    max_age = RESULT_STORE_TTL if max_age is None else max_age
+    now = time.time()
+    with _purge_lock:
+        if not force and now - _last_purge.get(str(store_dir), 0) < PURGE_INTERVAL:
+            return 0
+        _last_purge[str(store_dir)] = now
+    removed = 0
+    for path in store_dir.glob('*'):
+        try:
+            if path.is_file() and now - path.stat().st_mtime > max_age:
+                path.unlink()
+                removed += 1
+        except OSError:
+            pass
+    if removed:
+        logging.info(f'result store: removed {removed} payloads older than {max_age} sec from {store_dir}')
+    return removed
+
+
+def offload(result, name=None, threshold=None, store_dir=None):
+    ''' replace a large result by a claim-check reference (no-op without a store or for small results) '''
+    store_dir = store_dir or RESULT_STORE_DIR
+    threshold = CLAIM_CHECK_BYTES if threshold is None else threshold
+    if not store_dir or result is None or isinstance(result, (bool, int, float)):
+        return result
+    try:
+        size = len(json.dumps(result))
+    except (TypeError, ValueError):
+        return result
+    if size <= threshold:
+        return result
+    purge_store(store_dir)
+    reference = store_payload(result, store_dir, name=name)
+    logging.info(f'result of {name} ({size} bytes) offloaded to {reference[CLAIM_CHECK_KEY]}')
+    return reference
+
+
+def resolve(value):
+    ''' dereference a claim-check, any other value is returned as is '''
+    if is_claim_check(value):
+        return load_payload(value)
+    return value
+
+
+class ClaimCheckTask(Task):
+    ''' task base class: results above CLAIM_CHECK_BYTES are offloaded to the shared store '''
+
+    def __call__(self, *args, **kwargs):
+        result = super().__call__(*args, **kwargs)
+        return offload(result, name=self.request.id)
+
+
+class ClaimCheckResult(AsyncResult):
+    ''' AsyncResult whose get() dereferences claim-checks '''
+
+    def get(self, *args, **kwargs):
+        return resolve(super().get(*args, **kwargs))
+
+
+class TransportCelery(Celery):
+    ''' Celery app with claim-check tasks and results '''
+    task_cls = 'common.transport:ClaimCheckTask'
+
+    @cached_property
+    def AsyncResult(self):
+        return self.subclass_with_self(ClaimCheckResult)
@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import threading
+import configparser
+from collections import OrderedDict
+import logging
+
+
+class WarmRegistry():
+    '''
+    Per process registry of objects that are expensive to build and can be reused by later tasks
+    (loaded DLI assemblies per version, parsed config / json files, fetched tester paths).
+    Least recently used entries are evicted above max_entries. An entry is built once even when
+    several threads ask for it at the same time, and is rebuilt when validate(value) turns False.
+    Args:
+        max_entries (int): entries kept in the registry.
+    '''
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kind, key, factory, validate=None):
+        ''' the (kind, key) entry, built with factory() if missing or no longer valid '''
+        entry_key = (kind, key)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(entry_key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                found = entry_key in self.entries
+                value = self.entries.get(entry_key)
+                if found:
+                    self.entries.move_to_end(entry_key)
+            if found and (validate is None or validate(value)):
+                self.hits += 1
+                return value
+            self.misses += 1
+            value = factory()
+            with self.lock:
+                self.entries[entry_key] = value
+                self.entries.move_to_end(entry_key)
+                while len(self.entries) > self.max_entries:
+                    evicted, _ = self.entries.popitem(last=False)
+                    self.key_locks.pop(evicted, None)
+                    self.evictions += 1
+                    logging.debug(f'warm state: evicted {evicted}')
+            return value
+
+    def discard(self, kind, key):
+        with self.lock:
+            self.entries.pop((kind, key), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def config(self, path):
+        ''' parsed ini file, re-read when its mtime changes (treat as read-only) '''
+        path = str(path)
+
+        def load():
+            config = configparser.ConfigParser()
+            config.read(path)
+            return config
+        return self.get('config', (path, _mtime(path)), load)
+
+    def json_file(self, path):
+        ''' parsed json file, re-read when its mtime changes (treat as read-only) '''
+        path = str(path)
+
+        def load():
+            with open(path, 'r') as fp:
+                return json.load(fp)
+        return self.get('json', (path, _mtime(path)), load)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'kinds': sorted({kind for kind, key in self.entries})}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+_registry = None
+_registry_lock = threading.Lock()
+_log_files = set()
+
+
+def get_registry():
+    ''' the registry of the current process (created on first use) '''
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = WarmRegistry(int(os.getenv('WARM_STATE_MAX_ENTRIES', 64)))
+    return _registry
+
+
+def init_worker(max_entries=None):
+    ''' fresh registry for a new worker process (celery worker_process_init) '''
+    global _registry
+    _registry = WarmRegistry(max_entries or int(os.getenv('WARM_STATE_MAX_ENTRIES', 64)))
+    logging.info(f'warm state: registry of {_registry.max_entries} entries for worker {os.getpid()}')
+    return _registry
+
+
+def setup_logging(log_file):
+    ''' logging.basicConfig to log_file, once per process '''
+    log_file = str(log_file)
+    if log_file in _log_files:
+        return False
+    _log_files.add(log_file)
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.DEBUG,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    return True
+
+
+def add_sys_path(path):
+    ''' append path to sys.path unless it is already there '''
+    path = str(path)
+    if path not in sys.path:
+        sys.path.append(path)
+        return True
+    return False
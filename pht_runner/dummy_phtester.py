@@ -0,0 +1,44 @@
+"""
+Stand-in for PositionHandlerTester.bat, to exercise the PHT supervisor / pipeline without the tester:
+prints progress lines on stdout (and a few on stderr), optionally holds memory, writes a fake trace
+into the output directory and exits with the given code.
+
+Usage:
+    python -m pht_runner.dummy_phtester <incoming_case_path> <output_path> [--lines 20] [--delay 0.1]
+                                        [--memory-mb 0] [--exit-code 0]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('incoming_case_path')
+    parser.add_argument('output_path')
+    parser.add_argument('--lines', type=int, default=20, help='progress lines to print')
+    parser.add_argument('--delay', type=float, default=0.1, help='seconds between lines')
+    parser.add_argument('--memory-mb', type=int, default=0, help='memory to hold while running')
+    parser.add_argument('--exit-code', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    ballast = bytearray(args.memory_mb * 2**20)
+    for i in range(len(ballast) // 4096):
+        ballast[i * 4096] = 1
+    for i in range(args.lines):
+        print(f'processing {args.incoming_case_path}: {100 * (i + 1) // args.lines}%', flush=True)
+        if i % 10 == 9:
+            print(f'warning: dummy warning {i}', file=sys.stderr, flush=True)
+        time.sleep(args.delay)
+
+    # same layout PHT_runner.copy_result looks for: <output>/<label>/<run>/tracettalgupdate2.1
+    trace = Path(args.output_path).joinpath(Path(args.incoming_case_path).name, 'run', 'tracettalgupdate2.1')
+    trace.parent.mkdir(parents=True, exist_ok=True)
+    trace.write_bytes(b'\0' * 1024)
+    print('done', flush=True)
+    return args.exit_code
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
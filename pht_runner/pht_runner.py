@@ -3,34 +3,56 @@ import re
 import json
 import subprocess as sp
 import os, sys
+import shlex
 import shutil
 from datetime import datetime
 import configparser
 import logging
 import xml.etree.ElementTree as ET
+from common.case_index import CaseIndex
+from common.artifact_cache import ArtifactCache
+from pht_runner.sync import sync_tree
+from pht_runner.supervisor import ProcessSupervisor, SlotPool
+from common.instrumentation import Instrumentation, instrumented
+from common import warm_state
+
+TESTER_SCRIPT = 'PositionHandlerTester.bat'
+
+
+# Command line of the tester: template (str or list, e.g. '{python} -m pht_runner.dummy_phtester {incoming} {output}') 
+# with the {tester_dir}, {incoming}, {output} and {python} placeholders, <tester_dir>/PositionHandlerTester.bat if empty.
+def tester_command(template, tester_dir, incoming, output): 
+    if not template: 
+        return [str(Path(tester_dir).joinpath(TESTER_SCRIPT)), str(incoming), str(output)]
+    if isinstance(template, str): 
+        template = shlex.split(template, posix=sys.platform != 'win32')
+    values = {'tester_dir': str(tester_dir), 'incoming': str(incoming), 'output': str(output), 'python': sys.executable}
+    return [arg.format(**values) for arg in template]
+
 
 # This class handles the operations related to the PositionHandlerTester (PHT) tool.
 class PHT_runner(): 
             
 
     # Initializes the PHT_runner class with the required parameters and sets up logging.
-    def __init__(self, dataDir:str, label:str = "case1",enable_traces=[], exclude_dirs=[]) -> None:
+    def __init__(self, dataDir:str, label:str = "case1",enable_traces=[], exclude_dirs=[], remote_output_path='', 
+                 phtester_command=None) -> None:
         self.module_dir = Path(__file__).parent
-        self.config = configparser.ConfigParser()
-        self.config.read(self.module_dir.joinpath('config.ini'))
+        self.config = warm_state.get_registry().config(self.module_dir.joinpath('config.ini'))
         self.dataDir = dataDir
         self.label = label
         self.enable_traces = enable_traces
         self.exclude_dirs = exclude_dirs
+        # copy_result destination, <phtester_results_path>/<label> if empty (never inside the source recordings)
+        self.pht_remote_output_path = remote_output_path
+        # tester command template (see tester_command), phtester_command of config.ini if None
+        self.phtester_command = phtester_command
+        self.metrics = Instrumentation('pht_runner')
 
         """Set up logging to an external file in the same directory."""
         log_file_path = os.path.join(self.module_dir, 'pht_runner.log')
-        logging.basicConfig(
-            filename=log_file_path,
-            level=logging.DEBUG,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
-        logging.info("Logging initialized for pht_runner class")
+        if warm_state.setup_logging(log_file_path): 
+            logging.info("Logging initialized for pht_runner class")
 
         
 
@@ -38,61 +60,55 @@ class PHT_runner():
     # Searches for the CARTO version in the recordings directory and sets caseDir and cartoVersion.
     def readCartoVersion(self): 
         logging.info('searching for CARTO version...')
-        recordingsFile = Path(self.dataDir).rglob('**/recording_version.txt')
-        for recFile in recordingsFile: 
+        index = CaseIndex.get(self.dataDir)
+        if index.recording_version_file: 
+            recFile = Path(index.recording_version_file)
             logging.info(f'found recording_version in : {recFile}')
-            with open(recFile, 'r') as f: 
-                for line in f: 
-                    m = re.findall('WSM Version: (.*)\n',line)
-                    if m: 
-                        self.caseDir = recFile.parent
-                        self.cartoVersion = m[0]
-                        logging.info(f'caseDir: {self.caseDir}')
-                        logging.info(f'cartoVersion: {self.cartoVersion}')
-                        return True
+            self.caseDir = recFile.parent
+            self.cartoVersion = index.wsm_version
+            logging.info(f'caseDir: {self.caseDir}')
+            logging.info(f'cartoVersion: {self.cartoVersion}')
+            return True
         return False   
     
-    # Copies the corresponding PHTester version from the remote repository to the local directory.
+    # Copies the corresponding PHTester version from the remote repository to the local directory (shared, size bounded cache).
+    @instrumented('copy_phtester')
     def copy_phtester(self):
 
         self.local_pht_path = Path(self.config['DEFAULT']['local_phtester_path']).joinpath(self.cartoVersion)
         self.remote_pht_path = Path(self.config['DEFAULT']['phtester_repository_path']).joinpath(self.cartoVersion)
         logging.info(f"search for corecponding phtester version in {self.remote_pht_path}")
         
-        if not self.remote_pht_path.exists() : 
+        max_gb = self.config['DEFAULT'].getfloat('phtester_cache_max_gb', 0)
+        cache = ArtifactCache(self.config['DEFAULT']['local_phtester_path'], max_bytes=int(max_gb * 2**30) or None)
+        self.phtester_cache = cache
+        try: 
+            # fetched (and verified) once per process and version, later cases reuse the local path
+            self.local_pht_path = warm_state.get_registry().get(
+                'phtester', self.cartoVersion, lambda: cache.fetch(self.cartoVersion, self.remote_pht_path), 
+                validate=lambda path: Path(path).exists())
+        except FileNotFoundError: 
             logging.error(f'unable to find... ({self.remote_pht_path})')
-        if not self.local_pht_path.exists() : 
-            try: 
-                logging.info(f"copy phtester from remote repository to local ")
-                shutil.copytree(self.remote_pht_path, self.local_pht_path  )
-            except FileExistsError: 
-                logging.info(f'local phtester already exists! ({self.cartoVersion})')
-        else: 
-            logging.info(f'local phtester already exists! ({self.cartoVersion})')
+            raise
     
-    # Copies recordings from the case directory to the incoming temporary directory.
-    def copy_recordings(self):
+    # Syncs recordings from the case directory to the incoming temporary directory: only new / changed files are copied, 
+    # concurrently and through temporary names, so a partial or stale copy from an earlier run is completed instead of reused.
+    def copy_recordings(self, progress=None):
         self.incoming_case_path = Path(self.config['DEFAULT']['local_phtester_incoming_temp']).joinpath(self.label)
         
-        logging.info('check if case label exist in incoming temp dir...')
-        if self.incoming_case_path.exists(): 
-            logging.info(f'case : {self.incoming_case_path} already exist, skip copying...')
-            return True 
-
-        logging.info(f'create new directory : {self.incoming_case_path}')
-        os.makedirs(self.incoming_case_path)
-        
-
-        for f in Path(self.caseDir).iterdir(): 
-            if f.is_dir(): 
-                if f.parts[-1] not in self.exclude_dirs: 
-                    print(f)
-                    shutil.copytree(f, Path(self.incoming_case_path).joinpath(f.name), ignore=shutil.ignore_patterns('*$RECYCLE.BIN*'))
-            else: 
-                print(f)
-                shutil.copy(f, self.incoming_case_path)
+        logging.info(f'sync recordings to : {self.incoming_case_path}')
+        with self.metrics.stage('copy_recordings') as rec: 
+            stats = sync_tree(self.caseDir, self.incoming_case_path, 
+                              exclude_dirs=self.exclude_dirs or [], 
+                              max_workers=self.config['DEFAULT'].getint('copy_workers', 8), 
+                              use_hash=self.config['DEFAULT'].getboolean('copy_verify_hash', False), 
+                              progress=progress)
+            rec.records, rec.bytes = stats['files_copied'], stats['bytes_copied']
+        logging.info(f"copied {stats['files_copied']} files ({stats['bytes_copied']} bytes), skipped {stats['files_skipped']} up to date files")
+        return stats
 
     # Updates the trace configuration XML file to enable or disable specific traces.
+    @instrumented('update_trace_config')
     def update_trace_config(self):
         
         self.enable_traces.append('TraceVersion')
@@ -117,24 +133,44 @@ class PHT_runner():
         logging.info('rewrite xml : {xml_filename}')
         return True
     
-    # Executes the PHTester tool using the provided batch file and paths.
-    def run_phtester(self): 
+    # Executes the PHTester tool using the provided batch file and paths. 
+    # The tester runs under a ProcessSupervisor (output streamed line by line to <phtester_log_dir>/<label>.log, wall-clock and 
+    # memory limits) in one of the node's phtester_slots, so several cases can run side by side in their own incoming / output dirs.
+    @instrumented('run_phtester')
+    def run_phtester(self, progress=None, waiting=None): 
         self.pht_local_output_path = Path(self.config['DEFAULT']['local_phtester_output_temp']).joinpath(self.label)
-        cmdStr=r'"{0}" "{1}" "{2}"'.format(str(self.local_pht_path.joinpath('PositionHandlerTester.bat')), 
-                                   self.incoming_case_path, 
-                                   self.pht_local_output_path)
-
-        logging.info(f'Run : {cmdStr}')
-        result = sp.run(cmdStr, stdout=sp.PIPE)
-        return result.stdout.strip().decode("utf-8") 
+        cfg = self.config['DEFAULT']
+        cmd = tester_command(self.phtester_command or cfg.get('phtester_command', ''), 
+                             self.local_pht_path, self.incoming_case_path, self.pht_local_output_path)
+        
+        log_dir = Path(cfg.get('phtester_log_dir', '') or Path(cfg['local_phtester_output_temp']).joinpath('logs'))
+        supervisor = ProcessSupervisor(cmd, 
+                                       log_file=log_dir.joinpath(f'{self.label}.log'), 
+                                       timeout=cfg.getfloat('phtester_timeout_sec', 0) or None, 
+                                       max_memory_bytes=int(cfg.getfloat('phtester_max_memory_gb', 0) * 2**30) or None, 
+                                       progress=progress)
+        slots = SlotPool(cfg.getint('phtester_slots', 2), lock_dir=cfg.get('phtester_slots_dir', '') or None)
+
+        logging.info(f'Run : {cmd}')
+        with slots.hold(waiting=waiting) as slot, self.phtester_cache.lease(self.cartoVersion): 
+            # leased: not evicted while it runs, fetched again if it was evicted since copy_phtester
+            self.phtester_cache.fetch(self.cartoVersion, self.remote_pht_path)
+            logging.info(f'run_phtester: {self.label} in slot {slot}')
+            result = supervisor.run()
+        if result['returncode'] != 0: 
+            logging.error(f"PHTester exit code {result['returncode']}, see {result['log_file']}")
+        return result
     
     # Moves the generated trace results from the local output directory to the remote output directory.
     def copy_result(self): 
         if self.pht_remote_output_path == '' :
-            self.pht_remote_output_path = Path(self.dataDir).joinpath('Traces')
+            results_path = self.config['DEFAULT'].get('phtester_results_path') or \
+                Path(self.config['DEFAULT']['local_phtester_output_temp']).parent.joinpath('results')
+            self.pht_remote_output_path = Path(results_path).joinpath(self.label)
         try: 
             trace_flist = list(self.pht_local_output_path.rglob('tracettalgupdate2.1'))
             print(trace_flist)
+            Path(self.pht_remote_output_path).mkdir(parents=True, exist_ok=True)
             for trace in trace_flist: 
                 print(trace)
                 shutil.move(trace.parent, Path(self.pht_remote_output_path).joinpath(trace.parts[-3]))
@@ -142,9 +178,11 @@ class PHT_runner():
             print(e)
             
     # Cleans up temporary directories created during the PHTester run.
+    # (also after a failed run: the directories of the steps that did not run are not set)
     def cleanup(self): 
-        shutil.rmtree(self.pht_local_output_path, ignore_errors=True)
-        shutil.rmtree(self.incoming_case_path)
+        for path in (getattr(self, 'pht_local_output_path', None), getattr(self, 'incoming_case_path', None)): 
+            if path: 
+                shutil.rmtree(path, ignore_errors=True)
 
 
     # Executes the full workflow of the PHT_runner class, including reading the CARTO version, copying files, updating configurations, and running the PHTester tool.
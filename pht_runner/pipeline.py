@@ -0,0 +1,219 @@
+from pathlib import Path
+import queue
+import threading
+import time
+import logging
+from pht_runner.pht_runner import PHT_runner
+
+
+# end of input marker of a stage queue
+_DONE = object()
+
+
+class Stage():
+    '''
+    One step of a Pipeline.
+    Args:
+        name (str): stage name (summary / progress).
+        func (callable): func(item) - does the stage's work on the item (in place).
+        workers (int): items processed at the same time by this stage.
+        on_failure (callable): on_failure(item) - run instead of func for an item that failed in an earlier
+                               stage (e.g. release what the earlier stages left behind).
+    '''
+
+    def __init__(self, name, func, workers=1, on_failure=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.on_failure = on_failure
+
+
+class PipelineItem():
+    ''' an input item travelling through the stages, with its per stage timing and error '''
+
+    def __init__(self, num, value):
+        self.num = num
+        self.value = value
+        self.state = 'PENDING'
+        self.stage = None
+        self.error = None
+        self.stage_sec = {}
+
+    def as_dict(self):
+        return {'num': self.num, 'state': self.state, 'stage': self.stage, 'error': self.error,
+                'stage_sec': {k: round(v, 3) for k, v in self.stage_sec.items()}}
+
+
+class Pipeline():
+    '''
+    Staged pipeline: every stage has its own worker threads, consecutive stages are connected by
+    bounded queues. While a later stage works on item n, the earlier stages already work on the next
+    items, at most queue_size items ahead (backpressure), so the makespan of a batch approaches the
+    time of its slowest stage instead of the sum of all the stages.
+    An item that fails in a stage is reported and skips the remaining stages (only their on_failure runs);
+    the other items continue.
+    Args:
+        stages (list): Stage objects, in order.
+        queue_size (int): items waiting between two stages.
+        progress (callable): called as progress(item, stage_name) after every stage of every item (from the stage threads).
+    '''
+
+    def __init__(self, stages, queue_size=1, progress=None):
+        self.stages = stages
+        self.queue_size = max(1, int(queue_size))
+        self.progress = progress
+
+    def run(self, values):
+        '''
+        Returns:
+            dict: {'total', 'succeeded', 'failed', 'elapsed_sec', 'stage_busy_sec', 'items'} where
+                  stage_busy_sec is the summed work time of every stage (the largest one bounds the makespan).
+        '''
+        t0 = time.monotonic()
+        items = [PipelineItem(num, value) for num, value in enumerate(values)]
+        # the first queue is unbounded (all inputs are known), the others are bounded
+        queues = [queue.Queue()] + [queue.Queue(maxsize=self.queue_size) for _ in self.stages[1:]] + [None]
+        busy = {stage.name: 0.0 for stage in self.stages}
+        lock = threading.Lock()
+        remaining = [stage.workers for stage in self.stages]
+
+        def fail_later_stages(i, item):
+            for stage in self.stages[i + 1:]:
+                if stage.on_failure:
+                    try:
+                        stage.on_failure(item.value)
+                    except Exception:
+                        logging.exception(f'pipeline: on_failure of {stage.name} failed for item {item.num}')
+
+        def worker(i, stage):
+            in_queue, out_queue = queues[i], queues[i + 1]
+            try:
+                while True:
+                    item = in_queue.get()
+                    if item is _DONE:
+                        break
+                    item.stage = stage.name
+                    item.state = 'RUNNING'
+                    t = time.monotonic()
+                    try:
+                        stage.func(item.value)
+                        item.state = 'DONE' if out_queue is None else 'QUEUED'
+                    except Exception as e:
+                        logging.exception(f'pipeline: item {item.num} failed in {stage.name}')
+                        item.state = 'FAILURE'
+                        item.error = repr(e)
+                        fail_later_stages(i, item)
+                    finally:
+                        item.stage_sec[stage.name] = time.monotonic() - t
+                        with lock:
+                            busy[stage.name] += item.stage_sec[stage.name]
+                    if self.progress:
+                        try:
+                            self.progress(item, stage.name)
+                        except Exception:
+                            logging.exception(f'pipeline: progress failed for item {item.num} in {stage.name}')
+                    if out_queue is not None and item.state != 'FAILURE':
+                        out_queue.put(item)
+            finally:
+                with lock:
+                    remaining[i] -= 1
+                    last = remaining[i] == 0
+                if last and out_queue is not None:
+                    # the last worker of this stage closes the next stage, even if this worker died
+                    for _ in range(self.stages[i + 1].workers):
+                        out_queue.put(_DONE)
+
+        threads = [threading.Thread(target=worker, args=(i, stage), name=f'pipeline-{stage.name}-{w}', daemon=True)
+                   for i, stage in enumerate(self.stages) for w in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+
+        failed = [item for item in items if item.state == 'FAILURE']
+        return {'total': len(items),
+                'succeeded': len(items) - len(failed),
+                'failed': len(failed),
+                'elapsed_sec': round(time.monotonic() - t0, 3),
+                'stage_busy_sec': {k: round(v, 3) for k, v in busy.items()},
+                'items': [item.as_dict() for item in items]}
+
+
+def make_runner(case):
+    '''
+    PHT_runner of a batch case:
+    {'dataDir', 'label', 'enable_traces', 'exclude_dirs', 'remote_output_path', 'phtester_command'}
+    '''
+    return PHT_runner(dataDir=case['dataDir'],
+                      label=case.get('label') or Path(case['dataDir']).name,
+                      enable_traces=list(case.get('enable_traces') or []),
+                      exclude_dirs=list(case.get('exclude_dirs') or []),
+                      remote_output_path=case.get('remote_output_path', ''),
+                      phtester_command=case.get('phtester_command'))
+
+
+def prepare(pht):
+    if not pht.readCartoVersion():
+        raise FileNotFoundError(f'no recording_version file in {pht.dataDir}')
+    pht.copy_phtester()
+
+
+def run_tester(pht):
+    result = pht.run_phtester()
+    if result['returncode'] != 0:
+        raise RuntimeError(f"PHTester exit code {result['returncode']} (log: {result['log_file']})")
+
+
+def harvest_results(pht):
+    pht.copy_result()
+    pht.cleanup()
+
+
+def pht_stages(run_workers=2, copy_workers=1, harvest=True):
+    '''
+    Stages of a PHT batch: prepare (CARTO version + tester copy), copy (recordings), configure
+    (TracerConfig.xml), run (PHTester, run_workers at a time - match phtester_slots) and
+    harvest (copy_result + cleanup; a failed case is only cleaned up).
+    '''
+    stages = [Stage('prepare', prepare),
+              Stage('copy', lambda pht: pht.copy_recordings(), workers=copy_workers),
+              Stage('configure', lambda pht: pht.update_trace_config()),
+              Stage('run', run_tester, workers=run_workers)]
+    if harvest:
+        stages.append(Stage('harvest', harvest_results, on_failure=lambda pht: pht.cleanup()))
+    return stages
+
+
+def run_pht_batch(cases, run_workers=None, copy_workers=1, queue_size=1, harvest=True, progress=None):
+    '''
+    Run a batch of PHT cases through the staged pipeline: the recordings of the next cases are copied
+    while the tester runs on the current ones, and finished cases are harvested while others still run.
+    Args:
+        cases (list): case dicts, see make_runner.
+        run_workers (int): testers run at the same time (default: phtester_slots of pht_runner/config.ini).
+        copy_workers (int): cases whose recordings are copied at the same time.
+        queue_size (int): cases prepared ahead of a stage.
+        harvest (bool): move the traces to <phtester_results_path>/<label> (or remote_output_path) and remove the temporary dirs.
+        progress (callable): progress(case_record, stage_name) after every stage of every case.
+    Returns:
+        dict: Pipeline.run summary, every item also has the case 'label'.
+    '''
+    runners = [make_runner(case) for case in cases]
+    if run_workers is None:
+        run_workers = runners[0].config['DEFAULT'].getint('phtester_slots', 2) if runners else 1
+
+    def item_progress(item, stage_name):
+        if progress:
+            progress(dict(item.as_dict(), label=item.value.label), stage_name)
+
+    pipeline = Pipeline(pht_stages(run_workers, copy_workers, harvest), queue_size=queue_size, progress=item_progress)
+    summary = pipeline.run(runners)
+    for item, pht in zip(summary['items'], runners):
+        item['label'] = pht.label
+    logging.info(f"pht batch: {summary['succeeded']}/{summary['total']} cases in {summary['elapsed_sec']} sec, "
+                 f"stage busy time {summary['stage_busy_sec']}")
+    return summary
@@ -0,0 +1,317 @@
+from pathlib import Path
+import collections
+import logging
+import logging.handlers
+import os
+import signal
+import subprocess as sp
+import sys
+import threading
+import time
+import tempfile
+from contextlib import contextmanager
+from common.locking import FileLock
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class ProcessLimitError(RuntimeError):
+    ''' the supervised process was killed for exceeding its wall-clock or memory limit '''
+
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+def _linux_tree_rss(pid):
+    children = collections.defaultdict(list)
+    rss = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/stat', 'r') as fp:
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry.name))
+        rss[int(entry.name)] = int(fields[21]) * page_size
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        total += rss.get(p, 0)
+        todo.extend(children.get(p, ()))
+    return total
+
+
+def _windows_tree_rss(pid):
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESSENTRY32(ctypes.Structure):
+        _fields_ = [('dwSize', wintypes.DWORD), ('cntUsage', wintypes.DWORD), ('th32ProcessID', wintypes.DWORD),
+                    ('th32DefaultHeapID', ctypes.c_size_t), ('th32ModuleID', wintypes.DWORD),
+                    ('cntThreads', wintypes.DWORD), ('th32ParentProcessID', wintypes.DWORD),
+                    ('pcPriClassBase', ctypes.c_long), ('dwFlags', wintypes.DWORD), ('szExeFile', ctypes.c_char * 260)]
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    kernel32, psapi = ctypes.windll.kernel32, ctypes.windll.psapi
+    kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    TH32CS_SNAPPROCESS, PROCESS_QUERY_LIMITED_INFORMATION = 0x2, 0x1000
+    children = collections.defaultdict(list)
+    snapshot = kernel32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+    try:
+        entry = PROCESSENTRY32()
+        entry.dwSize = ctypes.sizeof(entry)
+        ok = kernel32.Process32First(snapshot, ctypes.byref(entry))
+        while ok:
+            children[entry.th32ParentProcessID].append(entry.th32ProcessID)
+            ok = kernel32.Process32Next(snapshot, ctypes.byref(entry))
+    finally:
+        kernel32.CloseHandle(snapshot)
+    total, todo, seen = 0, [pid], set()
+    while todo:
+        p = todo.pop()
+        if p in seen:
+            continue
+        seen.add(p)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, p)
+        if handle:
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            if psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                total += counters.WorkingSetSize
+            kernel32.CloseHandle(handle)
+        todo.extend(children.get(p, ()))
+    return total
+
+
+def process_tree_rss(pid):
+    ''' resident memory of pid and all its descendants in bytes (None if unavailable) '''
+    try:
+        if psutil is not None:
+            proc = psutil.Process(pid)
+            procs = [proc] + proc.children(recursive=True)
+            total = 0
+            for p in procs:
+                try:
+                    total += p.memory_info().rss
+                except psutil.Error:
+                    pass
+            return total
+        if sys.platform == 'win32':
+            return _windows_tree_rss(pid)
+        if os.path.isdir('/proc'):
+            return _linux_tree_rss(pid)
+    except Exception as e:
+        logging.debug(f'process_tree_rss({pid}) failed: {e!r}')
+    return None
+
+
+def kill_tree(proc):
+    ''' kill the process and everything it started (the .bat's cmd.exe starts the tester itself) '''
+    if proc.poll() is not None:
+        return
+    if sys.platform == 'win32':
+        sp.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            proc.kill()
+    proc.wait()
+
+
+class ProcessSupervisor():
+    '''
+    Runs a command without buffering its output: stdout / stderr are read line by line by two
+    threads into a rotating log file, the last tail_lines lines are kept for the result, and the
+    process tree is killed when it runs longer than timeout or uses more than max_memory_bytes.
+    Args:
+        cmd (list or str): command to run.
+        cwd (str): working directory.
+        env (dict): environment (inherited if None).
+        log_file (str): rotating log of the output lines (none if None).
+        log_max_bytes / log_backups (int): rotation of log_file.
+        timeout (float): wall-clock limit in seconds (None: no limit).
+        max_memory_bytes (int): resident memory limit of the whole process tree (None: no limit).
+        poll_interval (float): seconds between limit checks.
+        progress (callable): called as progress(status) at most every progress_interval seconds, from
+                             the thread that calls wait(); status has 'lines', 'last_line', 'elapsed_sec', 'rss_bytes'.
+        tail_lines (int): output lines kept in memory.
+    '''
+
+    def __init__(self, cmd, cwd=None, env=None, log_file=None, log_max_bytes=10 * 2**20, log_backups=3,
+                 timeout=None, max_memory_bytes=None, poll_interval=0.5, progress=None, progress_interval=2.0,
+                 tail_lines=200):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.log_file = log_file
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        self.timeout = timeout
+        self.max_memory_bytes = max_memory_bytes
+        self.poll_interval = poll_interval
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.proc = None
+        self.readers = []
+        self.handler = None
+
+    def open_log(self):
+        if self.log_file:
+            Path(self.log_file).parent.mkdir(parents=True, exist_ok=True)
+            self.handler = logging.handlers.RotatingFileHandler(self.log_file, maxBytes=self.log_max_bytes,
+                                                                backupCount=self.log_backups, encoding='utf-8')
+            self.handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+
+    def log(self, msg):
+        # the handler serializes the two reader threads
+        if self.handler is not None:
+            self.handler.handle(logging.makeLogRecord({'msg': msg, 'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+    def close_log(self):
+        if self.handler is not None:
+            self.handler.close()
+            self.handler = None
+
+    def read_stream(self, stream, name):
+        for raw in iter(stream.readline, b''):
+            line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+            with self.lock:
+                self.lines += 1
+                self.tail.append(f'{name}: {line}' if name == 'stderr' else line)
+            self.log(f'[{name}] {line}')
+        stream.close()
+
+    def start(self):
+        self.open_log()
+        self.log(f'[supervisor] start: {self.cmd}')
+        kwargs = {'creationflags': sp.CREATE_NEW_PROCESS_GROUP} if sys.platform == 'win32' else {'start_new_session': True}
+        self.proc = sp.Popen(self.cmd, cwd=self.cwd, env=self.env, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE,
+                             **kwargs)
+        self.t0 = time.monotonic()
+        self.readers = [threading.Thread(target=self.read_stream, args=(stream, name), daemon=True)
+                        for stream, name in ((self.proc.stdout, 'stdout'), (self.proc.stderr, 'stderr'))]
+        for reader in self.readers:
+            reader.start()
+        return self.proc
+
+    def status(self, rss_bytes=None):
+        with self.lock:
+            return {'lines': self.lines,
+                    'last_line': self.tail[-1] if self.tail else None,
+                    'elapsed_sec': round(time.monotonic() - self.t0, 3),
+                    'rss_bytes': rss_bytes}
+
+    def wait(self):
+        '''
+        Wait for the process, enforcing the limits.
+        Returns:
+            dict: {'returncode', 'elapsed_sec', 'peak_rss_bytes', 'lines', 'tail', 'log_file', 'killed'}
+                  (killed: None, 'timeout' or 'memory').
+        Raises:
+            ProcessLimitError: if the process tree was killed; the result is in its .result.
+        '''
+        killed, peak_rss, last_progress = None, 0, 0.0
+        try:
+            while self.proc.poll() is None:
+                elapsed = time.monotonic() - self.t0
+                rss = process_tree_rss(self.proc.pid) if self.max_memory_bytes or self.progress else None
+                peak_rss = max(peak_rss, rss or 0)
+                if self.timeout and elapsed > self.timeout:
+                    killed = 'timeout'
+                elif self.max_memory_bytes and rss and rss > self.max_memory_bytes:
+                    killed = 'memory'
+                if killed:
+                    self.log(f'[supervisor] kill ({killed}): elapsed {elapsed:.1f} sec, rss {rss} bytes')
+                    kill_tree(self.proc)
+                    break
+                if self.progress and time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    self.progress(self.status(rss))
+                time.sleep(self.poll_interval)
+        except BaseException:
+            kill_tree(self.proc)
+            raise
+        finally:
+            for reader in self.readers:
+                reader.join(timeout=10)
+            result = dict(self.status(), returncode=self.proc.returncode, peak_rss_bytes=peak_rss or None,
+                          tail=list(self.tail), log_file=str(self.log_file) if self.log_file else None, killed=killed)
+            result.pop('rss_bytes')
+            self.log(f"[supervisor] exit code {result['returncode']} after {result['elapsed_sec']} sec")
+            self.close_log()
+        if killed:
+            limit = f'{self.timeout} sec' if killed == 'timeout' else f'{self.max_memory_bytes} bytes'
+            raise ProcessLimitError(f'{self.cmd} killed: {killed} limit of {limit} exceeded', result)
+        return result
+
+    def run(self):
+        self.start()
+        return self.wait()
+
+
+class SlotPool():
+    '''
+    Node wide limit on concurrently running processes (e.g. PHTester runs of all the worker processes
+    of this machine): num_of_slots lock files, a run holds one of them.
+    Args:
+        num_of_slots (int): concurrent runs allowed.
+        lock_dir (str): directory of the slot lock files (node local).
+        poll (float): seconds between attempts while all slots are taken.
+    '''
+
+    def __init__(self, num_of_slots, lock_dir=None, name='phtester', poll=1.0):
+        self.num_of_slots = max(1, int(num_of_slots))
+        self.lock_dir = Path(lock_dir or Path(tempfile.gettempdir()).joinpath('case_processor_slots'))
+        self.name = name
+        self.poll = poll
+
+    def acquire(self, timeout=None, waiting=None):
+        '''
+        Take a free slot, waiting for one if needed. waiting() is called once if all slots are taken.
+        Returns:
+            (int, FileLock): slot number and its held lock (release it with release()).
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        notified = False
+        while True:
+            for slot in range(self.num_of_slots):
+                lock = FileLock(self.lock_dir.joinpath(f'{self.name}.{slot}.lock'))
+                if lock.acquire(blocking=False):
+                    return slot, lock
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f'no free {self.name} slot within {timeout} sec')
+            if waiting and not notified:
+                waiting()
+                notified = True
+            time.sleep(self.poll)
+
+    @staticmethod
+    def release(lock):
+        lock.release()
+
+    @contextmanager
+    def hold(self, timeout=None, waiting=None):
+        ''' with slots.hold() as slot: ... - a free slot for the duration of the block '''
+        slot, lock = self.acquire(timeout, waiting)
+        try:
+            yield slot
+        finally:
+            self.release(lock)
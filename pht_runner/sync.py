@@ -0,0 +1,178 @@
+from pathlib import Path
+import concurrent.futures
+import fnmatch
+import hashlib
+import threading
+import shutil
+import time
+import os
+import uuid
+import logging
+
+
+COPY_BUFSIZE = 8 * 1024 * 1024
+PARTIAL_SUFFIX = '.partial'
+# mtime resolution of FAT / SMB shares
+MTIME_TOLERANCE = 2.0
+# a partial copy not written to for this long is left over by a dead sync (in-flight copies are written every chunk)
+STALE_PARTIAL_SEC = float(os.getenv('SYNC_STALE_PARTIAL_SEC', 600))
+
+
+def file_digest(path, bufsize=COPY_BUFSIZE):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(bufsize):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def needs_copy(src, dst, src_stat, use_hash=False):
+    ''' True if dst is missing or differs from src (size / mtime, and content when use_hash) '''
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return True
+    if dst_stat.st_size != src_stat.st_size:
+        return True
+    if use_hash:
+        return file_digest(src) != file_digest(dst)
+    return abs(dst_stat.st_mtime - src_stat.st_mtime) > MTIME_TOLERANCE
+
+
+class SyncProgress():
+    ''' Thread safe byte / file counters, reported to a callback at most every interval seconds '''
+
+    def __init__(self, callback=None, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.last_report = 0
+        self.files_total = 0
+        self.files_copied = 0
+        self.files_skipped = 0
+        self.bytes_total = 0
+        self.bytes_copied = 0
+
+    def add(self, bytes_copied=0, files_copied=0, files_skipped=0):
+        with self.lock:
+            self.bytes_copied += bytes_copied
+            self.files_copied += files_copied
+            self.files_skipped += files_skipped
+            report = self.callback and time.monotonic() - self.last_report >= self.interval
+            if report:
+                self.last_report = time.monotonic()
+        if report:
+            self.callback(self.as_dict())
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self.start_time
+        return {'files_total': self.files_total,
+                'files_copied': self.files_copied,
+                'files_skipped': self.files_skipped,
+                'bytes_total': self.bytes_total,
+                'bytes_copied': self.bytes_copied,
+                'elapsed_sec': round(elapsed, 3),
+                'bytes_per_sec': round(self.bytes_copied / elapsed) if elapsed > 0 else 0}
+
+
+def copy_file(src, dst, progress=None, bufsize=COPY_BUFSIZE, run_id=None):
+    '''
+    Copy src to a temporary name next to dst and rename it into place once complete,
+    so an interrupted copy never leaves a truncated file under the final name.
+    run_id: id of the sync (in the temporary name), default the process id.
+    '''
+    tmp = f'{dst}{PARTIAL_SUFFIX}-{run_id or os.getpid()}-{threading.get_ident()}'
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            while chunk := fsrc.read(bufsize):
+                fdst.write(chunk)
+                if progress:
+                    progress.add(bytes_copied=len(chunk))
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def list_files(src, exclude_dirs=(), ignore_patterns=()):
+    ''' (relative path, stat) of all files under src, skipping top level exclude_dirs and ignore_patterns '''
+    files = []
+    stack = [(src, 0)]
+    while stack:
+        dir_path, depth = stack.pop()
+        for entry in os.scandir(dir_path):
+            if any(fnmatch.fnmatch(entry.name, p) for p in ignore_patterns):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if depth == 0 and entry.name in exclude_dirs:
+                    continue
+                stack.append((entry.path, depth + 1))
+            else:
+                files.append((os.path.relpath(entry.path, src), entry.stat()))
+    return files
+
+
+def remove_partials(dst, stale_after=STALE_PARTIAL_SEC):
+    '''
+    remove temporary files left by an interrupted sync: partial copies not modified for stale_after
+    seconds. Younger ones may belong to a concurrent sync of the same destination and are kept.
+    '''
+    now = time.time()
+    for f in Path(dst).rglob(f'*{PARTIAL_SUFFIX}-*'):
+        try:
+            if now - f.stat().st_mtime < stale_after:
+                continue
+            logging.info(f'sync: remove leftover partial copy {f}')
+            f.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+
+def sync_tree(src, dst, exclude_dirs=(), ignore_patterns=('*$RECYCLE.BIN*',), max_workers=8,
+              use_hash=False, progress=None, progress_interval=1.0):
+    '''
+    Incremental, parallel copy of src into dst: only files whose size / mtime (or content hash
+    when use_hash) differ are copied, concurrently in a thread pool.
+    Args:
+        exclude_dirs (list): names of top level directories of src to skip.
+        progress (callable): called with the SyncProgress counters (bytes/sec etc.) while copying.
+    Returns:
+        dict: final counters.
+    '''
+    src, dst = str(src), str(dst)
+    os.makedirs(dst, exist_ok=True)
+    remove_partials(dst)
+    # in the temporary names, so partial copies of concurrent syncs of the same destination are told apart
+    run_id = uuid.uuid4().hex[:12]
+
+    stats = SyncProgress(progress, progress_interval)
+    files = list_files(src, exclude_dirs, ignore_patterns)
+    stats.files_total = len(files)
+    stats.bytes_total = sum(st.st_size for _, st in files)
+    logging.info(f'sync: {src} -> {dst} ({stats.files_total} files, {stats.bytes_total} bytes)')
+
+    def sync_file(rel_path, src_stat):
+        src_file, dst_file = os.path.join(src, rel_path), os.path.join(dst, rel_path)
+        if needs_copy(src_file, dst_file, src_stat, use_hash=use_hash):
+            copy_file(src_file, dst_file, progress=stats, run_id=run_id)
+            stats.add(files_copied=1)
+        else:
+            stats.add(files_skipped=1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # largest files first, so a big file does not start last
+        futures = [executor.submit(sync_file, rel_path, st) for rel_path, st in sorted(files, key=lambda f: -f[1].st_size)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    result = stats.as_dict()
+    if progress:
+        progress(result)
+    logging.info(f'sync: done {result}')
+    return result
@@ -0,0 +1,211 @@
+'''
+Block-level checkpoints of long DLI reads.
+
+The checkpoint of an output is a manifest next to it (<output>.checkpoint.json) listing the
+completed [ts0, ts1] blocks with their record count and SHA-1, rewritten atomically after every
+block. A job submitted again with the same parameters skips the finished blocks:
+- single output files (json / jsonl / pk, see stream_writer.BlockWriter) are truncated to the end
+  of the last checkpointed block and appended to
+- per-block outputs (MP_dli part files) are reused when their checksum still matches
+so a crashed or killed run costs at most the block that was in flight.
+'''
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+import logging
+from common.locking import FileLock
+from pyDli.stream_writer import get_writer, is_resumable, WRITERS
+
+
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+
+
+def job_key(job):
+    ''' stable hash of the parameters that define the output of a job '''
+    return hashlib.sha1(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_sha1(filename, start=0, end=None, chunk_size=1 << 20):
+    ''' SHA-1 of filename[start:end] '''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            data = fp.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not data:
+                break
+            sha1.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return sha1.hexdigest()
+
+
+class CheckpointBusy(RuntimeError):
+    ''' another run of the same job holds the checkpoint '''
+
+
+class Checkpoint():
+    '''
+    Manifest of the completed blocks of one output.
+    Args:
+        filename (str): output file name without suffix (the manifest is filename + CHECKPOINT_SUFFIX).
+        job (dict): parameters of the job; a manifest of different parameters is discarded.
+        lock (bool): hold an inter-process lock on the manifest until close(), so a redelivered task
+                     cannot write the same output while the first run is still alive (raises CheckpointBusy).
+    '''
+
+    def __init__(self, filename, job, lock=True):
+        self.path = Path(str(filename) + CHECKPOINT_SUFFIX)
+        self.job = job
+        self.key = job_key(job)
+        self.lock = None
+        self.lock_path = Path(str(self.path) + '.lock')
+        if lock:
+            self.lock = FileLock(self.lock_path)
+            if not self.lock.acquire(blocking=False):
+                self.lock = None
+                raise CheckpointBusy(f'{self.path} is used by another run')
+        self.load()
+
+    def load(self):
+        self.blocks = {}
+        self.writer_state = None
+        self.complete = False
+        try:
+            with open(self.path, 'r') as fp:
+                manifest = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return self
+        if manifest.get('key') != self.key:
+            logging.info(f'checkpoint: {self.path} belongs to other job parameters, starting over')
+            return self
+        self.blocks = {tuple(entry['tsRange']): entry for entry in manifest['blocks']}
+        self.writer_state = manifest.get('writer')
+        self.complete = manifest.get('complete', False)
+        logging.info(f'checkpoint: {len(self.blocks)} blocks of {self.path} already done')
+        return self
+
+    def save(self):
+        manifest = {'key': self.key,
+                    'job': self.job,
+                    'updated': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    'complete': self.complete,
+                    'records': sum(entry['records'] for entry in self.blocks.values()),
+                    'writer': self.writer_state,
+                    'blocks': list(self.blocks.values())}
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump(manifest, fp)
+        os.replace(tmp_path, self.path)
+
+    def get(self, block):
+        ''' the entry of a completed block, None if it has to be (re)done '''
+        return self.blocks.get((int(block[0]), int(block[1])))
+
+    def add(self, block, **entry):
+        ''' record a completed block (entry: 'records', 'sha1' and any other field) '''
+        self.blocks[(int(block[0]), int(block[1]))] = dict(entry, tsRange=[int(block[0]), int(block[1])])
+        self.save()
+
+    def add_block(self, block, writer, **entry):
+        ''' record a block just written to writer (a single output file): its byte range, checksum and the writer state '''
+        start, records = (self.writer_state['offset'], self.writer_state['records']) if self.writer_state else (0, 0)
+        state = writer.state()
+        self.writer_state = state
+        self.add(block, records=state['records'] - records, offset=[start, state['offset']],
+                 sha1=file_sha1(writer.filename, start, state['offset']), **entry)
+
+    def add_file(self, block, filename, **entry):
+        ''' record a block written to its own file '''
+        self.add(block, file=str(filename), sha1=file_sha1(filename), **entry)
+
+    def verified(self, block):
+        ''' the entry of a completed block whose own file still exists with the same checksum '''
+        entry = self.get(block)
+        if not entry or not entry.get('file'):
+            return entry
+        try:
+            if file_sha1(entry['file']) == entry['sha1']:
+                return entry
+        except OSError:
+            pass
+        logging.warning(f"checkpoint: {entry['file']} is missing or changed, block {block} is read again")
+        return None
+
+    def verify_output(self, filename):
+        '''
+        True if filename still holds the checkpointed blocks: at least as long as the last checkpointed offset
+        and the last block's checksum matches (bytes written after it by a crashed run are dropped on resume).
+        '''
+        if not self.writer_state or not self.blocks:
+            return False
+        last = max(self.blocks.values(), key=lambda entry: entry['offset'][1])
+        try:
+            if os.path.getsize(filename) < last['offset'][1]:
+                return False
+            return file_sha1(filename, *last['offset']) == last['sha1']
+        except OSError:
+            return False
+
+    def reset(self):
+        self.blocks = {}
+        self.writer_state = None
+        self.complete = False
+        self.save()
+
+    def finish(self, remove=True):
+        '''
+        the job is complete: the manifest and its lock file are removed (a new run starts over),
+        or kept and marked complete with remove=False.
+        '''
+        self.complete = True
+        if not remove:
+            self.save()
+            return
+        self.close()
+        for path in (self.path, self.lock_path):
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                # opened by another run (Windows)
+                logging.info(f'checkpoint: unable to remove {path}')
+
+    def close(self):
+        if self.lock:
+            self.lock.release()
+            self.lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(output_type, output_filename, job, lock=True):
+    '''
+    Writer of output_filename and its checkpoint: continues the output of an earlier run of the same job
+    from its last checkpointed block, or starts a new one. Output types without a resumable writer
+    (columnar, written on close, and store) get no checkpoint.
+    Returns:
+        tuple: (writer, checkpoint or None)
+    '''
+    if not is_resumable(output_type):
+        logging.info(f'checkpoint: output_type {output_type} is not resumable, no checkpoint')
+        return get_writer(output_type, output_filename), None
+    checkpoint = Checkpoint(output_filename, dict(job, output_type=output_type), lock=lock)
+    filename = str(output_filename) + WRITERS[output_type][1]
+    try:
+        if checkpoint.verify_output(filename):
+            logging.info(f'checkpoint: resuming {filename} after {len(checkpoint.blocks)} blocks')
+            return get_writer(output_type, output_filename, resume=checkpoint.writer_state), checkpoint
+        if checkpoint.blocks:
+            logging.warning(f'checkpoint: {filename} does not match its checkpoint, starting over')
+        checkpoint.reset()
+        return get_writer(output_type, output_filename), checkpoint
+    except Exception:
+        checkpoint.close()
+        raise
@@ -0,0 +1,208 @@
+import json
+import zipfile
+from collections.abc import Mapping
+from pathlib import Path
+import logging
+
+import numpy as np
+
+
+def flatten_record(rec, prefix=''):
+    '''
+    Flatten a parsed record (output of PyDli.parse) to {dotted column name: value}.
+    Nested records become dotted names, arrays of nested records are transposed
+    to one list per field, e.g. Electrodes=[{Id: 1}, {Id: 2}] -> {'Electrodes.Id': [1, 2]}.
+    '''
+    out = {}
+    for name, value in rec.items():
+        col = prefix + name
+        if isinstance(value, dict):
+            out.update(flatten_record(value, col + '.'))
+        elif isinstance(value, list) and value and isinstance(value[0], dict):
+            flat = [flatten_record(v) for v in value]
+            for sub in flat[0]:
+                out[f'{col}.{sub}'] = [f.get(sub) for f in flat]
+        else:
+            out[col] = value
+    return out
+
+
+def to_array(values):
+    '''
+    Convert the values of one column to a typed array.
+    Fixed-length lists become a 2-D array, ragged or mixed columns fall back to an object array.
+    '''
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        arr = None
+    if arr is None or arr.dtype == object:
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+    return arr
+
+
+def to_columns(records):
+    ''' Convert parsed records to a struct-of-arrays: {dotted column name: np.ndarray}. '''
+    flat = [flatten_record(rec) for rec in records]
+    names = {}
+    for f in flat:
+        names.update(dict.fromkeys(f))
+    return {name: to_array([f.get(name) for f in flat]) for name in names}
+
+
+def concat_columns(blocks):
+    ''' Concatenate per block column dicts, columns missing in a block are filled with None. '''
+    lengths = [len(next(iter(b.values()))) if b else 0 for b in blocks]
+    names = {}
+    for b in blocks:
+        names.update(dict.fromkeys(b))
+
+    columns = {}
+    for name in names:
+        parts = []
+        for b, n in zip(blocks, lengths):
+            if name in b:
+                parts.append(b[name])
+            else:
+                parts.append(np.full(n, None, dtype=object))
+        try:
+            columns[name] = np.concatenate(parts)
+        except ValueError:
+            # trailing shapes differ between blocks (e.g. array length changed)
+            columns[name] = to_array([v for p in parts for v in p.tolist()])
+    return columns
+
+
+def save_columnar(columns, filename, fmt='npz'):
+    '''
+    Write columns as a single .npz file, or as a directory of .npy files (fmt='npy')
+    that can be memory-mapped by load_columnar.
+    Both hold numbered .npy members and a columns.json index {column name: {'file', 'dtype', 'shape'}}.
+    Returns:
+        Path: written file / directory.
+    '''
+    filename = Path(filename)
+    index = {}
+    if fmt == 'npz':
+        # not np.savez(**columns): column names are arbitrary (e.g. 'file') and would collide with its arguments
+        with zipfile.ZipFile(filename, 'w', allowZip64=True) as zf:
+            for i, (name, arr) in enumerate(columns.items()):
+                fname = f'{i:04d}.npy'
+                with zf.open(fname, 'w', force_zip64=True) as fp:
+                    np.lib.format.write_array(fp, np.asanyarray(arr), allow_pickle=arr.dtype == object)
+                index[name] = {'file': fname, 'dtype': str(arr.dtype), 'shape': list(arr.shape)}
+            zf.writestr('columns.json', json.dumps(index, indent=4))
+    elif fmt == 'npy':
+        filename.mkdir(parents=True, exist_ok=True)
+        for i, (name, arr) in enumerate(columns.items()):
+            # column names may contain characters that are not valid in file names
+            fname = f'{i:04d}.npy'
+            np.save(filename.joinpath(fname), arr, allow_pickle=arr.dtype == object)
+            index[name] = {'file': fname, 'dtype': str(arr.dtype), 'shape': list(arr.shape)}
+        with open(filename.joinpath('columns.json'), 'w') as fp:
+            json.dump(index, fp, indent=4)
+    else:
+        raise ValueError(f'unknown columnar format: {fmt}')
+    return filename
+
+
+class NpzColumns(Mapping):
+    '''
+    Lazy {column name: np.ndarray} view of a .npz written by save_columnar, columns are read on access.
+    Only the columns indexed as object columns are unpickled.
+    '''
+
+    def __init__(self, filename):
+        self.zip = zipfile.ZipFile(filename)
+        self.index = json.loads(self.zip.read('columns.json'))
+
+    def __getitem__(self, name):
+        info = self.index[name]
+        with self.zip.open(info['file']) as fp:
+            return np.lib.format.read_array(fp, allow_pickle=info['dtype'] == 'object')
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_columnar(filename, mmap_mode='r', allow_pickle=False):
+    '''
+    Load columns written by save_columnar.
+    For a .npy directory typed columns are memory-mapped (zero copy), object columns are unpickled.
+    For a .npz file a lazy NpzColumns is returned (columns are read on access).
+    A .npz without columns.json (older np.savez files) is loaded as a NpzFile, unpickled only with allow_pickle.
+    '''
+    filename = Path(filename)
+    if filename.is_dir():
+        with open(filename.joinpath('columns.json'), 'r') as fp:
+            index = json.load(fp)
+        columns = {}
+        for name, info in index.items():
+            is_object = info['dtype'] == 'object'
+            columns[name] = np.load(filename.joinpath(info['file']),
+                                    mmap_mode=None if is_object else mmap_mode,
+                                    allow_pickle=is_object)
+        return columns
+    with zipfile.ZipFile(filename) as zf:
+        indexed = 'columns.json' in zf.namelist()
+    if indexed:
+        return NpzColumns(filename)
+    return np.load(filename, allow_pickle=allow_pickle)
+
+
+class ColumnarWriter():
+    '''
+    Block writer (see pyDli.stream_writer) that converts every block to typed columns as it
+    arrives and writes one .npz file / .npy directory on close.
+    Only the compact column arrays are kept in memory, never the record dicts.
+    '''
+
+    def __init__(self, filename, fmt='npz'):
+        self.filename = Path(filename)
+        self.fmt = fmt
+        self.blocks = []
+        self.num_of_records = 0
+        self.num_of_blocks = 0
+        self.closed = False
+
+    def write_block(self, records, ts_range=None):
+        if records:
+            self.blocks.append(to_columns(records))
+        self.num_of_records += len(records)
+        self.num_of_blocks += 1
+
+    def close(self):
+        if self.closed:
+            return
+        columns = concat_columns(self.blocks)
+        self.blocks = []
+        save_columnar(columns, self.filename, fmt=self.fmt)
+        self.closed = True
+        logging.info(f'columnar: wrote {len(columns)} columns of {self.num_of_records} records to {self.filename}')
+
+    @property
+    def bytes_written(self):
+        if not self.closed:
+            return 0
+        if self.filename.is_dir():
+            return sum(f.stat().st_size for f in self.filename.iterdir())
+        return self.filename.stat().st_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,188 @@
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+import atexit
+import logging
+import os
+import threading
+from pyDli.stream_writer import get_writer, write_stream, block_read_range
+from pyDli.partition import split_block
+
+
+# state of the current (worker) process: loaded dli per version and resolved stream paths
+_state = {'version': None, 'dli': None, 'stream_paths': {}}
+
+# pools of the current process, reused across successive tasks: (version, max_workers, loader) -> executor.
+# At most MAX_POOLS are kept (least recently used first out), so a long-lived worker that sees many versions /
+# worker counts does not keep every pool's processes alive. An evicted pool still used by a use_pool() caller
+# is shut down when its last user leaves.
+MAX_POOLS = int(os.getenv('DLI_MAX_POOLS', 2))
+_pools = OrderedDict()
+_pool_users = {}
+_retired = set()
+_pools_lock = threading.RLock()
+
+
+def load_pydli(version):
+    ''' Default loader: a PyDli with the DliNetInterface assembly of version loaded. '''
+    from pyDli.pyDli import PyDli
+    dli = PyDli(caseDir=None, dliVersion=version)
+    dli.loadDli()
+    return dli
+
+
+def init_worker(loader, version):
+    ''' Process initializer: load the DLI assembly once per worker process. '''
+    _state['loader'] = loader
+    _state['version'] = version
+    _state['dli'] = loader(version)
+    _state['stream_paths'] = {}
+    logging.info(f'dli_pool: worker {os.getpid()} loaded DLI V{version}')
+
+
+def get_dli(version=None, loader=None):
+    ''' Loaded dli of the current process, (re)loaded only when the version changes. '''
+    if _state['dli'] is None or (version is not None and version != _state['version']):
+        init_worker(loader or _state.get('loader') or load_pydli, version)
+    return _state['dli']
+
+
+def get_stream_path(path, stream_label):
+    ''' Resolve (and cache per process) the stream file of stream_label in the case directory path. '''
+    key = (str(path), stream_label)
+    if key not in _state['stream_paths']:
+        _state['stream_paths'][key] = get_dli().find_stream_path(stream_label, search_path=path)
+    return _state['stream_paths'][key]
+
+
+def first_last_key(path, stream_label, version=None):
+    dli = get_dli(version)
+    return [int(k) for k in dli.DliReader.GetFirstLastKey(get_stream_path(path, stream_label))]
+
+
+def count_records(path, stream_label, ts0, ts1, version=None):
+    ''' Number of records in [ts0, ts1) (read only, no parsing) - used to probe record density. '''
+    dli = get_dli(version)
+    trace = dli.read(stream_label=stream_label, ts_range=block_read_range((ts0, ts1)),
+                     stream_path=get_stream_path(path, stream_label))
+    return len(trace) if trace else 0
+
+
+def read_block(path, stream_label, ts0, ts1, output_path=None, output_type='pk', version=None,
+               max_records=None, min_block=1, extract=None, offset=0):
+    '''
+    Read, parse and (optionally) write a single half-open [ts0, ts1) block with the dli loaded in this process.
+    If the block holds more than max_records records it is not parsed, the caller gets
+    back two halves to schedule instead (dynamic splitting of oversized blocks).
+    extract: field projection / row filter passed to dli.parse ('fields', 'where', 'stride').
+    offset: number of stream records before ts0, the stride is counted from it (a block read without knowing
+            it, e.g. by MP_dli, must not be strided: see stream_writer.merge_parts).
+    Returns:
+        dict: {'tsRange': [ts0, ts1], 'records': num_of_records, 'split': [sub blocks] or None,
+               'file': written file or None}
+    '''
+    dli = get_dli(version)
+    trace = dli.read(stream_label=stream_label, ts_range=block_read_range((ts0, ts1)),
+                     stream_path=get_stream_path(path, stream_label))
+    num_of_records = len(trace) if trace else 0
+    if max_records and num_of_records > max_records and ts1 - ts0 >= 2 * min_block:
+        return {'tsRange': [int(ts0), int(ts1)], 'records': 0, 'split': split_block((ts0, ts1)), 'file': None}
+
+    records = dli.parse(trace, stream_label, offset=offset, **(extract or {}))
+
+    output_filename = None
+    if output_path:
+        # all the blocks of a stream are appended to one store, other output types get a file per block
+        output_name = stream_label if output_type == 'store' else f'{stream_label}[{ts0},{ts1}]'
+        output_filename = Path(output_path).joinpath(output_name)
+        with get_writer(output_type, output_filename) as writer:
+            writer.write_block(records, [int(ts0), int(ts1)])
+        output_filename = str(writer.filename)
+
+    return {'tsRange': [int(ts0), int(ts1)], 'records': len(records), 'split': None, 'file': output_filename}
+
+
+def read_stream(path, stream_label, output_filename, output_type='json', ts_range=None, block_size=50000,
+                version=None, extract=None):
+    '''
+    Read a whole stream (or ts_range) of the case directory path into output_filename with the dli
+    loaded in this process - one task of a multi-stream read (see pyDli.multi_stream).
+    Returns:
+        dict: {'output', 'records', 'bytes', 'elapsed_sec', 'tsRange'}
+    '''
+    dli = get_dli(version)
+    stream_path = get_stream_path(path, stream_label)
+    ts_range = list(ts_range) if ts_range else [int(k) for k in dli.DliReader.GetFirstLastKey(stream_path)]
+    res = write_stream(dli, stream_label, output_type, output_filename, stream_path=stream_path,
+                       ts_range=ts_range, block_size=block_size, extract=extract)
+    return dict(res, tsRange=ts_range)
+
+
+def get_pool(version, max_workers, loader=load_pydli):
+    '''
+    Long-lived process pool whose workers have the DLI assembly of version already loaded.
+    Pools are kept per (version, max_workers, loader) and reused by later calls in this process;
+    use use_pool() to keep the pool from being shut down (evicted) while it is in use.
+    '''
+    key = (version, max_workers, loader)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or getattr(pool, '_broken', False):
+            if pool is not None:
+                _retire(_pools.pop(key))
+            logging.info(f'dli_pool: start {max_workers} workers for DLI V{version}')
+            pool = _pools[key] = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, initializer=init_worker, initargs=(loader, version))
+        _pools.move_to_end(key)
+        while len(_pools) > MAX_POOLS:
+            evicted_key, evicted = _pools.popitem(last=False)
+            logging.info(f'dli_pool: evict the pool of DLI V{evicted_key[0]} ({evicted_key[1]} workers)')
+            _retire(evicted)
+        return pool
+
+
+def _retire(pool):
+    ''' shut pool down now, or when its last user leaves (call with _pools_lock held) '''
+    if _pool_users.get(pool, 0):
+        _retired.add(pool)
+    else:
+        pool.shutdown(wait=False)
+
+
+@contextmanager
+def use_pool(version, max_workers, loader=load_pydli):
+    ''' get_pool() as a context: the pool is not shut down by an eviction before the block exits '''
+    with _pools_lock:
+        pool = get_pool(version, max_workers, loader)
+        _pool_users[pool] = _pool_users.get(pool, 0) + 1
+    try:
+        yield pool
+    finally:
+        with _pools_lock:
+            _pool_users[pool] -= 1
+            if not _pool_users[pool]:
+                del _pool_users[pool]
+                if pool in _retired:
+                    _retired.discard(pool)
+                    pool.shutdown(wait=False)
+
+
+def discard_pool(version, max_workers, loader=load_pydli):
+    ''' Drop a (broken) pool so the next get_pool starts a fresh one. '''
+    with _pools_lock:
+        pool = _pools.pop((version, max_workers, loader), None)
+        _retired.discard(pool)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        pools = list(_pools.values()) + list(_retired)
+        _pools.clear()
+        _retired.clear()
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
+
@@ -0,0 +1,146 @@
+'''
+Pure-Python stand-in for the DliNetInterface assembly, for benchmarks and for running the
+DLI pipeline on machines without the .NET reader.
+
+FakeDliReader exposes GetFirstLastKey and every reader named in stream2reader.json, and
+generates nested, array-bearing records deterministically from their timestamp, so any block
+partition of a range returns the same records. FakeDli mirrors the PyDli interface
+(find_stream_path / read / parse / get_first_last_key / view / metrics) and can be plugged into
+MP_dli / dli_pool with loader=load_fake.
+'''
+import json
+import random
+from functools import partial
+from pathlib import Path
+from common.instrumentation import Instrumentation, instrumented
+from pyDli.schema import SchemaCache
+from pyDli.trace_view import TraceView
+
+
+class Point():
+    def __init__(self, rnd):
+        self.X = rnd.random()
+        self.Y = rnd.random()
+        self.Z = rnd.random()
+
+
+class Electrode():
+    def __init__(self, rnd, num_of_samples=8):
+        self.Id = rnd.randrange(64)
+        self.Impedance = rnd.random() * 200
+        self.Position = Point(rnd)
+        self.Samples = [rnd.random() for _ in range(num_of_samples)]
+
+
+class Record():
+    def __init__(self, timestamp, num_of_electrodes=4, num_of_weights=16):
+        rnd = random.Random(timestamp)
+        self.Timestamp = timestamp
+        self.Valid = rnd.random() > 0.1
+        self.Status = rnd.randrange(8)
+        self.Location = Point(rnd)
+        self.Electrodes = [Electrode(rnd) for _ in range(num_of_electrodes)]
+        self.Weights = [rnd.random() for _ in range(num_of_weights)]
+        self.Range = (0, 1)
+        self.Extra = None
+
+
+# the parsers recognise DLI records by their type name
+for cls in (Point, Electrode, Record):
+    cls.__module__ = 'DliNetInterface'
+
+# python stand-ins of System.Array / System.Tuple
+ARRAY_TYPES = (list,)
+TUPLE_TYPES = (tuple,)
+
+
+def make_records(num_of_records, start=0, period=1, **kwargs):
+    return [Record(start + i * period, **kwargs) for i in range(num_of_records)]
+
+
+class FakeDliReader():
+    '''
+    Args:
+        first_last_key (list): [first, last] timestamp of every stream.
+        period (int): timestamps between records (record rate = 1 / period).
+        num_of_electrodes (int): size of the nested record array of every record.
+    '''
+    stream2reader_file = Path(__file__).parent.joinpath('stream2reader.json')
+
+    def __init__(self, first_last_key=(0, 1_000_000), period=100, num_of_electrodes=4):
+        self.first_last_key = [int(first_last_key[0]), int(first_last_key[1])]
+        self.period = int(period)
+        self.num_of_electrodes = num_of_electrodes
+        with open(self.stream2reader_file, 'r') as fp:
+            self.readers = [v['reader'] for v in json.load(fp).values()]
+        for reader in self.readers:
+            setattr(self, reader, self.read_range)
+
+    def GetFirstLastKey(self, stream_path):
+        return list(self.first_last_key)
+
+    def read_range(self, stream_path, ts0=None, ts1=None):
+        first, last = self.first_last_key
+        ts0 = first if ts0 is None else max(int(ts0), first)
+        ts1 = last if ts1 is None else min(int(ts1), last)
+        start = -(-ts0 // self.period) * self.period
+        return [Record(ts, num_of_electrodes=self.num_of_electrodes) for ts in range(start, ts1 + 1, self.period)]
+
+
+class FakeDli():
+    ''' PyDli interface on top of FakeDliReader '''
+
+    def __init__(self, caseDir=None, dliVersion='fake', **reader_kwargs):
+        self.caseDir = caseDir
+        self.dliVersion = dliVersion
+        self.stream_path = None
+        self.DliReader = FakeDliReader(**reader_kwargs)
+        self.schema_cache = SchemaCache(array_types=ARRAY_TYPES, tuple_types=TUPLE_TYPES)
+        self.metrics = Instrumentation('fake_dli')
+        with open(FakeDliReader.stream2reader_file, 'r') as fp:
+            self.stream2reader_ = json.load(fp)
+
+    def loadDli(self):
+        return self.DliReader
+
+    def stream2reader(self, stream_label):
+        return getattr(self.DliReader, self.stream2reader_[stream_label]['reader'], None)
+
+    def find_stream_path(self, stream_label, search_path=None):
+        self.stream_path = str(Path(search_path or self.caseDir or '.').joinpath(stream_label))
+        return self.stream_path
+
+    def stream_fingerprint(self, stream_label):
+        return [self.find_stream_path(stream_label), self.DliReader.first_last_key, self.DliReader.period]
+
+    def get_first_last_key(self, stream_label):
+        return list(self.DliReader.GetFirstLastKey(self.find_stream_path(stream_label)))
+
+    @instrumented('read', count_records=True)
+    def read(self, stream_label=None, ts_range=None, stream_path=None):
+        reading_func = self.stream2reader(stream_label)
+        stream_path = stream_path or self.stream_path or self.find_stream_path(stream_label)
+        if ts_range:
+            return reading_func(stream_path, ts_range[0], ts_range[1])
+        return reading_func(stream_path)
+
+    @instrumented('parse', count_records=True)
+    def parse(self, trace=None, stream_label=None, fields=None, where=None, stride=1, offset=0):
+        if trace and stream_label:
+            if fields or where or stride > 1:
+                return self.schema_cache.extractor(fields, where)(trace, stride, offset)
+            return [self.schema_cache.extract(x) for x in trace]
+        return []
+
+    def view(self, stream_label, **kwargs):
+        return TraceView(self, stream_label, **kwargs)
+
+
+def load_fake(version, **reader_kwargs):
+    ''' dli_pool / MP_dli loader returning a FakeDli '''
+    return FakeDli(dliVersion=version, **reader_kwargs)
+
+
+def fake_loader(**reader_kwargs):
+    ''' picklable loader with reader options, e.g. MP_dli(..., loader=fake_loader(period=10)) '''
+    return partial(load_fake, **reader_kwargs)
@@ -1,18 +1,22 @@
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import sys
-from copy import deepcopy
-from numpy import arange 
 import json
 import pickle
 from pathlib import Path
 import logging
-from pyDli.pyDli import PyDli
+from pyDli import dli_pool
+from pyDli.partition import adaptive_blocks
+from pyDli.stream_writer import iter_blocks
+from pyDli.checkpoint import Checkpoint
 import shutil
 
 
 class MP_dli(): 
     def __init__(self, version : str, path : str, stream_label: str, tsRange =None, 
-                 block_size : int = 50000, max_workers = 32, output_path=None, output_type='pk'):
+                 block_size : int = 50000, max_workers = 32, output_path=None, output_type='pk', 
+                 loader=dli_pool.load_pydli, target_records=None, max_block_records=None, 
+                 num_of_probes=16, probe_width=None, extract=None, checkpoint=False, max_block=None):
         
         self.version = version
         self.path = path
@@ -22,61 +26,137 @@ class MP_dli():
         self.max_workers = max_workers
         self.output_path = output_path
         self.output_type = output_type
+        # loader(version) -> loaded dli, runs once per worker process (a stub reader can be plugged in here)
+        self.loader = loader
+        # adaptive partitioning: blocks of ~target_records records planned from sampled density, 
+        # blocks holding more than max_block_records records are split while the job runs
+        self.target_records = target_records
+        self.max_block_records = max_block_records
+        self.num_of_probes = num_of_probes
+        self.probe_width = probe_width
+        # widest planned block (timestamps, default block_size): a region the probes saw as empty 
+        # does not become one huge block 
+        self.max_block = max_block or block_size
+        # field projection / row filter applied by the workers while parsing ('fields', 'where'). 
+        # A stride is counted over the stream, but a block's offset in it is unknown until the blocks 
+        # before it are read: stride the merged output instead (stream_writer.merge_parts) 
+        if extract and (extract.get('stride') or 1) > 1: 
+            raise ValueError('MP_dli: stride is not supported by parallel block reads, use merge_parts(stride=...)')
+        self.extract = extract
+        # keep a checkpoint of the finished blocks in output_path, a new run of the same job reuses their files
+        self.checkpoint = checkpoint
         
+    def get_pool(self): 
+        return dli_pool.get_pool(self.version, self.max_workers, loader=self.loader)
+
+    def use_pool(self): 
+        ''' the pool, kept alive (not evicted by other versions' pools) until the with block exits '''
+        return dli_pool.use_pool(self.version, self.max_workers, loader=self.loader)
+
     def get_tsrange(self): 
-        dli = PyDli(caseDir=self.path, dliVersion=self.version)
-        dli.loadDli()
-        dli.find_stream_path(self.stream_label, search_path=self.path)
-        return list(dli.DliReader.GetFirstLastKey(str(dli.stream_path))) 
+        with self.use_pool() as executor: 
+            return executor.submit(dli_pool.first_last_key, self.path, self.stream_label).result()
 
-    def worker(self, dli, stream_label, ts, block_size): 
-        dli.loadDli()
-        dli.find_stream_path(self.stream_label, search_path=self.path)
-        trace = dli.read(stream_label=stream_label, ts_range=[int(ts), int(ts+block_size)])
-        res_dict = dli.parse(trace, self.stream_label)
+    def plan_blocks(self): 
+        ''' sample record density with probe reads on the pool and plan blocks of ~target_records '''
+        with self.use_pool() as executor: 
+            def count_func(probes): 
+                futures = [executor.submit(dli_pool.count_records, self.path, self.stream_label, p0, p1) for p0, p1 in probes]
+                return [f.result() for f in futures]
 
-    
-        
-        if self.output_path: 
-            if self.output_type == 'json':
-                output_filename = Path(self.output_path).joinpath(f'{stream_label}[{ts},{ts+block_size}].json')
-                with open (output_filename,'w') as fp:
-                    json.dump(res_dict, fp)
-                
-            elif self.output_type == 'pk':
-                output_filename = Path(self.output_path).joinpath(f'{stream_label}[{ts},{ts+block_size}].pk')
-                with open (output_filename,'wb') as fp:
-                    pickle.dump(res_dict, fp)
-            else:
-                pass
-        
-        return []
+            blocks, segments = adaptive_blocks(self.tsRange, count_func, self.target_records, 
+                                               num_of_probes=self.num_of_probes, 
+                                               probe_width=self.probe_width or max(self.block_size // 10, 1), 
+                                               max_block=self.max_block)
+        return blocks
 
-    def process(self): 
-        dli = PyDli(caseDir=self.path, dliVersion=self.version)
-        dli_dup =  deepcopy(dli)
-        
+    def open_checkpoint(self): 
+        ''' checkpoint of the per-block outputs of this job (None without output files or for a shared store) '''
+        if not self.checkpoint or not self.output_path or self.output_type == 'store': 
+            return None
+        job = {'version': self.version, 'path': str(self.path), 'stream_label': self.stream_label, 
+               'tsRange': [int(t) for t in self.tsRange], 'block_size': self.block_size, 
+               'target_records': self.target_records, 'max_block_records': self.max_block_records, 
+               'output_type': self.output_type, 'extract': self.extract}
+        return Checkpoint(Path(self.output_path).joinpath(f'{self.stream_label}[{job["tsRange"]}]'), job)
+
+    def worker(self, ts, block_size): 
+        ''' read a single block in the current process '''
+        dli_pool.get_dli(self.version, loader=self.loader)
+        return dli_pool.read_block(self.path, self.stream_label, int(ts), int(ts+block_size), 
+                                   output_path=self.output_path, output_type=self.output_type, 
+                                   extract=self.extract)
+
+    def process(self, progress=None): 
+        ''' 
+        read the whole range on the worker pool. 
+        progress(num_of_blocks, num_of_records) is called after every finished block. 
+        With checkpoint=True finished blocks are recorded as they complete and skipped by the next run. 
+        ''' 
         if self.tsRange is None:  
-            dli.loadDli()
-            dli.find_stream_path(self.stream_label, search_path=self.path)
-            self.tsRange = list(dli.DliReader.GetFirstLastKey(str(dli.stream_path)))
-            print(self.tsRange)
+            self.tsRange = self.get_tsrange()
             
-        print(self.tsRange)
-        tRangeList = arange(*self.tsRange, self.block_size )
+        logging.info(f'MP_dli: {self.stream_label} {self.tsRange} on {self.max_workers} workers')
+        if self.target_records: 
+            blocks = self.plan_blocks()
+        else: 
+            # half-open [ts, ts+block_size) blocks, the edge records are read once
+            blocks = list(iter_blocks(self.tsRange, self.block_size))
         
-        # # # # Use ProcessPoolExecutor to execute functions in parallel
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
-            futures =[executor.submit(self.worker, dli_dup, self.stream_label, value, self.block_size) for value in tRangeList]
-            results=[]
-            for future in concurrent.futures.as_completed(futures): 
-                results.extend(future.result())
-
-            # results = [future.result() for future in concurrent.futures.as_completed(futures)]
+        # workers are long-lived: the DLI assembly and stream path are loaded once per process, 
+        # blocks are queued to them (idle workers pull the next one) and the pool is reused by the next call
+        with self.use_pool() as executor: 
+            checkpoint = self.open_checkpoint()
+            def submit(block): 
+                entry = checkpoint.verified(block) if checkpoint else None
+                if entry: 
+                    future = concurrent.futures.Future()
+                    future.set_result({'tsRange': entry['tsRange'], 'records': entry['records'], 'split': None, 
+                                       'file': entry['file'], 'resumed': True})
+                    return future
+                return executor.submit(dli_pool.read_block, self.path, self.stream_label, block[0], block[1], 
+                                       self.output_path, self.output_type, max_records=self.max_block_records, 
+                                       extract=self.extract)
+        
+            num_of_records, num_of_blocks, num_of_splits, max_records = 0, 0, 0, 0
+            finished = []
+            try: 
+                pending = {submit(block) for block in blocks}
+                while pending: 
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done: 
+                        res = future.result()
+                        if res['split']: 
+                            # oversized block: schedule its halves
+                            num_of_splits += 1
+                            pending |= {submit(block) for block in res['split']}
+                        else: 
+                            num_of_blocks += 1
+                            num_of_records += res['records']
+                            max_records = max(max_records, res['records'])
+                            finished.append(res)
+                            if checkpoint and not res.get('resumed') and res['file']: 
+                                checkpoint.add_file(res['tsRange'], res['file'], records=res['records'])
+                            if progress: 
+                                progress(num_of_blocks, num_of_records)
+ 
+                if checkpoint: 
+                    # the block files are kept, and so is their manifest (a new run of the job reuses them) 
+                    checkpoint.finish(remove=False)
+            except BrokenProcessPool: 
+                dli_pool.discard_pool(self.version, self.max_workers, loader=self.loader)
+                raise
+            finally: 
+                if checkpoint: 
+                    checkpoint.close()
         
-        print("All tasks completed.")     
+        logging.info(f'MP_dli: {num_of_blocks} blocks, {num_of_records} records, {num_of_splits} splits')
        
-        return {'Num of records': len(results)}
+        return {'Num of records': num_of_records, 
+                'Num of blocks': num_of_blocks, 
+                'Num of splits': num_of_splits, 
+                'Max block records': max_records, 
+                'Blocks': sorted(finished, key=lambda b: b['tsRange'])}
     
     
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import logging
+from pyDli import dli_pool
+from pyDli.stream_writer import write_stream
+
+
+ALL_STREAMS = 'all'
+
+
+def resolve_stream_labels(dli, stream_labels):
+    ''' 'all' -> every stream of stream2reader.json, a single label -> [label] '''
+    if stream_labels == ALL_STREAMS:
+        return list(dli.stream2reader_)
+    if isinstance(stream_labels, str):
+        return [stream_labels]
+    return list(stream_labels)
+
+
+def write_manifest(manifest, filename):
+    ''' write the manifest atomically (readers never see a partial file) '''
+    filename = Path(filename)
+    tmp_filename = filename.with_name(f'{filename.name}.{os.getpid()}.tmp')
+    with open(tmp_filename, 'w') as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+def read_streams(dli, stream_labels, output_path, output_type='json', ts_range=None, block_size=50000,
+                 max_workers=4, mode='thread', extract=None, block_cache=None, progress=None,
+                 manifest_name='manifest.json', output_name=None, loader=dli_pool.load_pydli):
+    '''
+    Read several streams of one case in a single pass: the case index and the stream paths are
+    resolved once, then the streams are read concurrently by a bounded pool.
+    Args:
+        dli: a loaded PyDli of the case (caseDir set).
+        stream_labels (list or str): stream labels, or 'all' for every stream of stream2reader.json.
+        output_path (str): directory of the outputs and of the manifest.
+        output_type (str): writer of every output (see stream_writer.WRITERS).
+        ts_range (list): [start, end] of every stream, the whole stream if None.
+        block_size (int): timestamps per block (see stream_read).
+        max_workers (int): streams read at the same time.
+        mode (str): 'thread' - the streams share this process's dli (the .NET reads overlap, parsing shares the GIL),
+                    'process' - the streams are read on the dli_pool process pool of dli.dliVersion
+                    (the assembly is loaded once per worker process and the pool is reused).
+        extract (dict): field projection / row filter of every stream (see stream_read).
+        block_cache (callable): block_cache(stream_label) -> StreamCache or None (thread mode only).
+        progress (callable): called as progress(stream_label, entry) when a stream finishes.
+        manifest_name (str): file name of the manifest in output_path.
+        output_name (callable): output_name(stream_label) -> output file name without suffix
+                                (default: '<stream_label>[<ts_range>]').
+    Returns:
+        dict: the manifest, also written to output_path/manifest_name. Every stream has an entry with
+              'status' ('done', 'missing', 'unknown' (not in stream2reader.json) or 'failed'), 'stream_path' and for done streams
+              'output', 'records', 'bytes', 'tsRange' and 'elapsed_sec'.
+    '''
+    t0 = time.perf_counter()
+    output_path = Path(output_path)
+    stream_labels = resolve_stream_labels(dli, stream_labels)
+    output_name = output_name or (lambda stream_label: f'{stream_label}[{ts_range}]')
+    streams = {}
+    jobs = {}
+    for stream_label in stream_labels:
+        if stream_label not in dli.stream2reader_:
+            streams[stream_label] = {'status': 'unknown', 'stream_path': None}
+            continue
+        # one case index lookup per stream, in this thread (find_stream_path updates dli.stream_path)
+        stream_path = dli.find_stream_path(stream_label)
+        streams[stream_label] = {'status': 'missing' if not stream_path else 'pending',
+                                 'stream_path': stream_path or None}
+        if stream_path:
+            jobs[stream_label] = stream_path
+    logging.info(f'read_streams: {len(jobs)} of {len(stream_labels)} streams found, {mode} pool of {max_workers}')
+
+    lock = threading.Lock()
+
+    def finished(stream_label, entry):
+        with lock:
+            streams[stream_label].update(entry)
+        if progress:
+            progress(stream_label, streams[stream_label])
+
+    if mode == 'process':
+        with dli_pool.use_pool(dli.dliVersion, max_workers, loader=loader) as executor:
+            futures = {executor.submit(dli_pool.read_stream, dli.caseDir, stream_label,
+                                       str(output_path.joinpath(output_name(stream_label))), output_type,
+                                       ts_range, block_size, dli.dliVersion, extract): stream_label
+                       for stream_label in jobs}
+            wait_streams(futures, finished)
+    elif mode == 'thread':
+        def read_one(stream_label, stream_path):
+            stream_ts_range = list(ts_range) if ts_range else \
+                [int(k) for k in dli.DliReader.GetFirstLastKey(stream_path)]
+            res = write_stream(dli, stream_label, output_type, output_path.joinpath(output_name(stream_label)),
+                               stream_path=stream_path, ts_range=stream_ts_range, block_size=block_size,
+                               extract=extract, block_cache=block_cache(stream_label) if block_cache else None,
+                               metrics=getattr(dli, 'metrics', None))
+            return dict(res, tsRange=stream_ts_range)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='read_streams') as executor:
+            futures = {executor.submit(read_one, stream_label, stream_path): stream_label
+                       for stream_label, stream_path in jobs.items()}
+            wait_streams(futures, finished)
+    else:
+        raise ValueError(f"unknown mode: {mode} (supported: 'thread', 'process')")
+
+    manifest = {'case': str(dli.caseDir),
+                'version': dli.dliVersion,
+                'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'output_type': output_type,
+                'tsRange': ts_range,
+                'extract': extract or None,
+                'elapsed_sec': round(time.perf_counter() - t0, 3),
+                'streams': streams}
+    manifest['manifest'] = str(write_manifest(manifest, output_path.joinpath(manifest_name)))
+    return manifest
+
+
+def wait_streams(futures, finished):
+    ''' report every stream as it finishes; a failed stream does not stop the others '''
+    for future in concurrent.futures.as_completed(futures):
+        stream_label = futures[future]
+        try:
+            finished(stream_label, dict(future.result(), status='done'))
+        except Exception as e:
+            logging.error(f'read_streams: {stream_label} failed: {e!r}')
+            finished(stream_label, {'status': 'failed', 'error': repr(e)})
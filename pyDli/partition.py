@@ -0,0 +1,107 @@
+import math
+import logging
+
+
+def probe_ranges(ts_range, num_of_probes=16, probe_width=1000):
+    '''
+    Evenly spaced half-open [ts, ts+probe_width) windows over ts_range, used to sample record density.
+    '''
+    start, end = int(ts_range[0]), int(ts_range[1])
+    span = max(end - start, 1)
+    num_of_probes = max(1, min(num_of_probes, span // max(probe_width, 1)))
+    step = span / num_of_probes
+    probes = []
+    for i in range(num_of_probes):
+        center = start + step * (i + 0.5)
+        ts0 = max(start, int(center - probe_width / 2))
+        probes.append((ts0, min(end + 1, ts0 + probe_width)))
+    return probes
+
+
+def density_segments(ts_range, probes, counts):
+    '''
+    Piecewise-constant density model: every probe's density (records per timestamp) holds
+    from the midpoint with the previous probe to the midpoint with the next one.
+    Returns:
+        list: (seg_start, seg_end, density) covering ts_range.
+    '''
+    start, end = int(ts_range[0]), int(ts_range[1])
+    centers = [(p0 + p1) / 2 for p0, p1 in probes]
+    densities = [n / max(p1 - p0, 1) for (p0, p1), n in zip(probes, counts)]
+    bounds = [start] + [int((a + b) / 2) for a, b in zip(centers, centers[1:])] + [end]
+    return [(s, e, d) for s, e, d in zip(bounds, bounds[1:], densities) if e > s]
+
+
+def plan_blocks(ts_range, segments, target_records, min_block=1, max_block=None):
+    '''
+    Cut ts_range into blocks that are each expected to hold about target_records records.
+    Args:
+        ts_range (list): [start, end].
+        segments (list): density model, see density_segments.
+        target_records (int): expected records per block.
+        min_block / max_block (int): bounds on block width in timestamps. max_block keeps
+            blocks bounded in regions the probes saw as empty.
+    Returns:
+        list: [(ts0, ts1)] consecutive half-open blocks covering [start, end], the last one ends at
+              end + 1 (same convention as stream_writer.iter_blocks).
+    '''
+    start, end = int(ts_range[0]), int(ts_range[1]) + 1
+    max_block = max_block or (end - start) or 1
+    cuts = [start]
+    acc = 0.0
+    for seg_start, seg_end, density in segments:
+        pos = seg_start
+        while pos < seg_end:
+            if density <= 0:
+                break
+            span = (target_records - acc) / density
+            if pos + span >= seg_end:
+                acc += density * (seg_end - pos)
+                break
+            cut = max(int(math.ceil(pos + span)), cuts[-1] + min_block)
+            if cut >= end:
+                break
+            cuts.append(cut)
+            acc = 0.0
+            pos = cut
+    cuts.append(end)
+
+    blocks = []
+    for ts0, ts1 in zip(cuts, cuts[1:]):
+        # split blocks wider than max_block evenly
+        n = max(1, int(math.ceil((ts1 - ts0) / max_block)))
+        edges = [ts0 + (ts1 - ts0) * i // n for i in range(n)] + [ts1]
+        blocks.extend((a, b) for a, b in zip(edges, edges[1:]) if b > a)
+    return blocks or [(start, end)]
+
+
+def expected_records(block, segments):
+    ''' Expected number of records in block according to the density model. '''
+    ts0, ts1 = block
+    return sum(d * max(0, min(ts1, e) - max(ts0, s)) for s, e, d in segments)
+
+
+def split_block(block, parts=2):
+    ''' Split an oversized half-open block into equal half-open sub blocks (dynamic splitting while the job runs). '''
+    ts0, ts1 = int(block[0]), int(block[1])
+    edges = [ts0 + (ts1 - ts0) * i // parts for i in range(parts)] + [ts1]
+    return [(a, b) for a, b in zip(edges, edges[1:]) if b > a]
+
+
+def adaptive_blocks(ts_range, count_func, target_records, num_of_probes=16, probe_width=1000,
+                    min_block=1, max_block=None):
+    '''
+    Sample record density with cheap probe reads and plan blocks of ~target_records each,
+    largest expected block first so stragglers start early.
+    Args:
+        count_func (callable): count_func(probes) -> list of record counts, one per probe window.
+    Returns:
+        tuple: (blocks, segments)
+    '''
+    probes = probe_ranges(ts_range, num_of_probes, probe_width)
+    counts = count_func(probes)
+    segments = density_segments(ts_range, probes, counts)
+    blocks = plan_blocks(ts_range, segments, target_records, min_block=min_block, max_block=max_block)
+    blocks.sort(key=lambda b: expected_records(b, segments), reverse=True)
+    logging.info(f'adaptive_blocks: {len(blocks)} blocks of ~{target_records} records from {len(probes)} probes')
+    return blocks, segments
@@ -7,35 +7,42 @@ import sys, os
 import configparser
 import shutil
 import logging
+from pyDli.schema import SchemaCache, read_generic
+from pyDli.trace_view import TraceView
+from common.case_index import CaseIndex, STREAM_SUFFIX
+from common.artifact_cache import ArtifactCache
+from common.instrumentation import Instrumentation, instrumented
+from common import warm_state
+
+# leases of the DLI versions loaded in this process: an assembly cannot be unloaded, its files stay in use until exit
+_assembly_leases = {}
 
 class PyDli(): 
     def __init__(self, caseDir = None, dliVersion=None):
         self.module_dir = Path(__file__).parent
         self.caseDir = caseDir
+        self.stream_path = None
+        self.schema_cache = SchemaCache(array_types=(Array,), tuple_types=(Tuple,))
+        self.metrics = Instrumentation('pyDli')
         self.setup_logging()
 
-        self.config = configparser.ConfigParser()
-        self.config.read(self.module_dir.joinpath('config.ini'))
+        # config / stream2reader / loaded assemblies are kept by the per-process warm state registry across tasks
+        self.config = warm_state.get_registry().config(self.module_dir.joinpath('config.ini'))
         if dliVersion is None: 
             self.dliVersion = self.readCartoVersion(caseDir)
         else: 
             self.dliVersion = dliVersion
         logging.info(f"set dliVersion : {self.dliVersion}")
         
-        with open(self.module_dir.joinpath("stream2reader.json"), 'r') as fp: 
-            self.stream2reader_ = json.load(fp)       
+        self.stream2reader_ = warm_state.get_registry().json_file(self.module_dir.joinpath("stream2reader.json"))
 
 
 
     def setup_logging(self):
         """Set up logging to an external file in the same directory."""
         log_file_path = os.path.join(self.module_dir, 'pyDli.log')
-        logging.basicConfig(
-            filename=log_file_path,
-            level=logging.DEBUG,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
-        logging.info("Logging initialized for pyDli class")
+        if warm_state.setup_logging(log_file_path): 
+            logging.info("Logging initialized for pyDli class")
 
     def readCartoVersion(self, caseDir=None): 
         """ search for 'recording_version.txt' in caseDir and parse carto version  """
@@ -44,14 +51,8 @@ class PyDli():
         else:
             _caseDir = caseDir
 
-        recordingsFile = Path(self.caseDir).rglob('recording_version.txt')
-        for recFile in recordingsFile: 
-            with open(recFile, 'r') as f: 
-                for line in f: 
-                    m = re.findall('WSM Version: (.*)\n',line)
-                    if m: 
-                        return m[0]
-        return False   
+        # the case index walks the directory once and is reused by later lookups
+        return CaseIndex.get(_caseDir).wsm_version or False
 
     def updateDLiPath(self, doCopy=True): 
 
@@ -61,18 +62,25 @@ class PyDli():
         self.remote_dli_path = Path(self.config['DEFAULT']['remote_dli_path']).joinpath( self.dliVersion)
 
         if doCopy: 
-            # copy DLL's to local dst
-            if not(os.path.exists(self.local_dli_path)):
-                # print('copy dli from remote')
-                logging.info('copy dli files')
-                shutil.copytree(self.remote_dli_path, self.local_dli_path)
-                logging.info('dli files were copied')
-
+            # copy DLL's to local dst (once per version, shared and size bounded)
+            max_gb = self.config['DEFAULT'].getfloat('dli_cache_max_gb', 0)
+            cache = ArtifactCache(self.base_local_dli_path, max_bytes=int(max_gb * 2**30) or None)
+            if self.dliVersion not in _assembly_leases: 
+                _assembly_leases[self.dliVersion] = cache.lease(self.dliVersion)
+            self.local_dli_path = cache.fetch(self.dliVersion, self.remote_dli_path)
+
+    @instrumented('loadDli')
     def loadDli(self): 
+        # the assembly of a version is fetched and loaded once per process, later tasks reuse it 
+        self.local_dli_path, self.DliReader = warm_state.get_registry().get(
+            'dli_assembly', self.dliVersion, self.load_assembly, validate=lambda entry: Path(entry[0]).exists())
+        return self.DliReader
+
+    def load_assembly(self): 
         # copy dli directory locally
         self.updateDLiPath()
          # load assambly
-        sys.path.append(str(self.local_dli_path))
+        warm_state.add_sys_path(self.local_dli_path)
         try:
             clr.FindAssembly("DliNetInterface")
             clr.AddReference("DliNetInterface")
@@ -81,23 +89,23 @@ class PyDli():
             logging.error(f'unable to load dLI : {self.local_dli_path}')
             
         from DliNetInterface import DliReader # type: ignore
-        self.DliReader = DliReader
-        return DliReader
+        return self.local_dli_path, DliReader
 
     def stream2reader(self, stream_label): 
         read_func = self.stream2reader_[stream_label]['reader']
         logging.info(f'use {read_func} to read {stream_label}')
         return getattr(self.DliReader, read_func, None)
     
+    @instrumented('find_stream_path')
     def find_stream_path(self, stream_label, search_path=None): 
-        logging.info('find_stream_path: search for stream_path: {stream_label}')
+        logging.info(f'find_stream_path: search for stream_path: {stream_label}')
         # check if stream exists 
         if not search_path: 
             search_path = self.caseDir
 
-        stream_flist = list(Path(search_path).rglob(stream_label + '*.1'))
+        stream_flist = [Path(f) for f in CaseIndex.get(search_path).find_streams(stream_label)]
         num_of_streams = len(stream_flist)
-        logging.info('find_stream_path: find : {num_of_streams} streams of {stream_label}')
+        logging.info(f'find_stream_path: find : {num_of_streams} streams of {stream_label}')
         if not stream_flist: 
             return False
         
@@ -108,30 +116,49 @@ class PyDli():
         self.stream_path = str(stream_flist[0].with_suffix(''))
         return str(stream_flist[0].with_suffix(''))
     
+    def stream_fingerprint(self, stream_label): 
+        ''' (path, size, mtime) of the stream file - changes whenever the recording changes '''
+        stream_path = self.find_stream_path(stream_label)
+        # stat the file itself: the case index is only rebuilt when a directory mtime changes, not on a rewrite in place
+        for path in (stream_path, f'{stream_path}{STREAM_SUFFIX}'): 
+            try: 
+                st = os.stat(path)
+                return [stream_path, st.st_size, st.st_mtime_ns]
+            except OSError: 
+                continue
+        return [stream_path, None, None]
+
     def get_first_last_key(self, stream_label):
         return list(self.DliReader.GetFirstLastKey(self.find_stream_path(stream_label)))
         
 
 
 
-    def read(self, stream_label=None, ts_range=None): 
+    @instrumented('read', count_records=True)
+    def read(self, stream_label=None, ts_range=None, stream_path=None): 
         '''
         Contract a DLI reading function. if not exact define search for "similar" function. 
         e.g. catheterpositions1 -> catheterpositions
+        stream_path can be given explicitly (e.g. resolved once by a worker process) to skip the search. 
         '''
         reading_func = self.stream2reader(stream_label)
-        if not self.stream_path : 
-            self.stream_path =self.find_stream_path(stream_label)
+        if not stream_path: 
+            if not self.stream_path : 
+                self.stream_path =self.find_stream_path(stream_label)
+            stream_path = self.stream_path
 
 
         if ts_range: 
-            return reading_func(self.stream_path, UInt64(ts_range[0]), UInt64(ts_range[1]))
+            return reading_func(stream_path, UInt64(ts_range[0]), UInt64(ts_range[1]))
         else: 
-            return reading_func(self.stream_path)
+            return reading_func(stream_path)
         
-    def parse(self, trace=None, stream_label=None, **kwarg): 
+    @instrumented('parse', count_records=True)
+    def parse(self, trace=None, stream_label=None, fields=None, where=None, stride=1, offset=0): 
         '''
         Contract a parsing function. if not define in json file, use read_generic function. 
+        fields (dotted paths), where (row filter clauses) and stride (keep every stride-th record, counted from offset) 
+        are applied while extracting: unselected fields are never read and rejected records never converted. 
         '''
         if trace and stream_label: 
             # parser_ = self.stream2reader_[stream_label]['parser']
@@ -141,40 +168,28 @@ class PyDli():
             # constract_parser = f'parser.{parser_}'
 
             # parser_func = eval(constract_parser)
-            parser_func = self.read_generic
-            return  [parser_func(x, **kwarg) for x in trace]
+            if fields or where or stride > 1: 
+                return self.schema_cache.extractor(fields, where)(trace, stride, offset)
+            parser_func = self.schema_cache.extract
+            return  [parser_func(x) for x in trace]
             
         else: 
             print('Missing trace and/or stream_label')
             return []
 
-    def read_generic(self, rec): 
-        out = dict()
-        for elem_name in dir(rec): 
-            elem = getattr(rec, elem_name, None)
-            # if not DLI class 
-            if elem_name.startswith('__') or (str(type(elem)) == "<class 'CLR.MethodBinding'>"): 
-                continue
-            if isinstance(elem, Array): 
-                lst = []
-                for l in elem : 
-                    if 'DliNetInterface' in str(type(l)): 
-                        lst.append(self.read_generic(l))
-                    else: 
-                        lst.append(l)
-                out[elem_name] = lst
-            elif isinstance(elem, Tuple): 
-                pass
-            elif 'DliNetInterface' in str(type(elem)): 
-                out[elem_name] =self.read_generic(elem)
-            else:  
-                out[elem_name] = elem    
-
-        return out    
-   
-
-
+    def view(self, stream_label, **kwargs): 
+        '''
+        Lazy TraceView of a stream: blocks are read and parsed only when a slice / iteration / column needs them. 
+        e.g. dli.view('tracettalgupdate2', ts_field='Timestamp')[ts0:ts1] 
+        '''
+        return TraceView(self, stream_label, **kwargs)
 
+    def read_generic(self, rec): 
+        '''
+        Reflective record -> dict conversion (dir() + getattr on every record). 
+        parse() uses the compiled per-type extractors of self.schema_cache instead, which give the same output. 
+        '''
+        return read_generic(rec, array_types=(Array,), tuple_types=(Tuple,))
 
     def __repr__(self):
         repr_dict = {a: str(getattr(self,a)) for a in dir(self) if not a.startswith('__') and not callable(getattr(self, a))}
@@ -0,0 +1,128 @@
+import os
+import json
+import zlib
+import pickle
+import hashlib
+import threading
+from pathlib import Path
+import logging
+
+
+class ResultCache():
+    '''
+    Content-addressed cache of parsed DLI blocks on the local disk.
+    A block is stored under a key built from the stream fingerprint (path, size, mtime),
+    stream label, DLI version and the block-aligned time range, so repeated and overlapping
+    dli_read requests only read + parse the blocks that are not cached yet.
+    Files are zlib-compressed pickles; least recently used blocks are evicted above max_bytes.
+    '''
+
+    def __init__(self, root, max_bytes=None, compress_level=1):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return self.root.joinpath(key[:2], key + '.pkz')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fp:
+                records = pickle.loads(zlib.decompress(fp.read()))
+            # mtime is the last use time for LRU eviction
+            os.utime(path)
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return records
+
+    def put(self, key, records):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = zlib.compress(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL), self.compress_level)
+        tmp_path = path.with_suffix(f'.{os.getpid()}-{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+        self.evict()
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(f.stat().st_size for f in self.root.glob('*/*.pkz'))
+            return self._size
+
+    def evict(self):
+        ''' remove least recently used blocks until the cache fits in max_bytes '''
+        if not self.max_bytes or self.size() <= self.max_bytes:
+            return 0
+        files = sorted(((f.stat().st_mtime, f.stat().st_size, f) for f in self.root.glob('*/*.pkz')), key=lambda f: f[0])
+        total = sum(size for _, size, _ in files)
+        # evict down to 90% so the scan does not run on every put
+        target = self.max_bytes * 0.9
+        removed = 0
+        for mtime, size, f in files:
+            if total <= target:
+                break
+            f.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        with self._lock:
+            self._size = total
+        logging.info(f'result cache: evicted {removed} blocks ({total} bytes left)')
+        return removed
+
+    def for_stream(self, fingerprint, stream_label, dli_version, extract=None):
+        return StreamCache(self, fingerprint, stream_label, dli_version, extract)
+
+    def metrics(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class StreamCache():
+    ''' ResultCache view of one stream; blocks are addressed by their aligned, half-open [ts0, ts1) range '''
+    # bumped when the content of a cached block changes (2: half-open blocks, no shared edge records)
+    key_version = 2
+
+    def __init__(self, cache, fingerprint, stream_label, dli_version, extract=None):
+        self.cache = cache
+        self.prefix = (self.key_version, fingerprint, stream_label, dli_version)
+        if extract:
+            # projected / filtered blocks are cached apart from the full blocks
+            self.prefix += (extract,)
+
+    def key(self, ts0, ts1):
+        return self.cache.make_key(*self.prefix, int(ts0), int(ts1))
+
+    def get(self, ts0, ts1):
+        return self.cache.get(self.key(ts0, ts1))
+
+    def put(self, ts0, ts1, records):
+        self.cache.put(self.key(ts0, ts1), records)
+
+
+_caches = {}
+
+
+def get_result_cache(config):
+    ''' process wide ResultCache configured by the [DEFAULT] result_cache_* keys of a pyDli config '''
+    root = config['DEFAULT'].get('result_cache_path')
+    if not root:
+        return None
+    if root not in _caches:
+        max_gb = config['DEFAULT'].getfloat('result_cache_max_gb', 0)
+        _caches[root] = ResultCache(root, max_bytes=int(max_gb * 2**30) or None)
+    return _caches[root]
@@ -0,0 +1,273 @@
+import json
+import operator
+from operator import attrgetter
+import logging
+
+
+def is_dli_type(tp):
+    ''' True for DliNetInterface record classes (nested records that should be converted to dict). '''
+    return 'DliNetInterface' in str(tp)
+
+
+def is_method_type(tp):
+    return str(tp) == "<class 'CLR.MethodBinding'>"
+
+
+def read_generic(rec, array_types=(), tuple_types=()):
+    '''
+    Reflective record -> dict conversion: dir() + getattr + type string checks on every record.
+    Kept as the reference implementation of SchemaCache.extract.
+    '''
+    out = dict()
+    for elem_name in dir(rec):
+        elem = getattr(rec, elem_name, None)
+        # if not DLI class
+        if elem_name.startswith('__') or is_method_type(type(elem)):
+            continue
+        if isinstance(elem, array_types):
+            lst = []
+            for l in elem:
+                if is_dli_type(type(l)):
+                    lst.append(read_generic(l, array_types, tuple_types))
+                else:
+                    lst.append(l)
+            out[elem_name] = lst
+        elif isinstance(elem, tuple_types):
+            pass
+        elif is_dli_type(type(elem)):
+            out[elem_name] = read_generic(elem, array_types, tuple_types)
+        else:
+            out[elem_name] = elem
+
+    return out
+
+
+# field kinds of a compiled record schema
+SCALAR, NESTED, ARRAY, DYNAMIC = 'scalar', 'nested', 'array', 'dynamic'
+
+
+def field_tree(fields):
+    '''
+    Dotted field paths -> hashable projection tree: ((name, subtree or None), ...), sorted by name.
+    None selects the whole field, e.g. ['Timestamp', 'Location.X'] -> (('Location', (('X', None),)), ('Timestamp', None))
+    '''
+    if not fields:
+        return None
+    tree = {}
+    for path in fields:
+        node = tree
+        names = path.split('.')
+        for i, name in enumerate(names):
+            if i == len(names) - 1 or node.get(name, {}) is None:
+                # a whole field wins over its sub fields
+                node[name] = None
+                break
+            node = node.setdefault(name, {})
+
+    def freeze(node):
+        return tuple((name, None if sub is None else freeze(sub)) for name, sub in sorted(node.items()))
+    return freeze(tree)
+
+
+class RowFilter():
+    '''
+    Predicate on raw (unconverted) records, so rejected records are never converted.
+    Args:
+        where (dict or list): {'field': 'Location.X', 'op': '>', 'value': 0.5} clause(s), all must hold.
+            op is one of ==, !=, >, >=, <, <=, in, not in.
+    '''
+    OPS = {'==': operator.eq, '!=': operator.ne, '>': operator.gt, '>=': operator.ge,
+           '<': operator.lt, '<=': operator.le,
+           'in': lambda a, b: a in b, 'not in': lambda a, b: a not in b}
+
+    def __init__(self, where):
+        clauses = [where] if isinstance(where, dict) else list(where)
+        self.clauses = []
+        for clause in clauses:
+            if clause['op'] not in self.OPS:
+                raise ValueError(f"unknown filter op: {clause['op']} (supported: {list(self.OPS)})")
+            value = clause['value']
+            if clause['op'] in ('in', 'not in'):
+                value = set(value)
+            self.clauses.append((attrgetter(clause['field']), self.OPS[clause['op']], value))
+
+    def __call__(self, rec):
+        for getter, op, value in self.clauses:
+            try:
+                if not op(getter(rec), value):
+                    return False
+            except (AttributeError, TypeError):
+                return False
+        return True
+
+
+class RecordExtractor():
+    '''
+    Converts a trace (list of raw records) with the field projection and row filter of a SchemaCache.extractor.
+    stride keeps every stride-th record, counted from offset (the number of records before this trace),
+    so consecutive traces of a stream are decimated continuously. Skipped records are never converted.
+    '''
+
+    def __init__(self, cache, tree=None, row_filter=None):
+        self.cache = cache
+        self.tree = tree
+        self.row_filter = row_filter
+
+    def __call__(self, trace, stride=1, offset=0):
+        stride = max(int(stride or 1), 1)
+        if stride > 1:
+            trace = trace[(-offset) % stride::stride] if isinstance(trace, list) else \
+                [rec for i, rec in enumerate(trace, offset) if i % stride == 0]
+        extract, tree = self.cache.extract, self.tree
+        if self.row_filter is None:
+            return [extract(rec, tree) for rec in trace]
+        row_filter = self.row_filter
+        return [extract(rec, tree) for rec in trace if row_filter(rec)]
+
+
+class RecordSchema():
+    '''
+    Compiled extractor of a single record type: the attribute list is resolved once and every
+    record is converted with one attrgetter call plus a converter per nested/array field.
+    With a projection tree only the selected fields are read (and only their selected sub fields).
+    '''
+
+    def __init__(self, rec_type, fields, cache, tree=None):
+        self.rec_type = rec_type
+        self.fields = fields
+        self.names = [name for name, kind in fields]
+        self.getter = attrgetter(*self.names) if len(self.names) > 1 else None
+        subtrees = dict(tree or ())
+        self.converters = [(name, cache.converter(kind, subtrees.get(name))) for name, kind in fields
+                           if kind != SCALAR]
+        self.cache = cache
+
+    def values(self, rec):
+        if self.getter is not None:
+            try:
+                return self.getter(rec)
+            except AttributeError:
+                pass
+        return [getattr(rec, name, None) for name in self.names]
+
+    def __call__(self, rec):
+        out = dict(zip(self.names, self.values(rec)))
+        for name, convert in self.converters:
+            out[name] = convert(out[name])
+        return out
+
+    def __repr__(self):
+        return f'RecordSchema({self.rec_type.__name__}, {dict(self.fields)})'
+
+
+class SchemaCache():
+    '''
+    Per record type cache of compiled extractors.
+    The first record of a type is introspected (dir + type checks) and compiled into a RecordSchema,
+    all later records of that type skip the reflection. Output is identical to read_generic.
+    Args:
+        array_types (tuple): types handled as arrays (System.Array for the .NET reader).
+        tuple_types (tuple): types that are skipped (System.Tuple for the .NET reader).
+    '''
+
+    def __init__(self, array_types=(), tuple_types=()):
+        self.array_types = tuple(array_types)
+        self.tuple_types = tuple(tuple_types)
+        self.schemas = {}
+        self.extractors = {}
+        self._is_dli = {}
+
+    def is_dli(self, tp):
+        try:
+            return self._is_dli[tp]
+        except KeyError:
+            res = self._is_dli[tp] = is_dli_type(tp)
+            return res
+
+    def kind_of(self, elem):
+        if isinstance(elem, self.array_types):
+            return ARRAY
+        if isinstance(elem, self.tuple_types):
+            return None
+        if elem is None:
+            return DYNAMIC
+        if self.is_dli(type(elem)):
+            return NESTED
+        return SCALAR
+
+    def compile(self, rec, tree=None):
+        fields = []
+        if tree is None:
+            names = [name for name in dir(rec) if not name.startswith('__')]
+        else:
+            names = [name for name, sub in tree]
+            missing = [name for name in names if not hasattr(rec, name)]
+            if missing:
+                logging.warning(f'{type(rec).__name__} has no fields {missing}')
+        for elem_name in names:
+            elem = getattr(rec, elem_name, None)
+            if is_method_type(type(elem)):
+                continue
+            kind = self.kind_of(elem)
+            if kind is not None:
+                fields.append((elem_name, kind))
+        key = type(rec) if tree is None else (type(rec), tree)
+        schema = self.schemas[key] = RecordSchema(type(rec), fields, self, tree)
+        logging.debug(f'compiled {schema}')
+        return schema
+
+    def converter(self, kind, tree=None):
+        if kind == NESTED:
+            convert = self.convert_nested
+        elif kind == ARRAY:
+            convert = self.convert_array
+        else:
+            convert = self.convert_dynamic
+        if tree is None:
+            return convert
+        return lambda elem: convert(elem, tree)
+
+    def convert_nested(self, elem, tree=None):
+        if elem is None:
+            return None
+        return self.extract(elem, tree)
+
+    def convert_array(self, elem, tree=None):
+        if not isinstance(elem, self.array_types):
+            return self.convert_dynamic(elem, tree)
+        # arrays are homogeneous, so the element type is checked once per array
+        for first in elem:
+            if self.is_dli(type(first)):
+                return [self.extract(l, tree) for l in elem]
+            break
+        return list(elem)
+
+    def convert_dynamic(self, elem, tree=None):
+        # field was None (or changed type) when the schema was compiled
+        if elem is None:
+            return None
+        if isinstance(elem, self.array_types):
+            return self.convert_array(elem, tree)
+        if self.is_dli(type(elem)):
+            return self.extract(elem, tree)
+        return elem
+
+    def extract(self, rec, tree=None):
+        try:
+            schema = self.schemas[type(rec) if tree is None else (type(rec), tree)]
+        except KeyError:
+            schema = self.compile(rec, tree)
+        return schema(rec)
+
+    def extractor(self, fields=None, where=None):
+        '''
+        RecordExtractor of a trace that reads only the given dotted fields (all fields if None) of
+        the records passing the where filter (see RowFilter).
+        '''
+        key = (field_tree(fields), json.dumps(where, sort_keys=True) if where else None)
+        if key not in self.extractors:
+            self.extractors[key] = RecordExtractor(self, key[0], RowFilter(where) if where else None)
+        return self.extractors[key]
+
+    def __call__(self, rec):
+        return self.extract(rec)
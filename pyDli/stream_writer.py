@@ -0,0 +1,311 @@
+import json
+import math
+import pickle
+import struct
+import time
+from functools import partial
+from pathlib import Path
+import logging
+from pyDli.columnar import ColumnarWriter
+from pyDli.trace_store import TraceStoreWriter
+
+
+# footer layout of chunked pickle files: <index offset (uint64)><magic>
+PK_MAGIC = b'DLIPKIDX'
+PK_FOOTER = struct.Struct('<Q8s')
+
+
+def iter_blocks(ts_range, block_size, aligned=False):
+    '''
+    Split [start, end] (both included, like DLI reads) into consecutive half-open [ts, ts+block_size)
+    blocks: a block ends where the next one starts, and the last block ends at end + 1. Read a block
+    with block_read_range(block) so every timestamp belongs to exactly one block.
+    With aligned=True block edges are multiples of block_size (the first block is clipped to start),
+    so overlapping requests share the same blocks.
+    '''
+    start, end = int(ts_range[0]), int(ts_range[1]) + 1
+    block_size = int(block_size)
+    assert block_size > 0, 'block_size must be positive'
+    ts = start
+    while ts < end:
+        ts1 = (ts // block_size + 1) * block_size if aligned else ts + block_size
+        yield ts, min(ts1, end)
+        ts = ts1
+
+
+def block_read_range(block):
+    ''' [ts0, ts1 - 1]: the inclusive DLI read range of a half-open block '''
+    return [int(block[0]), int(block[1]) - 1]
+
+
+def split_range(ts_range, num_of_parts):
+    '''
+    Split [start, end] into up to num_of_parts consecutive, non-overlapping [ts0, ts1] ranges
+    (both included, like ts_range), e.g. the parts of a parallel read.
+    '''
+    part_size = max(math.ceil((int(ts_range[1]) - int(ts_range[0]) + 1) / num_of_parts), 1)
+    return [block_read_range(block) for block in iter_blocks(ts_range, part_size)]
+
+
+class BlockWriter():
+    '''
+    Base class for writers that receive parsed records one block at a time.
+    Sub classes implement _write_block and may extend close.
+    A writer can continue an output from a state() saved after one of its blocks (see pyDli.checkpoint):
+    the file is truncated to that point and the next blocks are appended.
+    '''
+    mode = 'wb'
+    resumable = True
+
+    def __init__(self, filename, resume=None):
+        self.filename = Path(filename)
+        self.num_of_records = 0
+        self.num_of_blocks = 0
+        if resume:
+            with open(self.filename, 'r+b') as fp:
+                fp.truncate(resume['offset'])
+            self.fp = open(self.filename, self.mode.replace('w', 'a'))
+            self.num_of_records = resume['records']
+            self.num_of_blocks = resume['blocks']
+        else:
+            self.fp = open(self.filename, self.mode)
+
+    def state(self):
+        ''' position after the last written block (flushed), to resume from '''
+        self.fp.flush()
+        return {'offset': self.fp.tell(), 'records': self.num_of_records, 'blocks': self.num_of_blocks}
+
+    def write_block(self, records, ts_range=None):
+        self._write_block(records, ts_range)
+        self.num_of_records += len(records)
+        self.num_of_blocks += 1
+
+    def _write_block(self, records, ts_range):
+        raise NotImplementedError
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    @property
+    def bytes_written(self):
+        return self.fp.tell() if not self.fp.closed else self.filename.stat().st_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonArrayWriter(BlockWriter):
+    ''' Writes a single JSON list (same format as the old json.dump output), record by record. '''
+    mode = 'w'
+
+    def __init__(self, filename, resume=None):
+        super().__init__(filename, resume)
+        if resume:
+            self.sep = ', ' if self.num_of_records else ''
+        else:
+            self.fp.write('[')
+            self.sep = ''
+
+    def _write_block(self, records, ts_range):
+        for rec in records:
+            self.fp.write(self.sep)
+            json.dump(rec, self.fp)
+            self.sep = ', '
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.write(']')
+        super().close()
+
+
+class JsonLinesWriter(BlockWriter):
+    ''' One JSON record per line. '''
+    mode = 'w'
+
+    def _write_block(self, records, ts_range):
+        self.fp.writelines(json.dumps(rec) + '\n' for rec in records)
+
+
+class PickleChunkWriter(BlockWriter):
+    '''
+    One pickled list per block, followed by a footer index of
+    (offset, length, num_of_records, ts_range) entries so single blocks can be loaded back.
+    '''
+
+    def __init__(self, filename, resume=None):
+        super().__init__(filename, resume)
+        # (the saved index went through JSON: ts ranges come back as lists)
+        self.index = [(offset, length, num_of_records, tuple(ts_range) if ts_range else ts_range)
+                      for offset, length, num_of_records, ts_range in resume['index']] if resume else []
+
+    def _write_block(self, records, ts_range):
+        offset = self.fp.tell()
+        pickle.dump(records, self.fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.index.append((offset, self.fp.tell() - offset, len(records), ts_range))
+
+    def state(self):
+        return dict(super().state(), index=self.index)
+
+    def close(self):
+        if not self.fp.closed:
+            index_offset = self.fp.tell()
+            pickle.dump(self.index, self.fp, protocol=pickle.HIGHEST_PROTOCOL)
+            self.fp.write(PK_FOOTER.pack(index_offset, PK_MAGIC))
+        super().close()
+
+
+def read_pickle_index(filename):
+    ''' Return the footer index of a file written by PickleChunkWriter. '''
+    with open(filename, 'rb') as fp:
+        fp.seek(-PK_FOOTER.size, 2)
+        index_offset, magic = PK_FOOTER.unpack(fp.read(PK_FOOTER.size))
+        assert magic == PK_MAGIC, f'{filename} is not a chunked pickle file'
+        fp.seek(index_offset)
+        return pickle.load(fp)
+
+
+def read_pickle_chunks(filename, blocks=None):
+    ''' Yield the record lists of a chunked pickle file (all blocks, or the given block numbers). '''
+    index = read_pickle_index(filename)
+    with open(filename, 'rb') as fp:
+        for i, (offset, length, num_of_records, ts_range) in enumerate(index):
+            if blocks is not None and i not in blocks:
+                continue
+            fp.seek(offset)
+            yield pickle.load(fp)
+
+
+WRITERS = {
+    'json': (JsonArrayWriter, '.json'),
+    'jsonl': (JsonLinesWriter, '.jsonl'),
+    'pk': (PickleChunkWriter, '.pk'),
+    'columnar': (partial(ColumnarWriter, fmt='npz'), '.npz'),
+    'columnar_npy': (partial(ColumnarWriter, fmt='npy'), '.npy'),
+    # memory-mapped TraceStore directory, appended to by every writer of the same filename
+    'store': (TraceStoreWriter, '.store'),
+}
+
+
+def get_writer(output_type, filename, resume=None):
+    '''
+    Create a writer for output_type; the matching suffix is appended to filename.
+    resume: state() of a writer of the same output to continue from (resumable writers only).
+    '''
+    if output_type not in WRITERS:
+        raise ValueError(f'unknown output_type: {output_type} (supported: {list(WRITERS)})')
+    writer_cls, suffix = WRITERS[output_type]
+    if resume:
+        return writer_cls(str(filename) + suffix, resume=resume)
+    return writer_cls(str(filename) + suffix)
+
+
+def is_resumable(output_type):
+    writer_cls = WRITERS[output_type][0]
+    return getattr(writer_cls, 'resumable', False)
+
+
+def stream_read(dli, stream_label, writer, ts_range=None, block_size=50000, progress=None, block_cache=None,
+                metrics=None, extract=None, stream_path=None, checkpoint=None):
+    '''
+    Read, parse and write a stream block by block, so peak memory is bounded by block_size
+    rather than by the recording length.
+    Args:
+        dli: a loaded PyDli (or any object with the same read/parse/get_first_last_key methods).
+        stream_label (str): stream to read.
+        writer (BlockWriter): destination of the parsed records.
+        ts_range (list): [start, end] timestamps, whole stream if None.
+        block_size (int): timestamps per block.
+        progress (callable): called as progress(block_num, ts_range, num_of_records) after every block.
+        block_cache (StreamCache): cache of parsed blocks (see pyDli.result_cache). Blocks are then
+            aligned to block_size, full blocks are taken from / added to the cache and only the
+            missing ones (and the partial blocks at the edges of ts_range) are read.
+        metrics (Instrumentation): records the 'serialize' stage (write time, records, bytes).
+        extract (dict): field projection / row filter passed to dli.parse ('fields', 'where', 'stride').
+            The stride is counted over the whole stream. block_cache must be keyed by the same
+            fields / where (see ResultCache.for_stream) and is not used with a stride.
+        stream_path (str): resolved stream file, passed to every dli.read (required when several
+            streams are read concurrently with the same dli).
+        checkpoint (Checkpoint): blocks already in the checkpoint are skipped (writer must be resumed
+            from it, see pyDli.checkpoint.open_output), every written block is added to it.
+    Returns:
+        int: number of records written.
+    '''
+    if not ts_range:
+        ts_range = dli.get_first_last_key(stream_label=stream_label)
+    logging.info(f'stream_read: {stream_label} {ts_range} in blocks of {block_size}')
+
+    extract = {k: v for k, v in (extract or {}).items() if v}
+    if extract.get('stride', 1) > 1:
+        # decimation depends on the records read before each block
+        block_cache = None
+    aligned = block_cache is not None
+    num_read = 0
+    for block_num, block in enumerate(iter_blocks(ts_range, block_size, aligned=aligned)):
+        done = checkpoint.get(block) if checkpoint is not None else None
+        if done:
+            num_read = done['num_read']
+            continue
+        cacheable = aligned and block[1] - block[0] == block_size
+        records = block_cache.get(*block) if cacheable else None
+        if records is None:
+            trace = dli.read(stream_label, ts_range=block_read_range(block), stream_path=stream_path)
+            if extract:
+                records = dli.parse(trace, stream_label=stream_label, offset=num_read, **extract)
+            else:
+                records = dli.parse(trace, stream_label=stream_label)
+            num_read += len(trace) if trace else 0
+            del trace
+            if cacheable:
+                block_cache.put(*block, records)
+        if metrics is not None:
+            with metrics.stage('serialize') as rec:
+                bytes_before = writer.bytes_written
+                writer.write_block(records, block)
+                rec.records, rec.bytes = len(records), writer.bytes_written - bytes_before
+        else:
+            writer.write_block(records, block)
+        del records
+        if checkpoint is not None:
+            checkpoint.add_block(block, writer, num_read=num_read)
+        if progress:
+            progress(block_num, block, writer.num_of_records)
+
+    logging.info(f'stream_read: wrote {writer.num_of_records} records to {writer.filename}')
+    return writer.num_of_records
+
+
+def write_stream(dli, stream_label, output_type, output_filename, stream_path=None, **kwargs):
+    '''
+    stream_read a whole stream (or kwargs['ts_range']) into a new output_type file.
+    Returns:
+        dict: {'output', 'records', 'bytes', 'elapsed_sec'}
+    '''
+    t0 = time.perf_counter()
+    with get_writer(output_type, output_filename) as writer:
+        stream_read(dli, stream_label, writer, stream_path=stream_path, **kwargs)
+    return {'output': str(writer.filename), 'records': writer.num_of_records,
+            'bytes': writer.bytes_written, 'elapsed_sec': round(time.perf_counter() - t0, 3)}
+
+
+def merge_parts(part_files, writer, progress=None, stride=1):
+    '''
+    Append the blocks of chunked pickle part files (in the given order) to writer, one block at a time.
+    Used to merge the per-block outputs of parallel reads into one ordered artifact.
+    stride keeps every stride-th record counted over all the parts, like a serial stream_read with a
+    stride (the parts must then be read without stride and without a row filter).
+    '''
+    stride = max(int(stride or 1), 1)
+    num_read = 0
+    for part_num, part_file in enumerate(part_files):
+        index = read_pickle_index(part_file)
+        for (offset, length, num_of_records, ts_range), records in zip(index, read_pickle_chunks(part_file)):
+            if stride > 1:
+                records, num_read = records[(-num_read) % stride::stride], num_read + len(records)
+            writer.write_block(records, ts_range)
+        if progress:
+            progress(part_num, writer.num_of_records)
+    return writer.num_of_records
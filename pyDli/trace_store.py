@@ -0,0 +1,412 @@
+import json
+import os
+from pathlib import Path
+import logging
+
+import numpy as np
+
+from common.locking import FileLock
+from pyDli.columnar import flatten_record, to_array
+
+
+TS_FIELDS = ('Timestamp', 'TimeStamp', 'timestamp', 'ts')
+
+
+def dtype_to_json(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+
+def dtype_from_json(fields):
+    return np.dtype([(name, base, tuple(shape)) for name, base, shape in fields])
+
+
+def block_columns(records):
+    ''' {column: array} of the flattened records of a block '''
+    flat = [flatten_record(rec) for rec in records]
+    names = dict.fromkeys(name for f in flat for name in f)
+    return {name: to_array([f.get(name) for f in flat]) for name in names}
+
+
+def infer_dtype(columns, warn=True):
+    ''' fixed-width record dtype of a block of columns; object (ragged / mixed / None) columns are left out '''
+    fields, skipped = [], []
+    for name, arr in columns.items():
+        if arr.dtype == object or arr.dtype.kind not in 'biufU':
+            skipped.append(name)
+            continue
+        fields.append((name, arr.dtype.str, arr.shape[1:]))
+    if skipped and warn:
+        logging.warning(f'trace store: variable-width columns are not stored: {skipped}')
+    return np.dtype(fields)
+
+
+def merge_dtype(dtype, columns):
+    '''
+    dtype widened to hold a new block of columns: fixed-width columns the store does not have yet are added,
+    string columns get the longer width, numeric columns the promoted type (int -> float).
+    Raises:
+        ValueError: a column changes between string and number, or its shape.
+    '''
+    fields = {name: (dtype.fields[name][0].base, dtype.fields[name][0].shape) for name in dtype.names}
+    block_dtype = infer_dtype(columns, warn=False)
+    for name in block_dtype.names:
+        base, shape = block_dtype.fields[name][0].base, block_dtype.fields[name][0].shape
+        if name not in fields:
+            fields[name] = (base, shape)
+            continue
+        old_base, old_shape = fields[name]
+        if shape != old_shape or (old_base.kind == 'U') != (base.kind == 'U'):
+            raise ValueError(f'trace store: column {name} changes from {old_base.str}{old_shape} to {base.str}{shape}')
+        if base.kind == 'U':
+            if base.itemsize > old_base.itemsize:
+                fields[name] = (base, shape)
+        else:
+            fields[name] = (np.promote_types(old_base, base), shape)
+    return np.dtype([(name, base, shape) for name, (base, shape) in fields.items()])
+
+
+def fill_missing(values, dtype):
+    ''' None -> NaN for float columns (0 / '' otherwise), so a column with gaps still fits its fixed width '''
+    fill = fill_value(dtype)
+    return [fill if v is None else v for v in values]
+
+
+def fill_value(dtype):
+    return np.nan if dtype.kind in 'fc' else ('' if dtype.kind == 'U' else 0)
+
+
+def to_structured(records, dtype):
+    ''' parsed records -> structured array of dtype '''
+    flat = [flatten_record(rec) for rec in records]
+    out = np.zeros(len(flat), dtype=dtype)
+    for name in dtype.names:
+        field_dtype = dtype.fields[name][0]
+        values = [f.get(name) for f in flat]
+        try:
+            out[name] = np.asarray(values).astype(field_dtype.base, copy=False)
+        except (TypeError, ValueError):
+            out[name] = np.asarray(fill_missing(values, field_dtype)).astype(field_dtype.base)
+    return out
+
+
+class TraceStore():
+    '''
+    On-disk store of one stream of a case: fixed-width records in a single memory-mapped file and
+    a timestamp index, so any [t0, t1] window is found by binary search and read without unpickling.
+
+    Layout of the store directory:
+        meta.json       dtype, ts_field, committed rows and segments (replaced atomically)
+        data-<gen>.bin  records (numpy structured dtype), appended segment by segment
+        index-<gen>.npy sorted (ts, row) index, only built while the data is not globally sorted
+        .lock           writers' lock
+
+    append() can be called from many processes (e.g. MP_dli workers): appends are serialized by a
+    file lock, rows are only visible to readers once meta.json is replaced, so a writer that dies
+    mid-append leaves no partial rows. The dtype is inferred from the first block and widened (the
+    data migrated) when a later block has new columns, longer strings or floats in an int column. Rows whose timestamp falls in the [ts0, ts1] range of a
+    committed segment are already stored and are skipped, so a block appended twice (or blocks
+    sharing their edge timestamp) never duplicate a timestamp. window() returns a zero-copy view
+    of the memory map when the data is sorted by timestamp (appended in time order, or after
+    compact()), otherwise a copy gathered through the index.
+    Args:
+        path (str): store directory, created on the first append.
+        ts_field (str): timestamp column (dotted name of the flattened record); found among
+                        TS_FIELDS if None.
+    '''
+
+    def __init__(self, path, ts_field=None):
+        self.path = Path(path)
+        self.ts_field = ts_field
+        self.meta = None
+        self._data = None
+        self._data_key = None
+        self._index = None
+        self.refresh()
+
+    # ----- metadata
+
+    def lock(self):
+        ''' writers' lock (a new FileLock per call: a FileLock instance is not shared between threads) '''
+        return FileLock(self.path.joinpath('.lock'))
+
+    @property
+    def meta_path(self):
+        return self.path.joinpath('meta.json')
+
+    def data_path(self, generation):
+        return self.path.joinpath(f'data-{generation}.bin')
+
+    def index_path(self, generation):
+        return self.path.joinpath(f'index-{generation}.npy')
+
+    def refresh(self):
+        ''' re-read meta.json (new rows of other writers become visible) '''
+        try:
+            with open(self.meta_path, 'r') as fp:
+                self.meta = json.load(fp)
+        except FileNotFoundError:
+            self.meta = None
+            return self
+        self.ts_field = self.meta['ts_field']
+        self.dtype = dtype_from_json(self.meta['dtype'])
+        return self
+
+    def write_meta(self, meta):
+        tmp_path = self.meta_path.with_name(f'meta.json.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_path, self.meta_path)
+        self.meta = meta
+        self.dtype = dtype_from_json(meta['dtype'])
+
+    def create_meta(self, columns):
+        ts_field = self.ts_field or next((f for f in TS_FIELDS if f in columns), None)
+        if ts_field is None or ts_field not in columns:
+            raise ValueError(f'trace store: no timestamp field ({self.ts_field or TS_FIELDS}) in the records')
+        dtype = infer_dtype(columns)
+        if ts_field not in dtype.names:
+            raise ValueError(f'trace store: timestamp field {ts_field} is not numeric')
+        self.ts_field = ts_field
+        return {'version': 1, 'ts_field': ts_field, 'dtype': dtype_to_json(dtype),
+                'generation': 0, 'rows': 0, 'sorted': True, 'segments': []}
+
+    @property
+    def num_of_records(self):
+        return self.meta['rows'] if self.meta else 0
+
+    def __len__(self):
+        return self.num_of_records
+
+    # ----- writing
+
+    def append(self, records, ts_range=None):
+        '''
+        Append parsed records (one block); safe to call concurrently from several processes.
+        Returns:
+            int: number of records appended.
+        '''
+        if not records:
+            return 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self.lock():
+            self.refresh()
+            columns = block_columns(records)
+            meta = self.meta or self.create_meta(columns)
+            dtype = merge_dtype(dtype_from_json(meta['dtype']), columns)
+            if dtype != dtype_from_json(meta['dtype']):
+                meta = self.migrate(meta, dtype)
+            block = to_structured(records, dtype)
+            ts = block[meta['ts_field']]
+            if len(ts) > 1 and np.any(ts[1:] < ts[:-1]):
+                block = block[np.argsort(ts, kind='stable')]
+                ts = block[meta['ts_field']]
+            covered = self.covered(meta['segments'], ts)
+            if covered.any():
+                # the timestamps of a committed segment are stored already (an overlapping or repeated block)
+                logging.warning(f'trace store: {int(covered.sum())} of {len(block)} rows are already stored, skipped')
+                block, ts = block[~covered], ts[~covered]
+                if not len(block):
+                    return 0
+            row0 = meta['rows']
+            data_path = self.data_path(meta['generation'])
+            with open(data_path, 'ab') as fp:
+                # drop rows of an append that died before committing
+                fp.truncate(row0 * block.dtype.itemsize)
+                fp.write(block.tobytes())
+            ts0, ts1 = ts[0].item(), ts[-1].item()
+            last_ts = max((s[3] for s in meta['segments']), default=None)
+            meta = dict(meta, rows=row0 + len(block),
+                        sorted=meta['sorted'] and (last_ts is None or ts0 >= last_ts),
+                        segments=meta['segments'] + [[row0, len(block), ts0, ts1]])
+            self.write_meta(meta)
+        return len(block)
+
+    def migrate(self, meta, dtype):
+        ''' rewrite the committed rows with the (widened) dtype into a new generation, returns its meta '''
+        old_dtype = dtype_from_json(meta['dtype'])
+        generation = meta['generation'] + 1
+        if meta['rows']:
+            data = np.memmap(self.data_path(meta['generation']), dtype=old_dtype, mode='r', shape=(meta['rows'],))
+            with open(self.data_path(generation), 'wb') as fp:
+                for row0 in range(0, meta['rows'], 1_000_000):
+                    chunk = data[row0:row0 + 1_000_000]
+                    out = np.zeros(len(chunk), dtype=dtype)
+                    for name in dtype.names:
+                        out[name] = chunk[name] if name in old_dtype.names else fill_value(dtype.fields[name][0].base)
+                    fp.write(out.tobytes())
+            del data
+        logging.info(f'trace store: {self.path} migrated to {dtype_to_json(dtype)}')
+        old_generation = meta['generation']
+        meta = dict(meta, dtype=dtype_to_json(dtype), generation=generation)
+        self.close()
+        self.write_meta(meta)
+        self.remove_generation(old_generation)
+        return meta
+
+    def remove_generation(self, generation):
+        for old in (self.data_path(generation), self.index_path(generation)):
+            try:
+                old.unlink(missing_ok=True)
+            except OSError:
+                # still mapped by a reader (Windows), removed by a later compact
+                logging.info(f'trace store: {old} is in use, not removed')
+
+    @staticmethod
+    def covered(segments, ts):
+        ''' mask of the (sorted) timestamps ts that fall in the [ts0, ts1] range of a committed segment '''
+        covered = np.zeros(len(ts), dtype=bool)
+        if not segments or not len(ts):
+            return covered
+        bounds = np.array([s[2:4] for s in segments])
+        for seg_ts0, seg_ts1 in bounds[(bounds[:, 0] <= ts[-1]) & (bounds[:, 1] >= ts[0])]:
+            covered[np.searchsorted(ts, seg_ts0, side='left'):np.searchsorted(ts, seg_ts1, side='right')] = True
+        return covered
+
+    def compact(self):
+        '''
+        rewrite the data sorted by timestamp, after which every window is a zero-copy view.
+        The segments become the merged [ts0, ts1] ranges of the appended blocks (so blocks filling the gaps
+        between them can still be appended) with their rows in the sorted data.
+        '''
+        with self.lock():
+            self.refresh()
+            if not self.meta or self.meta['sorted']:
+                return False
+            data = self.open_data()
+            order = np.argsort(data[self.ts_field], kind='stable')
+            generation = self.meta['generation'] + 1
+            with open(self.data_path(generation), 'wb') as fp:
+                for chunk in np.array_split(order, max(1, len(order) // 1_000_000)):
+                    fp.write(data[chunk].tobytes())
+            sorted_ts = data[self.ts_field][order]
+            ranges = []
+            for seg_ts0, seg_ts1 in sorted(s[2:4] for s in self.meta['segments']):
+                if ranges and seg_ts0 <= ranges[-1][1]:
+                    ranges[-1][1] = max(ranges[-1][1], seg_ts1)
+                else:
+                    ranges.append([seg_ts0, seg_ts1])
+            segments = []
+            for seg_ts0, seg_ts1 in ranges:
+                row0 = int(np.searchsorted(sorted_ts, seg_ts0, side='left'))
+                row1 = int(np.searchsorted(sorted_ts, seg_ts1, side='right'))
+                segments.append([row0, row1 - row0, seg_ts0, seg_ts1])
+            old_generation = self.meta['generation']
+            meta = dict(self.meta, generation=generation, sorted=True, segments=segments)
+            self.close()
+            self.write_meta(meta)
+            self.remove_generation(old_generation)
+            return True
+
+    # ----- reading
+
+    def open_data(self):
+        ''' memory map of the committed rows '''
+        key = (self.meta['generation'], self.meta['rows']) if self.meta else None
+        if key != self._data_key:
+            self.close()
+            if not key or not key[1]:
+                self._data = np.zeros(0, dtype=self.dtype if self.meta else np.float64)
+            else:
+                self._data = np.memmap(self.data_path(key[0]), dtype=self.dtype, mode='r', shape=(key[1],))
+            self._data_key = key
+        return self._data
+
+    def close(self):
+        self._data = None
+        self._data_key = None
+        self._index = None
+
+    def ts_index(self):
+        '''
+        Sorted timestamp index (ts, rows): ts of all rows in ascending order and the row of each.
+        When the data is sorted this is the timestamp column itself (rows None).
+        '''
+        data = self.open_data()
+        if self.meta['sorted']:
+            return data[self.ts_field], None
+        if self._index is not None and len(self._index[0]) == self.meta['rows']:
+            return self._index
+        index_path = self.index_path(self.meta['generation'])
+        try:
+            rows = np.load(index_path, mmap_mode='r')
+            if len(rows) != self.meta['rows']:
+                rows = None
+        except (OSError, ValueError):
+            rows = None
+        if rows is None:
+            rows = np.argsort(data[self.ts_field], kind='stable')
+            tmp_path = index_path.with_name(f'{index_path.stem}.{os.getpid()}.tmp.npy')
+            np.save(tmp_path, rows)
+            os.replace(tmp_path, index_path)
+        self._index = (data[self.ts_field][rows], rows)
+        return self._index
+
+    def rows(self, t0=None, t1=None):
+        ''' rows of [t0, t1]: a slice when the data is sorted, else an array of row numbers '''
+        if not self.meta:
+            return slice(0, 0)
+        ts, rows = self.ts_index()
+        lo = 0 if t0 is None else int(np.searchsorted(ts, t0, side='left'))
+        hi = len(ts) if t1 is None else int(np.searchsorted(ts, t1, side='right'))
+        return slice(lo, hi) if rows is None else rows[lo:hi]
+
+    def window(self, t0=None, t1=None, fields=None):
+        '''
+        Records of [t0, t1] as a structured array (zero-copy view of the memory map when sorted).
+        fields: column names to keep (a view as well).
+        '''
+        self.refresh()
+        if not self.meta:
+            return np.zeros(0)
+        data = self.open_data()
+        out = data[self.rows(t0, t1)]
+        if fields:
+            out = out[list(fields)]
+        return out
+
+    def column(self, name, t0=None, t1=None):
+        ''' one column of [t0, t1] (zero-copy view when sorted) '''
+        return self.window(t0, t1)[name]
+
+    @property
+    def columns(self):
+        return list(self.dtype.names) if self.meta else []
+
+    def info(self):
+        return {'path': str(self.path), 'records': self.num_of_records,
+                'segments': len(self.meta['segments']) if self.meta else 0,
+                'sorted': self.meta['sorted'] if self.meta else True,
+                'ts_field': self.ts_field, 'columns': self.columns}
+
+    def __repr__(self):
+        return f'TraceStore({self.info()})'
+
+
+class TraceStoreWriter():
+    '''
+    Block writer (see pyDli.stream_writer) appending to a TraceStore directory; several writers
+    (processes) can append to the same store.
+    '''
+
+    def __init__(self, filename, ts_field=None):
+        self.filename = Path(filename)
+        self.store = TraceStore(filename, ts_field=ts_field)
+        self.num_of_records = 0
+        self.num_of_blocks = 0
+        self.bytes_written = 0
+
+    def write_block(self, records, ts_range=None):
+        n = self.store.append(records, ts_range)
+        self.num_of_records += n
+        self.num_of_blocks += 1
+        if n:
+            self.bytes_written += n * self.store.dtype.itemsize
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,160 @@
+import bisect
+import threading
+from collections import OrderedDict
+import logging
+from pyDli.stream_writer import iter_blocks, block_read_range
+
+
+def get_path(rec, path):
+    ''' value of a dotted field path ('Location.X') of a parsed record, None if missing '''
+    for name in path.split('.'):
+        if rec is None:
+            return None
+        rec = rec.get(name) if isinstance(rec, dict) else getattr(rec, name, None)
+    return rec
+
+
+class BlockInfo():
+    ''' entry of the sparse timestamp -> block index '''
+    __slots__ = ('ts0', 'ts1', 'num_of_records')
+
+    def __init__(self, ts0, ts1):
+        self.ts0 = ts0
+        self.ts1 = ts1
+        self.num_of_records = None  # unknown until the block is decoded once
+
+    def __repr__(self):
+        return f'BlockInfo({self.ts0}, {self.ts1}, records={self.num_of_records})'
+
+
+class TraceView():
+    '''
+    Lazy view of a stream: only the blocks a query touches are read and parsed, and the last
+    cache_blocks decoded blocks are kept in an LRU, so the latency of a narrow query does not
+    depend on the recording length.
+
+        view = TraceView(dli, 'tracettalgupdate2', block_size=50000)
+        recs = view[1_000_000:1_020_000]           # records of a window
+        recs = view[1_000_000:2_000_000:10]        # every 10th record of a window
+        xs = view.column('Location.X', 1_000_000, 1_020_000)
+        for rec in view.iter(ts0, ts1): ...        # streams block by block
+
+    Args:
+        dli: a loaded PyDli (or any object with the same read/parse/get_first_last_key methods).
+        stream_label (str): stream to view.
+        block_size (int): timestamps per block; blocks are aligned to multiples of block_size.
+        cache_blocks (int): decoded blocks kept in memory.
+        ts_field (str): timestamp field of the parsed records. When given, windows are cut at the exact
+            timestamps; otherwise whole blocks are returned.
+        ts_range (list): [start, end] of the view, the whole stream if None.
+    '''
+
+    def __init__(self, dli, stream_label, block_size=50000, cache_blocks=8, ts_field=None, ts_range=None):
+        self.dli = dli
+        self.stream_label = stream_label
+        self.block_size = int(block_size)
+        self.cache_blocks = max(1, int(cache_blocks))
+        self.ts_field = ts_field
+        self.stream_path = dli.find_stream_path(stream_label)
+        self.ts_range = list(ts_range) if ts_range else dli.get_first_last_key(stream_label)
+        self.index = [BlockInfo(ts0, ts1) for ts0, ts1 in iter_blocks(self.ts_range, self.block_size, aligned=True)]
+        self.starts = [b.ts0 for b in self.index]
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        logging.info(f'TraceView: {stream_label} {self.ts_range} in {len(self.index)} blocks of {self.block_size}')
+
+    def block_of(self, ts):
+        ''' number of the block that holds timestamp ts (clipped to the view) '''
+        return min(max(bisect.bisect_right(self.starts, ts) - 1, 0), len(self.index) - 1)
+
+    def blocks_of(self, ts0=None, ts1=None):
+        ''' block numbers overlapping [ts0, ts1] '''
+        ts0 = self.ts_range[0] if ts0 is None else max(ts0, self.ts_range[0])
+        ts1 = self.ts_range[1] if ts1 is None else min(ts1, self.ts_range[1])
+        if ts1 < ts0:
+            return range(0)
+        return range(self.block_of(ts0), self.block_of(ts1) + 1)
+
+    def timestamps(self, records):
+        return [rec[self.ts_field] for rec in records]
+
+    def decode(self, block_num):
+        info = self.index[block_num]
+        # blocks are half-open, the edge timestamp belongs to the next block
+        trace = self.dli.read(self.stream_label, ts_range=block_read_range((info.ts0, info.ts1)),
+                              stream_path=self.stream_path)
+        records = self.dli.parse(trace, stream_label=self.stream_label)
+        info.num_of_records = len(records)
+        return records
+
+    def get_block(self, block_num):
+        ''' parsed records of a block (from the LRU, or read and parsed) '''
+        with self.lock:
+            records = self.cache.get(block_num)
+            if records is not None:
+                self.cache.move_to_end(block_num)
+                self.hits += 1
+                return records
+            self.misses += 1
+        records = [] if self.index[block_num].num_of_records == 0 else self.decode(block_num)
+        with self.lock:
+            self.cache[block_num] = records
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        return records
+
+    def iter_blocks(self, ts0=None, ts1=None):
+        ''' yield the (clipped) record list of every block overlapping [ts0, ts1] '''
+        for block_num in self.blocks_of(ts0, ts1):
+            records = self.get_block(block_num)
+            if self.ts_field and records:
+                ts = self.timestamps(records)
+                lo = 0 if ts0 is None else bisect.bisect_left(ts, ts0)
+                hi = len(ts) if ts1 is None else bisect.bisect_right(ts, ts1)
+                if lo or hi < len(ts):
+                    records = records[lo:hi]
+            yield records
+
+    def iter(self, ts0=None, ts1=None, step=1):
+        ''' yield the records of [ts0, ts1] (every step-th record), one block in memory at a time '''
+        n = 0
+        for records in self.iter_blocks(ts0, ts1):
+            if step == 1:
+                yield from records
+                continue
+            # keep the stride continuous across blocks
+            yield from records[(-n) % step::step]
+            n += len(records)
+
+    def __iter__(self):
+        return self.iter()
+
+    def window(self, ts0=None, ts1=None, step=1):
+        ''' list of the records of [ts0, ts1] '''
+        return list(self.iter(ts0, ts1, step))
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('TraceView is indexed by timestamp slices, e.g. view[ts0:ts1]')
+        return self.window(key.start, key.stop, key.step or 1)
+
+    def column(self, field, ts0=None, ts1=None, step=1):
+        ''' values of a (dotted) field over [ts0, ts1] '''
+        return [get_path(rec, field) for rec in self.iter(ts0, ts1, step)]
+
+    def project(self, fields, ts0=None, ts1=None, step=1):
+        ''' records of [ts0, ts1] reduced to the given (dotted) fields '''
+        return [{field: get_path(rec, field) for field in fields} for rec in self.iter(ts0, ts1, step)]
+
+    def num_of_records(self):
+        ''' records of the blocks decoded so far (None for blocks not decoded yet) '''
+        return [b.num_of_records for b in self.index]
+
+    def cache_info(self):
+        return {'blocks': len(self.index), 'cached': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
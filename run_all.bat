@@ -1,6 +1,15 @@
 @echo off
-REM Start Celery worker
-start cmd /k "uv run celery -A celery_tasks worker --pool=threads --loglevel=info --concurrency=8 -E"
+REM Start one Celery worker per queue (see common/routing.py), so short tasks never wait behind long ones
+REM   light: add / echo                      threads, 8 slots
+REM   io:    PHT runs and batches, parallel read orchestrators   threads, 8 slots, no prefetch
+REM   parse: DLI reads and read parts        prefork, one process per core
+REM   heavy: large DLI reads                 prefork, 2 processes, no prefetch
+REM prefork worker processes on Windows (billiard)
+set FORKED_BY_MULTIPROCESSING=1
+start cmd /k "uv run celery -A celery_tasks worker -Q light -n light@%%h --pool=threads --concurrency=8 --loglevel=info -E"
+start cmd /k "uv run celery -A celery_tasks worker -Q io -n io@%%h --pool=threads --concurrency=8 --prefetch-multiplier=1 --loglevel=info -E"
+start cmd /k "uv run celery -A celery_tasks worker -Q parse -n parse@%%h --pool=prefork --concurrency=%NUMBER_OF_PROCESSORS% --loglevel=info -E"
+start cmd /k "uv run celery -A celery_tasks worker -Q heavy -n heavy@%%h --pool=prefork --concurrency=2 --prefetch-multiplier=1 --max-memory-per-child=16000000 --loglevel=info -E"
 
 REM Start Flower monitoring tool
-start cmd /k "uv run celery -A celery_tasks flower --port=5555  --basic-auth=liron:123"
+start cmd /k "uv run celery -A celery_app flower --port=5555  --basic-auth=liron:123"
@@ -1,3 +1,11 @@
 @echo off
-REM Batch file to start the Celery worker
-uv run celery -A celery_tasks worker --pool=threads --loglevel=info --concurrency=8 -E
+REM Batch file to start the Celery worker of one queue (see common/routing.py)
+REM Usage: run_celery_worker.bat [light|io|parse|heavy]   (default: light)
+set QUEUE=%1
+if "%QUEUE%"=="" set QUEUE=light
+set FORKED_BY_MULTIPROCESSING=1
+if "%QUEUE%"=="light" set POOL_ARGS=--pool=threads --concurrency=8
+if "%QUEUE%"=="io" set POOL_ARGS=--pool=threads --concurrency=8 --prefetch-multiplier=1
+if "%QUEUE%"=="parse" set POOL_ARGS=--pool=prefork --concurrency=%NUMBER_OF_PROCESSORS%
+if "%QUEUE%"=="heavy" set POOL_ARGS=--pool=prefork --concurrency=2 --prefetch-multiplier=1 --max-memory-per-child=16000000
+uv run celery -A celery_tasks worker -Q %QUEUE% -n %QUEUE%@%%h %POOL_ARGS% --loglevel=info -E
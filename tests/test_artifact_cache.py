@@ -0,0 +1,57 @@
+'''
+Artifact cache: least recently used entries are evicted above max_bytes, except the leased ones
+(a loaded DLI version, a running PHTester); a lease left by a dead process does not protect an entry.
+'''
+import pytest
+from common.artifact_cache import ArtifactCache
+
+SIZE = 1000
+
+
+@pytest.fixture
+def remote(tmp_path):
+    ''' remote repository with versions v1..v3 of SIZE bytes each '''
+    root = tmp_path / 'remote'
+    for version in ['v1', 'v2', 'v3']:
+        (root / version / 'bin').mkdir(parents=True)
+        (root / version / 'bin' / 'tool.dll').write_bytes(version.encode() * (SIZE // 2))
+    return root
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ArtifactCache(tmp_path / 'local', max_bytes=2 * SIZE)
+
+
+def test_lru_eviction(cache, remote):
+    for version in ['v1', 'v2', 'v1', 'v3']:
+        cache.fetch(version, remote / version)
+    assert not cache.entry_path('v2').exists()
+    assert cache.entry_path('v1').exists() and cache.entry_path('v3').exists()
+    assert cache.metrics() == {'hits': 1, 'misses': 3, 'evictions': 1, 'bytes_fetched': 3 * SIZE}
+
+
+def test_leased_entry_is_not_evicted(cache, remote):
+    with cache.lease('v1'):
+        for version in ['v1', 'v2', 'v3']:
+            cache.fetch(version, remote / version)
+        # v1 is the least recently used one, but in use
+        assert cache.entry_path('v1').exists() and cache.is_valid('v1')
+        assert not cache.entry_path('v2').exists()
+        assert cache.is_leased('v1')
+    assert not cache.is_leased('v1')
+    cache.fetch('v2', remote / 'v2')
+    assert not cache.entry_path('v1').exists()
+
+
+def test_stale_lease(cache, remote):
+    cache.fetch('v1', remote / 'v1')
+    leases_dir = cache.leases_dir('v1')
+    leases_dir.mkdir(parents=True)
+    # lease file of a process that died without releasing it: its lock is free
+    (leases_dir / '12345-dead').touch()
+    assert not cache.is_leased('v1')
+    assert list(leases_dir.iterdir()) == []
+    for version in ['v2', 'v3']:
+        cache.fetch(version, remote / version)
+    assert not cache.entry_path('v1').exists()
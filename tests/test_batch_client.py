@@ -0,0 +1,128 @@
+'''
+BatchClient with an eager Celery app (tasks run in the calling thread) and with stub results:
+bounded in-flight tasks, retries with backoff, timeout -> revoke, and the group mode.
+'''
+import threading
+import pytest
+from celery import Celery
+from batch_client import BatchClient
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = Celery('batch_test', broker='memory://', backend='cache+memory://')
+    app.conf.task_always_eager = True
+    calls = {}
+
+    @app.task(name='tasks.add')
+    def add(x, y):
+        return x + y
+
+    @app.task(name='tasks.flaky')
+    def flaky(key, failures):
+        # fails the first `failures` calls of key
+        calls[key] = calls.get(key, 0) + 1
+        if calls[key] <= failures:
+            raise RuntimeError(f'{key} attempt {calls[key]} failed')
+        return calls[key]
+
+    return app
+
+
+def test_eager_jobs(app):
+    jobs = [{'id': f'job{i}', 'task': 'tasks.add', 'args': [i, 1]} for i in range(5)]
+    summary = BatchClient(app, poll_interval=0.01).run(jobs)
+    assert summary['succeeded'] == 5 and summary['retries'] == 0
+    assert [job['result'] for job in summary['jobs']] == [1, 2, 3, 4, 5]
+
+
+def test_retries_with_backoff(app):
+    jobs = [{'id': 'twice', 'task': 'tasks.flaky', 'args': ['twice', 2]},
+            {'id': 'always', 'task': 'tasks.flaky', 'args': ['always', 100]}]
+    summary = BatchClient(app, retries=2, backoff=0.01, poll_interval=0.01).run(jobs)
+    twice, always = summary['jobs']
+    assert twice['state'] == 'SUCCESS' and twice['attempts'] == 3 and twice['result'] == 3
+    assert always['state'] == 'FAILURE' and always['attempts'] == 3 and 'failed' in always['error']
+    assert summary['failed_ids'] == ['always'] and summary['retries'] == 4
+
+
+def test_group_mode(app):
+    jobs = [{'id': f'job{i}', 'task': 'tasks.add', 'args': [i, i]} for i in range(4)]
+    summary = BatchClient(app, poll_interval=0.01).run_group(jobs)
+    assert summary['succeeded'] == 4
+    assert [job['result'] for job in summary['jobs']] == [0, 2, 4, 6]
+
+
+class StubResult():
+    ''' result that is ready after `polls` ready() calls (never with polls=None) '''
+
+    def __init__(self, app, polls):
+        self.app = app
+        self.id = f'stub{len(app.results)}'
+        self.polls = polls
+        self.state = 'PENDING'
+        self.result = 'done'
+        self.revoked = None
+
+    def ready(self):
+        if self.polls is None:
+            return False
+        self.polls -= 1
+        if self.polls > 0:
+            return False
+        with self.app.lock:
+            if self.state != 'SUCCESS':
+                self.app.in_flight -= 1
+            self.state = 'SUCCESS'
+        return True
+
+    def failed(self):
+        return False
+
+    def revoke(self, terminate=False):
+        self.revoked = terminate
+        with self.app.lock:
+            self.app.in_flight -= 1
+
+
+class StubApp():
+    ''' app.signature(...).apply_async() -> StubResult, counting the tasks in flight '''
+
+    def __init__(self, polls=3):
+        self.polls = polls
+        self.results = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def signature(self, name, args=(), kwargs=None, **options):
+        app = self
+
+        class Signature():
+            def apply_async(self):
+                with app.lock:
+                    app.in_flight += 1
+                    app.max_in_flight = max(app.max_in_flight, app.in_flight)
+                    result = StubResult(app, app.polls)
+                    app.results.append(result)
+                return result
+        return Signature()
+
+
+def test_bounded_in_flight():
+    app = StubApp(polls=3)
+    jobs = [{'id': f'job{i}', 'task': 'tasks.stub'} for i in range(12)]
+    summary = BatchClient(app, max_in_flight=3, poll_interval=0.001).run(jobs)
+    assert summary['succeeded'] == 12
+    assert app.max_in_flight == 3
+
+
+def test_timeout_revokes_before_retry():
+    app = StubApp(polls=None)
+    jobs = [{'id': 'stuck', 'task': 'tasks.stub'}]
+    summary = BatchClient(app, retries=1, backoff=0.001, poll_interval=0.001, timeout=0.02).run(jobs)
+    record = summary['jobs'][0]
+    assert record['state'] == 'FAILURE' and record['attempts'] == 2 and 'revoked' in record['error']
+    assert [result.revoked for result in app.results] == [True, True]
+    # the first attempt was revoked before the retry was sent
+    assert app.max_in_flight == 1 and app.in_flight == 0
@@ -0,0 +1,40 @@
+'''
+Fake DliReader (deterministic records at a fixed rate) and the benchmark baseline: a run with
+--update-baseline is appended to the baseline file and the next run is compared with it.
+'''
+import json
+from pyDli.fake_dli import FakeDli, FakeDliReader
+from benchmarks import run_benchmarks
+
+
+def test_fake_reader_range():
+    reader = FakeDliReader(first_last_key=(0, 1000), period=100)
+    assert reader.GetFirstLastKey('stream') == [0, 1000]
+    assert [rec.Timestamp for rec in reader.read_range('stream', 150, 2000)] == [200, 300, 400, 500, 600, 700, 800, 900, 1000]
+    assert len(reader.read_range('stream')) == 11
+
+
+def test_fake_records_are_deterministic():
+    dli = FakeDli(first_last_key=(0, 999), period=1)
+    label = next(iter(dli.stream2reader_))
+    assert all(dli.stream2reader(name) is not None for name in dli.stream2reader_)
+    whole = dli.parse(dli.read(label, ts_range=[0, 999]), label)
+    parts = [rec for ts0 in range(0, 1000, 250) for rec in dli.parse(dli.read(label, ts_range=[ts0, ts0 + 249]), label)]
+    assert len(whole) == 1000 and parts == whole
+    assert len(whole[0]['Electrodes']) == 4 and len(whole[0]['Weights']) == 16
+
+
+def test_baseline_runs(tmp_path, capsys):
+    baseline = tmp_path / 'baseline.json'
+    args = ['--only', 'parse,writers', '--sizes', '200', '--block-size', '50', '--repeat', '1',
+            '--baseline', str(baseline), '--update-baseline']
+    run_benchmarks.main(args)
+    run_benchmarks.main(args)
+    runs = json.loads(baseline.read_text())['runs']
+    assert len(runs) == 2
+    assert set(runs[0]) == {'date', 'commit', 'platform', 'python', 'cpu_count', 'results'}
+    assert {'parse/read_generic/200', 'parse/schema_cache/200', 'writers/jsonl/200'} <= set(runs[1]['results'])
+    assert all(value > 0 for value in runs[1]['results'].values())
+    # the second run is compared with the first one
+    last_output = capsys.readouterr().out.split('baseline updated')[-2]
+    assert f"vs {runs[0]['commit']}" in last_output
@@ -0,0 +1,151 @@
+'''
+Block partitioning: a range read block by block must return every record exactly once,
+whatever the block size (blocks are half-open, DLI reads include both ends).
+'''
+import pytest
+from pyDli.fake_dli import FakeDli
+from pyDli.stream_writer import iter_blocks, block_read_range, stream_read
+
+
+TS_RANGE = [0, 20_000]
+
+
+class ListWriter():
+    ''' in-memory block writer '''
+
+    def __init__(self):
+        self.filename = 'memory'
+        self.records = []
+        self.num_of_records = 0
+
+    def write_block(self, records, ts_range=None):
+        self.records.extend(records)
+        self.num_of_records += len(records)
+
+
+@pytest.fixture(scope='module')
+def dli():
+    return FakeDli('case')
+
+
+@pytest.fixture(scope='module')
+def stream_label(dli):
+    return next(iter(dli.stream2reader_))
+
+
+@pytest.fixture(scope='module')
+def expected(dli, stream_label):
+    ''' timestamps of a single read of the whole range '''
+    return [rec['Timestamp'] for rec in dli.parse(dli.read(stream_label, ts_range=TS_RANGE), stream_label)]
+
+
+@pytest.mark.parametrize('block_size', [1, 99, 100, 101, 5_000, 7_777, 20_000, 20_001, 1_000_000])
+@pytest.mark.parametrize('aligned', [False, True])
+def test_iter_blocks_cover_range_once(block_size, aligned):
+    blocks = list(iter_blocks(TS_RANGE, block_size, aligned=aligned))
+    assert blocks[0][0] == TS_RANGE[0]
+    assert block_read_range(blocks[-1])[1] == TS_RANGE[1]
+    assert all(b0[1] == b1[0] for b0, b1 in zip(blocks, blocks[1:]))
+
+
+@pytest.mark.parametrize('block_size', [100, 150, 5_000, 7_777, 20_000, 1_000_000])
+def test_stream_read_counts(dli, stream_label, expected, block_size):
+    writer = ListWriter()
+    num_of_records = stream_read(dli, stream_label, writer, ts_range=TS_RANGE, block_size=block_size)
+    timestamps = [rec['Timestamp'] for rec in writer.records]
+    assert num_of_records == len(expected)
+    assert timestamps == expected
+
+
+@pytest.mark.parametrize('options', [{'block_size': 5_000},
+                                     {'block_size': 7_777},
+                                     {'target_records': 30, 'num_of_probes': 8},
+                                     {'block_size': 5_000, 'max_block_records': 7}])
+def test_mp_dli_counts(tmp_path, expected, stream_label, options):
+    from pyDli.fake_dli import load_fake
+    from pyDli.mp_dli import MP_dli
+    from pyDli.stream_writer import read_pickle_chunks
+    mp = MP_dli('fake', 'case', stream_label, tsRange=list(TS_RANGE), max_workers=2,
+                output_path=str(tmp_path), output_type='pk', loader=load_fake, **options)
+    res = mp.process()
+    timestamps = [rec['Timestamp'] for block in res['Blocks'] for records in read_pickle_chunks(block['file'])
+                  for rec in records]
+    assert res['Num of records'] == len(expected)
+    assert timestamps == expected
+    if options.get('max_block_records'):
+        assert res['Num of splits'] > 0
+
+
+@pytest.mark.parametrize('target_records', [1, 10, 77, 1_000])
+def test_plan_blocks_half_open(target_records):
+    from pyDli.partition import density_segments, plan_blocks, probe_ranges, split_block
+    probes = probe_ranges(TS_RANGE, 8, 500)
+    segments = density_segments(TS_RANGE, probes, [5] * len(probes))
+    blocks = plan_blocks(TS_RANGE, segments, target_records)
+    assert blocks[0][0] == TS_RANGE[0] and block_read_range(blocks[-1])[1] == TS_RANGE[1]
+    assert all(b0[1] == b1[0] for b0, b1 in zip(blocks, blocks[1:]))
+    halves = split_block(blocks[0])
+    assert halves[0][0] == blocks[0][0] and halves[-1][1] == blocks[0][1]
+
+
+@pytest.mark.parametrize('num_of_parts', [1, 3, 16, 64])
+def test_merged_parts_counts(tmp_path, dli, stream_label, expected, num_of_parts):
+    ''' parts of a parallel ('cluster') read, each read like dli_read_block, then merged '''
+    from pyDli.stream_writer import get_writer, merge_parts, split_range
+    parts = split_range(TS_RANGE, num_of_parts)
+    assert parts[0][0] == TS_RANGE[0] and parts[-1][1] == TS_RANGE[1]
+    part_files = []
+    for i, part in enumerate(parts):
+        with get_writer('pk', tmp_path.joinpath(f'{i:06d}')) as writer:
+            stream_read(dli, stream_label, writer, ts_range=part, block_size=3_000)
+        part_files.append(writer.filename)
+    writer = ListWriter()
+    assert merge_parts(part_files, writer) == len(expected)
+    assert [rec['Timestamp'] for rec in writer.records] == expected
+    # a stride applied while merging keeps the records of a serial strided read
+    serial, merged = ListWriter(), ListWriter()
+    stream_read(dli, stream_label, serial, ts_range=TS_RANGE, block_size=3_000, extract={'stride': 7})
+    merge_parts(part_files, merged, stride=7)
+    assert [rec['Timestamp'] for rec in merged.records] == [rec['Timestamp'] for rec in serial.records]
+    assert merged.num_of_records == len(expected[::7])
+
+
+def test_mp_dli_rejects_stride():
+    from pyDli.fake_dli import load_fake
+    from pyDli.mp_dli import MP_dli
+    with pytest.raises(ValueError):
+        MP_dli('fake', 'case', 'stream', tsRange=list(TS_RANGE), loader=load_fake, extract={'stride': 3})
+
+
+def test_trace_store_no_duplicate_timestamps(tmp_path, dli, stream_label, expected):
+    import numpy as np
+    from pyDli.trace_store import TraceStore
+    store = TraceStore(tmp_path.joinpath('stream.store'))
+    blocks = list(iter_blocks(TS_RANGE, 3_000))
+    # out of order, one block appended twice, one inclusive block sharing its edge with the next one
+    for block in blocks[::-1] + [blocks[2]]:
+        store.append(dli.parse(dli.read(stream_label, ts_range=block_read_range(block)), stream_label))
+    store.append(dli.parse(dli.read(stream_label, ts_range=[blocks[1][0], blocks[1][1]]), stream_label))
+    assert store.num_of_records == len(expected)
+    assert store.compact()
+    assert list(store.column('Timestamp')) == expected
+    window = store.window(4_000, 6_000)
+    assert len(window) == len(np.unique(window['Timestamp'])) == len([t for t in expected if 4_000 <= t <= 6_000])
+    # blocks filling a gap between compacted segments are still appended
+    gap = TraceStore(tmp_path.joinpath('gap.store'))
+    for block in (blocks[2], blocks[0]):
+        gap.append(dli.parse(dli.read(stream_label, ts_range=block_read_range(block)), stream_label))
+    gap.compact()
+    assert gap.append(dli.parse(dli.read(stream_label, ts_range=block_read_range(blocks[1])), stream_label)) > 0
+    assert list(gap.column('Timestamp')) == [t for t in expected if t < blocks[2][1]]
+
+
+def test_mp_dli_adaptive_blocks_are_capped(stream_label):
+    from pyDli.fake_dli import load_fake
+    from pyDli.mp_dli import MP_dli
+    # a single probe sees almost nothing: without a cap the plan would be one block over the whole range
+    mp = MP_dli('fake', 'case', stream_label, tsRange=list(TS_RANGE), max_workers=1, loader=load_fake,
+                block_size=2_000, target_records=1_000_000, num_of_probes=1)
+    blocks = mp.plan_blocks()
+    assert len(blocks) >= (TS_RANGE[1] - TS_RANGE[0]) // 2_000
+    assert max(b[1] - b[0] for b in blocks) <= 2_000
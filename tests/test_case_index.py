@@ -0,0 +1,58 @@
+'''
+Case index: one walk of the case directory, saved in a sidecar file that later processes reuse
+until a directory of the case changes.
+'''
+import os
+import pytest
+from common.case_index import CaseIndex
+
+
+def touch_dir(path, offset):
+    ''' move the mtime of a directory, as adding / removing an entry would '''
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + offset))
+
+
+@pytest.fixture
+def case(tmp_path):
+    case_dir = tmp_path / 'case1'
+    for rel_path in ['Streams/TraceA_0.1', 'Streams/TraceA_1.1', 'Streams/TraceB.1', 'Other/notes.txt']:
+        (case_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (case_dir / rel_path).write_bytes(b'\0' * 16)
+    (case_dir / 'Info').mkdir()
+    (case_dir / 'Info' / 'recording_version.txt').write_text('Recording\nWSM Version: 7.2.1\n')
+    return case_dir
+
+
+def test_build_and_sidecar(tmp_path, case):
+    index = CaseIndex(case, cache_dir=tmp_path / 'index').build()
+    assert [os.path.basename(p) for p in index.find_streams('TraceA')] == ['TraceA_0.1', 'TraceA_1.1']
+    assert index.stream_info(case / 'Streams' / 'TraceB') == index.streams[os.path.join('Streams', 'TraceB.1')]
+    assert index.wsm_version == '7.2.1'
+    assert index.sidecar_path.exists()
+
+    # another process loads the sidecar instead of walking the case
+    loaded = CaseIndex(case, cache_dir=tmp_path / 'index')
+    assert loaded.load()
+    assert loaded.streams == index.streams and loaded.wsm_version == '7.2.1'
+
+
+def test_changed_directory_invalidates(tmp_path, case):
+    index = CaseIndex.get(case, cache_dir=tmp_path / 'index')
+    assert CaseIndex.get(case, cache_dir=tmp_path / 'index') is index
+
+    (case / 'Streams' / 'TraceC.1').write_bytes(b'\0')
+    touch_dir(case / 'Streams', 1_000_000)
+    assert not index.is_valid()
+    assert not CaseIndex(case, cache_dir=tmp_path / 'index').load()
+    # a fresh index within max_age is returned as is, an older one is re-checked and rebuilt
+    assert CaseIndex.get(case, cache_dir=tmp_path / 'index') is index
+    rebuilt = CaseIndex.get(case, cache_dir=tmp_path / 'index', max_age=0)
+    assert rebuilt is not index
+    assert [os.path.basename(p) for p in rebuilt.find_streams('TraceC')] == ['TraceC.1']
+
+
+def test_stale_sidecar_version(tmp_path, case):
+    index = CaseIndex(case, cache_dir=tmp_path / 'index').build()
+    index.sidecar_path.write_text(index.sidecar_path.read_text().replace('"version": 1', '"version": 0'))
+    assert not CaseIndex(case, cache_dir=tmp_path / 'index').load()
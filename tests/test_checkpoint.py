@@ -0,0 +1,77 @@
+'''
+Checkpoints of a single output file: an interrupted read resumes after its last checkpointed block,
+a completed read leaves no sidecar files, and only transient OS errors are retried.
+'''
+import errno
+import pytest
+from pyDli.checkpoint import open_output, CHECKPOINT_SUFFIX, CheckpointBusy
+from pyDli.fake_dli import FakeDli
+from pyDli.stream_writer import read_pickle_chunks, stream_read
+
+
+TS_RANGE = [0, 20_000]
+JOB = {'stream': 'test', 'tsRange': TS_RANGE}
+
+
+class Interrupt(Exception):
+    pass
+
+
+@pytest.fixture(scope='module')
+def dli():
+    return FakeDli('case')
+
+
+@pytest.fixture(scope='module')
+def stream_label(dli):
+    return next(iter(dli.stream2reader_))
+
+
+def read(dli, stream_label, output, interrupt_after=None):
+    def progress(block_num, block, num_of_records):
+        if interrupt_after is not None and block_num == interrupt_after:
+            raise Interrupt()
+
+    writer, checkpoint = open_output('pk', output, JOB)
+    try:
+        with writer:
+            stream_read(dli, stream_label, writer, ts_range=TS_RANGE, block_size=3_000, progress=progress,
+                        checkpoint=checkpoint)
+        checkpoint.finish()
+    finally:
+        checkpoint.close()
+    return writer
+
+
+def timestamps(filename):
+    return [rec['Timestamp'] for records in read_pickle_chunks(filename) for rec in records]
+
+
+def test_resume_and_cleanup(tmp_path, dli, stream_label):
+    output = tmp_path.joinpath('out')
+    with pytest.raises(Interrupt):
+        read(dli, stream_label, output, interrupt_after=2)
+    assert tmp_path.joinpath('out' + CHECKPOINT_SUFFIX).exists()
+    writer = read(dli, stream_label, output)
+    full = read(dli, stream_label, tmp_path.joinpath('full'))
+    assert timestamps(writer.filename) == timestamps(full.filename)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['full.pk', 'out.pk']
+
+
+def test_busy_checkpoint(tmp_path):
+    writer, checkpoint = open_output('pk', tmp_path.joinpath('out'), JOB)
+    try:
+        with pytest.raises(CheckpointBusy):
+            open_output('pk', tmp_path.joinpath('out'), JOB)
+    finally:
+        writer.close()
+        checkpoint.close()
+
+
+def test_transient_errors():
+    from celery_tasks import is_transient
+    assert is_transient(OSError(errno.EIO, 'I/O error'))
+    assert is_transient(TimeoutError())
+    assert not is_transient(FileNotFoundError(errno.ENOENT, 'missing'))
+    assert not is_transient(PermissionError(errno.EACCES, 'denied'))
+    assert not is_transient(ValueError())
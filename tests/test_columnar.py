@@ -0,0 +1,40 @@
+'''
+Columnar output: column names that are np.savez argument names, and object columns that are
+the only ones unpickled on load.
+'''
+import numpy as np
+import pytest
+from pyDli.columnar import to_columns, save_columnar, load_columnar
+
+RECORDS = [{'file': f'rec{i}.dat', 'allow_pickle': i, 'Location': {'X': i * 0.5}, 'Ids': list(range(i % 3))}
+           for i in range(6)]
+
+
+@pytest.mark.parametrize('fmt', ['npz', 'npy'])
+def test_round_trip(tmp_path, fmt):
+    columns = to_columns(RECORDS)
+    loaded = load_columnar(save_columnar(columns, tmp_path / f'out.{fmt}', fmt=fmt))
+    assert list(loaded) == ['file', 'allow_pickle', 'Location.X', 'Ids']
+    assert loaded['file'].tolist() == [f'rec{i}.dat' for i in range(6)]
+    assert loaded['allow_pickle'].dtype.kind == 'i'
+    assert np.allclose(loaded['Location.X'], np.arange(6) * 0.5)
+    assert loaded['Ids'].dtype == object and loaded['Ids'][5] == [0, 1]
+
+
+def test_npz_pickles_object_columns_only(tmp_path):
+    filename = save_columnar(to_columns(RECORDS), tmp_path / 'out.npz')
+    with load_columnar(filename) as columns:
+        assert columns['Ids'][2] == [0, 1]
+        # a pickled member that the index does not list as an object column is refused
+        columns.index['Ids']['dtype'] = 'float64'
+        with pytest.raises(ValueError):
+            columns['Ids']
+
+
+def test_legacy_npz(tmp_path):
+    filename = tmp_path / 'legacy.npz'
+    np.savez(filename, x=np.arange(3), ragged=to_columns(RECORDS)['Ids'])
+    assert load_columnar(filename)['x'].tolist() == [0, 1, 2]
+    with pytest.raises(ValueError):
+        load_columnar(filename)['ragged']
+    assert load_columnar(filename, allow_pickle=True)['ragged'][2] == [0, 1]
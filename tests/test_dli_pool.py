@@ -0,0 +1,38 @@
+'''
+Process pools of dli_pool: at most MAX_POOLS stay alive, evicted pools are shut down once no
+use_pool() caller holds them.
+'''
+import pytest
+from pyDli import dli_pool
+from pyDli.fake_dli import load_fake
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    monkeypatch.setattr(dli_pool, 'MAX_POOLS', 2)
+    dli_pool.shutdown_pools()
+    yield dli_pool
+    dli_pool.shutdown_pools()
+
+
+def is_shutdown(pool):
+    return pool._shutdown_thread
+
+
+def test_pools_are_bounded(pools):
+    created = [pools.get_pool(f'v{i}', 1, loader=load_fake) for i in range(4)]
+    assert len(pools._pools) == 2
+    assert [is_shutdown(pool) for pool in created] == [True, True, False, False]
+    # a recently used pool is kept, the least recently used one goes
+    assert pools.get_pool('v2', 1, loader=load_fake) is created[2]
+    pools.get_pool('v4', 1, loader=load_fake)
+    assert is_shutdown(created[3]) and not is_shutdown(created[2])
+
+
+def test_pool_in_use_survives_eviction(pools):
+    with pools.use_pool('v0', 1, loader=load_fake) as pool:
+        pools.get_pool('v1', 1, loader=load_fake)
+        pools.get_pool('v2', 1, loader=load_fake)
+        assert ('v0', 1, load_fake) not in pools._pools
+        assert pool.submit(pools.first_last_key, '.', 'stream', 'v0').result()
+    assert is_shutdown(pool)
@@ -0,0 +1,56 @@
+'''
+Staged pipeline: a failing progress callback must not stall the stages, and an item that fails
+still gets the on_failure cleanup of the stages it skips.
+'''
+import threading
+from pht_runner.pipeline import Pipeline, Stage
+
+
+def run_with_timeout(pipeline, values, timeout=10):
+    ''' Pipeline.run in a thread, None if it did not finish within timeout '''
+    res = {}
+    thread = threading.Thread(target=lambda: res.update(summary=pipeline.run(values)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return res.get('summary')
+
+
+def test_progress_error_does_not_stall():
+    done = []
+
+    def progress(item, stage_name):
+        raise RuntimeError('progress callback failed')
+
+    pipeline = Pipeline([Stage('a', lambda value: None, workers=2),
+                         Stage('b', done.append)], queue_size=1, progress=progress)
+    summary = run_with_timeout(pipeline, range(10))
+    assert summary is not None
+    assert summary['succeeded'] == 10
+    assert sorted(done) == list(range(10))
+
+
+def test_failed_item_runs_on_failure_of_skipped_stages():
+    harvested, cleaned = [], []
+
+    def run(value):
+        if value % 3 == 0:
+            raise RuntimeError(f'item {value} failed')
+
+    pipeline = Pipeline([Stage('prepare', lambda value: None),
+                         Stage('run', run, workers=2),
+                         Stage('harvest', harvested.append, on_failure=cleaned.append)])
+    summary = run_with_timeout(pipeline, range(7))
+    assert summary['failed'] == 3
+    assert sorted(harvested) == [1, 2, 4, 5]
+    assert sorted(cleaned) == [0, 3, 6]
+    assert {item['stage'] for item in summary['items'] if item['state'] == 'FAILURE'} == {'run'}
+
+
+def test_on_failure_error_is_contained():
+    def on_failure(value):
+        raise OSError('cleanup failed')
+
+    pipeline = Pipeline([Stage('run', lambda value: 1 / 0),
+                         Stage('harvest', lambda value: None, on_failure=on_failure)])
+    summary = run_with_timeout(pipeline, range(3))
+    assert summary['failed'] == 3
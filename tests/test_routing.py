@@ -0,0 +1,29 @@
+'''
+Queue routing of the Celery tasks: fixed routes and the estimated cost of a dli_read.
+'''
+from common.routing import HEAVY_TS_SPAN, route_task, estimate_cost
+
+
+def dli_read_route(**params):
+    return route_task('tasks.dli_read', (), {'params': params}, {})
+
+
+def test_fixed_routes():
+    assert route_task('tasks.add', (), {}, {})['queue'] == 'light'
+    assert route_task('tasks.pht_run', (), {}, {})['queue'] == 'io'
+    assert route_task('tasks.unknown', (), {}, {}) is None
+
+
+def test_dli_read_cost():
+    assert estimate_cost({'tsRange': [100, 1100], 'stream_label': ['a', 'b']}) == 2000
+    assert estimate_cost({'stream_label': 'a'}) is None
+    # a strided read still reads the whole range
+    assert estimate_cost({'tsRange': [0, 1000], 'stream_label': 'a', 'stride': 10}) == 1000
+
+
+def test_dli_read_queue():
+    assert dli_read_route(tsRange=[0, 1000], stream_label='a')['queue'] == 'parse'
+    assert dli_read_route(tsRange=[0, HEAVY_TS_SPAN], stream_label='a', stride=4)['queue'] == 'heavy'
+    assert dli_read_route(stream_label='a')['queue'] == 'heavy'
+    assert dli_read_route(tsRange=[0, 1000], stream_label='a', parallel='local')['queue'] == 'io'
+    assert dli_read_route(tsRange=[0, 1000], stream_label='a', queue='light')['queue'] == 'light'
@@ -0,0 +1,58 @@
+'''
+ProcessSupervisor on the stand-in tester (pht_runner/dummy_phtester.py): normal run, non-zero exit,
+timeout and memory kills, and the configurable tester command.
+'''
+import sys
+from pathlib import Path
+import pytest
+from pht_runner.pht_runner import tester_command as build_command
+from pht_runner.supervisor import ProcessSupervisor, ProcessLimitError
+
+ROOT = Path(__file__).resolve().parents[1]
+DUMMY = '{python} -m pht_runner.dummy_phtester {incoming} {output}'
+
+
+def supervise(tmp_path, options='', **kwargs):
+    cmd = build_command(f'{DUMMY} {options}', ROOT, tmp_path / 'incoming' / 'case1', tmp_path / 'output')
+    return ProcessSupervisor(cmd, cwd=str(ROOT), log_file=tmp_path / 'case1.log', poll_interval=0.05, **kwargs)
+
+
+def test_tester_command():
+    assert build_command('', 'C:/pht/v1', 'in', 'out') == [str(Path('C:/pht/v1', 'PositionHandlerTester.bat')), 'in', 'out']
+    assert build_command(DUMMY + ' --lines 5', 'v1', 'in', 'out') == \
+        [sys.executable, '-m', 'pht_runner.dummy_phtester', 'in', 'out', '--lines', '5']
+    assert build_command(['{tester_dir}/run.sh', '{incoming}'], 'v1', 'in', 'out') == ['v1/run.sh', 'in']
+
+
+def test_normal_run(tmp_path):
+    result = supervise(tmp_path, '--lines 12 --delay 0.01').run()
+    assert result['returncode'] == 0 and result['killed'] is None
+    # 12 progress lines, 1 stderr warning, 'done'
+    assert result['lines'] == 14 and result['tail'][-1].endswith('done')
+    assert (tmp_path / 'output' / 'case1' / 'run' / 'tracettalgupdate2.1').exists()
+    assert 'exit code 0' in (tmp_path / 'case1.log').read_text()
+
+
+def test_non_zero_exit(tmp_path):
+    result = supervise(tmp_path, '--lines 2 --delay 0.01 --exit-code 3', timeout=60).run()
+    assert result['returncode'] == 3 and result['killed'] is None
+
+
+def test_timeout_kill(tmp_path):
+    with pytest.raises(ProcessLimitError) as info:
+        supervise(tmp_path, '--lines 1000 --delay 0.05', timeout=0.5).run()
+    result = info.value.result
+    assert result['killed'] == 'timeout'
+    assert 0.5 <= result['elapsed_sec'] < 10
+    if sys.platform != 'win32':
+        assert result['returncode'] == -9
+
+
+@pytest.mark.skipif(sys.platform != 'win32' and not Path('/proc').is_dir(), reason='no process memory source')
+def test_memory_kill(tmp_path):
+    with pytest.raises(ProcessLimitError) as info:
+        supervise(tmp_path, '--memory-mb 200 --lines 1000 --delay 0.05', max_memory_bytes=100 * 2**20,
+                  timeout=60).run()
+    result = info.value.result
+    assert result['killed'] == 'memory'
+    assert result['peak_rss_bytes'] > 100 * 2**20
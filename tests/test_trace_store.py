@@ -0,0 +1,36 @@
+'''
+TraceStore dtype: a later block with longer strings, a column that was None (or missing) before, or
+floats in an int column widens the store instead of losing data; incompatible columns are rejected.
+'''
+import numpy as np
+import pytest
+from pyDli.trace_store import TraceStore
+
+
+def block(ts0, n, **columns):
+    return [dict({'Timestamp': ts0 + i}, **{name: value(i) for name, value in columns.items()}) for i in range(n)]
+
+
+def test_later_block_widens_dtype(tmp_path):
+    store = TraceStore(tmp_path.joinpath('stream.store'))
+    store.append(block(0, 3, Name=lambda i: 'ab', X=lambda i: None, Count=lambda i: i))
+    assert 'X' not in store.columns
+    store.append(block(10, 3, Name=lambda i: 'abcdefgh', X=lambda i: i + 0.5, Count=lambda i: i + 0.25))
+    store.append(block(20, 2, Name=lambda i: 'c'))
+    assert store.num_of_records == 8
+    assert list(store.column('Name')) == ['ab'] * 3 + ['abcdefgh'] * 3 + ['c'] * 2
+    x = store.column('X')
+    assert np.isnan(x[:3]).all() and list(x[3:6]) == [0.5, 1.5, 2.5] and np.isnan(x[6:]).all()
+    assert list(store.column('Count')[:6]) == [0, 1, 2, 0.25, 1.25, 2.25]
+    assert list(store.column('Timestamp')) == [0, 1, 2, 10, 11, 12, 20, 21]
+    # a fresh reader sees the migrated dtype
+    reader = TraceStore(tmp_path.joinpath('stream.store'))
+    assert reader.window(10, 12)['Name'].tolist() == ['abcdefgh'] * 3
+
+
+def test_incompatible_column_is_rejected(tmp_path):
+    store = TraceStore(tmp_path.joinpath('stream.store'))
+    store.append(block(0, 3, Name=lambda i: 'ab'))
+    with pytest.raises(ValueError):
+        store.append(block(10, 3, Name=lambda i: i))
+    assert store.num_of_records == 3
@@ -0,0 +1,73 @@
+'''
+Result transport: the registered zlib serializers round-trip task results (int keys included), and
+claim-check payloads are offloaded, resolved and purged.
+'''
+import os
+import pytest
+from kombu.serialization import dumps, loads
+from common import transport
+
+
+RESULT = {'success': True, 'records': 3, 'blocks': {0: 10, 1: 20}, 'labels': ['a', 'b'], 'ratio': 0.5,
+          'nested': {'x': [1, 2, {3: 'c'}]}, 'none': None}
+
+
+def serializers():
+    return [transport.ZLIB_JSON] + ([transport.ZLIB_MSGPACK] if transport.msgpack else [])
+
+
+@pytest.mark.parametrize('serializer', serializers())
+def test_serializer_round_trip(serializer):
+    content_type, content_encoding, data = dumps(RESULT, serializer=serializer)
+    assert isinstance(data, bytes)
+    res = loads(data, content_type, content_encoding, accept=[content_type])
+    if serializer == transport.ZLIB_JSON:
+        # JSON turns int keys into strings
+        assert res['blocks'] == {'0': 10, '1': 20}
+    else:
+        assert res == RESULT
+
+
+def test_backend_round_trip():
+    from celery import Celery
+    app = Celery('transport_test', backend='cache+memory://', broker='memory://')
+    app.conf.update(**transport.result_transport_config())
+    app.backend.store_result('task-id', RESULT, 'SUCCESS')
+    res = app.AsyncResult('task-id').result
+    assert res['records'] == RESULT['records'] and len(res['blocks']) == 2
+
+
+def test_result_is_compressed():
+    result = {'values': list(range(10_000))}
+    content_type, content_encoding, data = dumps(result, serializer=transport.RESULT_SERIALIZER)
+    content_type, content_encoding, plain = dumps(result, serializer='json')
+    assert len(data) < len(plain) / 2
+
+
+def test_claim_check(tmp_path):
+    small = {'records': 1}
+    assert transport.offload(small, name='small', threshold=1_000, store_dir=tmp_path) == small
+    large = {'values': list(range(1_000))}
+    reference = transport.offload(large, name='large', threshold=1_000, store_dir=tmp_path)
+    assert transport.is_claim_check(reference)
+    assert transport.resolve(reference) == large
+    assert transport.resolve(small) == small
+
+
+def test_claim_check_corrupted(tmp_path):
+    reference = transport.store_payload({'values': [1, 2]}, tmp_path, name='payload')
+    with open(reference[transport.CLAIM_CHECK_KEY], 'ab') as fp:
+        fp.write(b'x')
+    with pytest.raises(ValueError):
+        transport.resolve(reference)
+
+
+def test_purge_store(tmp_path):
+    old = transport.store_payload({'values': [1]}, tmp_path, name='old')[transport.CLAIM_CHECK_KEY]
+    new = transport.store_payload({'values': [2]}, tmp_path, name='new')[transport.CLAIM_CHECK_KEY]
+    os.utime(old, (0, 0))
+    assert transport.purge_store(tmp_path, max_age=3600, force=True) == 1
+    assert not os.path.exists(old) and os.path.exists(new)
+    # rate limited without force
+    os.utime(new, (0, 0))
+    assert transport.purge_store(tmp_path, max_age=3600) == 0